@@ -4,30 +4,57 @@ Flask backend with file upload, OCR, and intelligent analysis
 """
 
 import os
-from flask import Flask, request, jsonify, send_file, session
+from flask import (
+    Flask, request, jsonify, send_file, session, Response,
+    stream_with_context, g, has_app_context
+)
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
-import google.generativeai as genai
+import gemini_client
+import gemini_files
+from gemini_client import GeminiBusy, GeminiTimeout
 import uuid
 from database import (
     init_database, track_interaction, get_user_history,
     add_favorite, get_favorites, remove_favorite,
-    get_usage_analytics, get_recommendations
+    get_usage_analytics, get_recommendations,
+    store_document, get_document, get_document_range
 )
 from language_detector import (
     LanguageDetector, UIStrings,
     process_kannada_text, process_english_text
 )
+from extractors import (
+    extract_pdf_text, extract_docx_text, extract_txt_text,
+    count_pdf_pages, iter_pdf_pages, iter_docx_pages
+)
+import extraction_cache
+import response_cache
+import simhash_index
+import singleflight
+import conversations
+import batch_jobs
+from extraction_cache import UncachedText, cached_extractor
+from upload_buffer import UploadBuffer, as_file
+from png_stream import base64_chunks, encode_png
+from chunking import BYTES_PER_TOKEN, estimate_tokens, split_content
+from ocr import ocr_image
+import ocr_pool
+import upscale
+from ocr_pool import OcrPoolBusy
 from PIL import Image
-import fitz  # PyMuPDF
-from docx import Document
-import pytesseract
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 from reportlab.lib.enums import TA_LEFT
 import io
+import json
+import math
+import mimetypes
+import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import chain
 from urllib.parse import quote
 
 app = Flask(__name__)
@@ -37,22 +64,107 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.secret_key = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
 
-# Create uploads folder
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-# Initialize database
-init_database()
-
 # Configure Gemini API
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+ANALYSIS_MODEL = 'gemini-2.5-flash'
+CHAT_MODEL = 'gemini-2.0-flash-exp'
+
+
+def init_app():
+    """Per-process start-up: uploads, database, Gemini client, file reaper."""
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    init_database()
+
+    # Configure once per worker and build the shared model handles up front
+    gemini_client.configure(GEMINI_API_KEY)
+    gemini_client.warm_up(
+        [ANALYSIS_MODEL, CHAT_MODEL],
+        ping=os.getenv('GEMINI_WARMUP_PING', 'true').lower() == 'true')
+    gemini_files.start_reaper()
+
+
+# Under `python app.py` the spawned upscale and OCR workers re-import this
+# file as __mp_main__; they only need the worker functions, not start-up.
+if __name__ != '__mp_main__':
+    init_app()
 
 # Configure LightX AI Expander API
 LIGHTX_API_KEY = os.getenv('LIGHTX_API_KEY', '')
+LIGHTX_API_URL = os.getenv(
+    'LIGHTX_API_URL',
+    'https://api.lightxeditor.com/external/api/v1/outpainting')
 
-# Configure Replicate API for AI Upscaling
+# Configure Replicate API for AI Upscaling (base URL None = the real API)
 REPLICATE_API_KEY = os.getenv('REPLICATE_API_KEY', '')
+REPLICATE_BASE_URL = os.getenv('REPLICATE_BASE_URL') or None
+
+# Extracted documents are kept server-side and referenced by id
+DOCUMENT_TTL_SECONDS = int(os.getenv('DOCUMENT_TTL_SECONDS', '3600'))
+DOCUMENT_RANGE_MAX_CHARS = 100000
+
+# Progressive upload: pages per PDF pool task and chars per text chunk
+STREAM_PDF_BATCH_PAGES = int(os.getenv('STREAM_PDF_BATCH_PAGES', '4'))
+STREAM_CHUNK_CHARS = 3000
+
+# Latency budget per endpoint; Gemini calls that cannot finish in what is
+# left fall back to a faster model tier or fail with a 504. The long
+# streaming budgets rely on threaded workers (gunicorn.conf.py); a sync
+# worker would be killed at --timeout mid-stream.
+REQUEST_BUDGET_SECONDS = float(os.getenv('REQUEST_BUDGET_SECONDS', '25'))
+REQUEST_BUDGETS = dict({
+    'chat_stream': 120,
+    'upload_file_stream': 300
+}, **json.loads(os.getenv('REQUEST_BUDGETS', '{}')))
+
+# Analyses over this many (estimated) tokens run map-reduce over chunks
+ANALYSIS_SINGLE_PASS_TOKENS = int(
+    os.getenv('ANALYSIS_SINGLE_PASS_TOKENS', '30000'))
+ANALYSIS_CHUNK_TOKENS = int(os.getenv('ANALYSIS_CHUNK_TOKENS', '8000'))
+ANALYSIS_MAP_WORKERS = int(os.getenv('ANALYSIS_MAP_WORKERS', '4'))
+# Each chunk call may take this long, and a map-reduce analysis gets this
+# much extra budget per round of ANALYSIS_MAP_WORKERS chunk calls
+ANALYSIS_CHUNK_SECONDS = float(os.getenv('ANALYSIS_CHUNK_SECONDS', '20'))
+
+# /api/analyze/batch fan-out; Gemini rate limits still apply underneath
+ANALYZE_BATCH_CONCURRENCY = int(os.getenv('ANALYZE_BATCH_CONCURRENCY', '4'))
+ANALYZE_BATCH_MAX_CONCURRENCY = int(
+    os.getenv('ANALYZE_BATCH_MAX_CONCURRENCY', '16'))
+ANALYZE_BATCH_MAX_ITEMS = int(os.getenv('ANALYZE_BATCH_MAX_ITEMS', '500'))
+ANALYZE_BATCH_BUSY_RETRIES = 3
+# Background batches running at once per worker (each fans out itself)
+BATCH_JOB_WORKERS = int(os.getenv('BATCH_JOB_WORKERS', '2'))
+
+
+def sse_event(event, data):
+    """Format one Server-Sent Events message."""
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+
+
+@app.before_request
+def start_request_budget():
+    """Give every request a deadline that its Gemini calls must meet."""
+    g.deadline = time.monotonic() + REQUEST_BUDGETS.get(
+        request.endpoint, REQUEST_BUDGET_SECONDS)
+
+
+def request_deadline():
+    """The current request's monotonic deadline, or None outside one."""
+    return g.get('deadline') if has_app_context() else None
+
+
+def timeout_response():
+    return jsonify({
+        'error': 'AI service took too long, please try again'
+    }), 504
+
+
+def busy_response(message, retry_after=None):
+    """503 for temporary overload, with Retry-After when it is known."""
+    response = jsonify({'error': message})
+    response.status_code = 503
+    if retry_after:
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
 
 
 def get_session_id():
@@ -62,23 +174,37 @@ def get_session_id():
     return session['session_id']
 
 
-def extract_text_from_image(image_path):
+def parse_page_range(value):
+    """Parse an optional "first-last" page range form value."""
+    if not value:
+        return None
+    try:
+        first, dash, last = value.partition('-')
+        if not dash:
+            last = first
+        return int(first) if first else None, int(last) if last else None
+    except ValueError:
+        return None
+
+
+@cached_extractor('image')
+def extract_text_from_image(source):
     """Extract text from image or describe image content using AI."""
     try:
-        # Try Tesseract first
+        # Try Tesseract first (pre-processed, banded across cores)
         try:
-            img = Image.open(image_path)
-            text = pytesseract.image_to_string(img)
+            img = Image.open(as_file(source))
+            text = ocr_image(img)
             if text.strip():
                 return text.strip()
+        except OcrPoolBusy:
+            raise
         except Exception:
             pass
 
         # Use Gemini Vision for image analysis
-        if GEMINI_API_KEY:
-            genai.configure(api_key=GEMINI_API_KEY)
-            model = genai.GenerativeModel('gemini-2.5-flash')
-            img = Image.open(image_path)
+        if gemini_client.is_configured():
+            img = Image.open(as_file(source))
 
             prompt = """Analyze this image carefully.
 
@@ -96,62 +222,55 @@ If there is NO TEXT or very little text:
 
 Be thorough and descriptive."""
 
-            response = model.generate_content([prompt, img])
-            return response.text.strip()
+            response, model = gemini_client.generate_with_fallback(
+                ANALYSIS_MODEL, [prompt, img], deadline=request_deadline())
+            text = response.text.strip()
+            # Fallback-tier text is served but not cached
+            if model != ANALYSIS_MODEL:
+                return UncachedText(text)
+            return text
 
         return "Could not analyze image"
+    except (OcrPoolBusy, GeminiBusy, GeminiTimeout):
+        raise
     except Exception as e:
         return "Error analyzing image: {}".format(str(e))
 
 
-def extract_text_from_pdf(pdf_path):
-    """Extract text from PDF using PyMuPDF."""
+@cached_extractor('pdf')
+def extract_text_from_pdf(source, page_range=None):
+    """Extract text from PDF using PyMuPDF (page-parallel for big docs)."""
     try:
-        doc = fitz.open(pdf_path)
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        doc.close()
-        return text.strip()
+        return extract_pdf_text(source, page_range)
+    except OcrPoolBusy:
+        raise
     except Exception as e:
         return f"Error extracting text from PDF: {str(e)}"
 
 
-def extract_text_from_docx(docx_path):
-    """Extract text from DOCX using python-docx."""
+@cached_extractor('docx')
+def extract_text_from_docx(source):
+    """Extract text from DOCX (paragraphs and tables, streamed)."""
     try:
-        doc = Document(docx_path)
-        text = "\n".join([para.text for para in doc.paragraphs])
-        return text.strip()
+        return extract_docx_text(source)
     except Exception as e:
         return f"Error extracting text from DOCX: {str(e)}"
 
 
-def extract_text_from_txt(txt_path):
-    """Extract text from TXT file."""
+@cached_extractor('txt')
+def extract_text_from_txt(source):
+    """Extract text from TXT file (encoding sniffed, size-bounded)."""
     try:
-        with open(txt_path, 'r', encoding='utf-8') as f:
-            return f.read().strip()
+        return extract_txt_text(source)
     except Exception as e:
         return f"Error reading text file: {str(e)}"
 
 
-def analyze_with_ai(content, prompt=None):
-    """Analyze content using Gemini AI with ChatGPT-style formatting."""
-    try:
-        if not GEMINI_API_KEY:
-            return "Error: GEMINI_API_KEY not configured"
-
-        model = genai.GenerativeModel('gemini-2.5-flash')
-
-        if prompt:
-            # User provided custom prompt
-            full_prompt = """{}
-
-Content:
-{}
-
-IMPORTANT: Write in natural, conversational language.
+# analyze_with_ai prompts. The fixed instructions go in the model's
+# system instruction (set once per model handle, context-cached where the
+# API allows) so each request only sends the question and the content.
+# Both parts are part of the response cache key.
+CUSTOM_ANALYSIS_INSTRUCTION = """Write in natural, conversational language.
 - Use simple, clear sentences
 - Explain like you're talking to a friend
 - NO markdown symbols (no ##, **, etc.)
@@ -161,14 +280,16 @@ IMPORTANT: Write in natural, conversational language.
 - Give complete, accurate answers
 
 Make it easy to read and understand.
-""".format(prompt, content)
-        else:
-            # Auto-generate intelligent analysis
-            full_prompt = """Analyze this content and provide a
-helpful response.
+"""
+
+CUSTOM_ANALYSIS_TEMPLATE = """{}
 
 Content:
 {}
+"""
+
+DEFAULT_ANALYSIS_INSTRUCTION = """Analyze the content you are given and
+provide a helpful response.
 
 IMPORTANT INSTRUCTIONS:
 - Write in natural, conversational English
@@ -199,13 +320,301 @@ RECOMMENDATIONS:
 Suggest helpful next steps or insights.
 
 Write everything in clear, natural language that's easy to understand.
-""".format(content)
+"""
 
-        response = model.generate_content(full_prompt)
-        return response.text.strip()
+DEFAULT_ANALYSIS_TEMPLATE = """Content:
+{}
+"""
+
+
+# Long documents: notes per chunk, then the prompts above over the notes
+CHUNK_NOTES_INSTRUCTION = """You are reading one part of a longer document.
+Write dense notes on this part for someone who will not see the original.
+
+- Keep every fact, name, number, date and definition
+- Copy any questions exactly, with their answers if the text gives them
+- Keep the original order; no introduction or conclusion
+- Plain text, no markdown symbols
+"""
+
+CHUNK_NOTES_TEMPLATE = """Part:
+{}
+"""
+
+REDUCE_PREAMBLE = (
+    "The document was too long to read at once. These are notes taken "
+    "from each of its parts, in order.\n\n")
+
+COMPACTION_TEMPLATE = """Previous summary:
+{}
+
+New turns:
+{}
+"""
+
+_map_pool = None
+_compaction_pool = None
+_batch_job_pool = None
 
+
+def analyze_with_ai(content, prompt=None, use_cache=True):
+    """Analyze content using Gemini AI with ChatGPT-style formatting."""
+    return analyze_with_ai_details(content, prompt, use_cache)['result']
+
+
+def analyze_with_ai_details(content, prompt=None, use_cache=True,
+                            approximate=True, deadline=None):
+    """Run analyze_with_ai and report where the answer came from.
+
+    Identical requests are answered from the response cache unless
+    `use_cache` is False. With `approximate`, content whose SimHash is
+    within SIMHASH_MAX_DISTANCE bits of earlier content (e.g. the same
+    worksheet with a few OCR differences) reuses that answer and is
+    flagged ``approximate``. `deadline` defaults to the current
+    request's.
+    """
+    details = {'cached': False, 'approximate': False, 'coalesced': False}
+    try:
+        if not gemini_client.is_configured():
+            details['result'] = "Error: GEMINI_API_KEY not configured"
+            return details
+
+        if prompt:
+            # User provided custom prompt
+            template = CUSTOM_ANALYSIS_TEMPLATE
+            instruction = CUSTOM_ANALYSIS_INSTRUCTION
+        else:
+            # Auto-generate intelligent analysis
+            template = DEFAULT_ANALYSIS_TEMPLATE
+            instruction = DEFAULT_ANALYSIS_INSTRUCTION
+
+        cache_key = response_cache.make_key(
+            ANALYSIS_MODEL, template, content, prompt=prompt,
+            system=instruction)
+        approximate = approximate and use_cache and (
+            response_cache.is_enabled('analyze-approximate'))
+        scope = simhash_index.scope_key(
+            ANALYSIS_MODEL, template, instruction,
+            response_cache.normalize(prompt))
+        fp = simhash_index.fingerprint(content) if approximate else None
+
+        if use_cache:
+            cached = response_cache.get(cache_key, 'analyze')
+            if cached is None and fp is not None:
+                cached = reuse_near_duplicate(scope, fp, details)
+            if cached is not None:
+                details.update(result=cached, cached=True)
+                return details
+
+        deadline = deadline or request_deadline()
+        long_document = estimate_tokens(content) > ANALYSIS_SINGLE_PASS_TOKENS
+        if long_document and deadline is not None:
+            deadline = map_reduce_deadline(content, deadline)
+
+        def call():
+            if long_document:
+                # Too long for one good answer: notes per chunk, then reduce
+                result, model = map_reduce_analysis(
+                    content, prompt, template, instruction, use_cache,
+                    details, deadline)
+            else:
+                result, model = run_analysis(
+                    template, instruction, content, prompt, deadline,
+                    details)
+            details['model'] = model
+            # Fallback-tier answers are not cached; next time try the best
+            if use_cache and model == ANALYSIS_MODEL and response_cache.put(
+                    cache_key, result, 'analyze'):
+                simhash_index.add(scope, fp, cache_key)
+            return result
+
+        # Identical requests already in flight share one Gemini call
+        details['result'], role = singleflight.do(
+            cache_key, call, lookup=partial(
+                response_cache.get, cache_key, 'analyze', record=False
+            ) if use_cache else None, deadline=deadline)
+        details['coalesced'] = role != singleflight.LEADER
+        return details
+
+    except (GeminiBusy, GeminiTimeout):
+        raise
     except Exception as e:
-        return "Error analyzing content: {}".format(str(e))
+        details['result'] = "Error analyzing content: {}".format(str(e))
+        return details
+
+
+def run_analysis(template, instruction, content, prompt=None, deadline=None,
+                 details=None):
+    """One Gemini call over the whole analysis prompt; (text, model).
+
+    Token usage reported by the API is added to `details` when given.
+    """
+    if prompt:
+        full_prompt = template.format(prompt, content)
+    else:
+        full_prompt = template.format(content)
+    response, model = gemini_client.generate_with_fallback(
+        ANALYSIS_MODEL, full_prompt, system_instruction=instruction,
+        deadline=deadline)
+    if details is not None:
+        details['usage'] = gemini_client.usage_of(response)
+    return response.text.strip(), model
+
+
+def _get_map_pool():
+    """Lazily create the pool that bounds concurrent chunk calls."""
+    global _map_pool
+    if _map_pool is None:
+        _map_pool = ThreadPoolExecutor(max_workers=ANALYSIS_MAP_WORKERS)
+    return _map_pool
+
+
+def map_reduce_deadline(content, deadline):
+    """`deadline` stretched by ANALYSIS_CHUNK_SECONDS per map round.
+
+    A 500-page document is dozens of chunks; the plain request budget
+    would not cover even the first few rounds of chunk calls.
+    """
+    chunks = -(-estimate_tokens(content) // ANALYSIS_CHUNK_TOKENS)
+    rounds = -(-chunks // ANALYSIS_MAP_WORKERS)
+    return deadline + rounds * ANALYSIS_CHUNK_SECONDS
+
+
+def map_chunk_notes(chunks, use_cache=True, deadline=None):
+    """chunk_notes for every chunk on the map pool, in order.
+
+    Each call gets at most ANALYSIS_CHUNK_SECONDS from when it starts
+    (and never past `deadline`). When one fails, chunks that have not
+    started yet are cancelled rather than left to run for nothing.
+    """
+    def notes(chunk):
+        chunk_deadline = deadline
+        if deadline is not None:
+            chunk_deadline = min(
+                deadline, time.monotonic() + ANALYSIS_CHUNK_SECONDS)
+        return chunk_notes(chunk, use_cache, chunk_deadline)
+
+    pool = _get_map_pool()
+    futures = [pool.submit(notes, chunk) for chunk in chunks]
+    try:
+        return [future.result() for future in futures]
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def chunk_notes(chunk, use_cache=True, deadline=None):
+    """Question-independent notes for one chunk, cached by chunk text.
+
+    Because the notes do not depend on the user's prompt, a follow-up
+    question about the same document reuses every chunk's notes and only
+    pays for the reduce call.
+    """
+    cache_key = response_cache.make_key(
+        ANALYSIS_MODEL, CHUNK_NOTES_TEMPLATE, chunk,
+        system=CHUNK_NOTES_INSTRUCTION)
+    if use_cache:
+        cached = response_cache.get(cache_key, 'analyze-chunk')
+        if cached is not None:
+            return cached
+
+    def call():
+        response, model = gemini_client.generate_with_fallback(
+            ANALYSIS_MODEL, CHUNK_NOTES_TEMPLATE.format(chunk),
+            system_instruction=CHUNK_NOTES_INSTRUCTION, deadline=deadline)
+        notes = response.text.strip()
+        if use_cache and model == ANALYSIS_MODEL:
+            response_cache.put(cache_key, notes, 'analyze-chunk')
+        return notes
+
+    return singleflight.do(cache_key, call, lookup=partial(
+        response_cache.get, cache_key, 'analyze-chunk', record=False
+    ) if use_cache else None, deadline=deadline)[0]
+
+
+def map_reduce_analysis(content, prompt, template, instruction, use_cache,
+                        details, deadline=None):
+    """Analyze a long document as notes per chunk plus one reduce pass.
+
+    Chunks follow page/paragraph boundaries. If the combined notes are
+    still over the single-pass budget they are chunked and condensed
+    again before the final answer.
+    """
+    notes = content
+    rounds = 0
+    while estimate_tokens(notes) > ANALYSIS_SINGLE_PASS_TOKENS:
+        if rounds == 3:
+            # Notes are not shrinking; send what we have
+            break
+        chunks = split_content(notes, ANALYSIS_CHUNK_TOKENS)
+        rounds += 1
+        details.setdefault('chunks', len(chunks))
+        parts = map_chunk_notes(chunks, use_cache, deadline)
+        notes = "\n\n".join(
+            "Part {}:\n{}".format(i, part) for i, part in enumerate(parts, 1))
+    details['map_rounds'] = rounds
+    return run_analysis(template, instruction, REDUCE_PREAMBLE + notes,
+                        prompt, deadline, details)
+
+
+def reuse_near_duplicate(scope, fp, details):
+    """Cached answer for the nearest indexed fingerprint, if still cached."""
+    tried = set()
+    while True:
+        match = simhash_index.nearest(scope, fp, exclude=tried)
+        if match is None:
+            return None
+        cache_key, distance = match
+        text = response_cache.get(cache_key, 'analyze-approximate')
+        if text is not None:
+            details.update(approximate=True, distance=distance)
+            return text
+        # The answer expired; drop its fingerprint and try the next one
+        simhash_index.remove(cache_key)
+        tried.add(cache_key)
+
+
+def conversation_document_context(document, use_cache=True, deadline=None):
+    """Document text to keep in a conversation, within its token budget.
+
+    Long documents are replaced by their chunk notes (shared with
+    map-reduce analysis, so usually already cached), cut short if even
+    those do not fit.
+    """
+    if estimate_tokens(document) <= conversations.CHAT_DOCUMENT_TOKENS:
+        return document
+    chunks = split_content(document, ANALYSIS_CHUNK_TOKENS)
+    parts = map_chunk_notes(chunks, use_cache, deadline)
+    notes = REDUCE_PREAMBLE + "\n\n".join(
+        "Part {}:\n{}".format(i, part) for i, part in enumerate(parts, 1))
+    limit = conversations.CHAT_DOCUMENT_TOKENS * BYTES_PER_TOKEN
+    return notes.encode('utf-8')[:limit].decode('utf-8', 'ignore')
+
+
+def summarize_turns(previous_summary, transcript):
+    response, _ = gemini_client.generate_with_fallback(
+        CHAT_MODEL,
+        COMPACTION_TEMPLATE.format(previous_summary or '(none)', transcript),
+        system_instruction=conversations.COMPACTION_INSTRUCTION)
+    return response.text.strip()
+
+
+def compact_conversation(conversation_id):
+    try:
+        conversations.compact(conversation_id, summarize_turns)
+    except Exception as e:
+        # The turns stay uncompacted; the next turn tries again
+        print(f"Error compacting conversation: {e}")
+
+
+def schedule_compaction(conversation_id):
+    """Fold old turns into the summary off the request path."""
+    global _compaction_pool
+    if not conversations.needs_compaction(conversation_id):
+        return
+    if _compaction_pool is None:
+        _compaction_pool = ThreadPoolExecutor(max_workers=2)
+    _compaction_pool.submit(compact_conversation, conversation_id)
 
 
 @app.route('/')
@@ -214,15 +623,18 @@ def index():
     return jsonify({
         'status': 'running',
         'message': 'AI Assistant API is running successfully!',
-        'api_key_configured': bool(GEMINI_API_KEY),
+        'api_key_configured': gemini_client.is_configured(),
         'endpoints': [
             '/api/upload',
+            '/api/upload/stream',
             '/api/chat',
             '/api/download-pdf',
             '/api/usage',
             '/api/analyze',
             '/api/detect-language',
-            '/api/ui-strings'
+            '/api/ui-strings',
+            '/api/documents/<document_id>/text',
+            '/api/metrics'
         ]
     })
 
@@ -271,6 +683,26 @@ def get_ui_strings():
         return jsonify({'error': str(e)}), 500
 
 
+def resolve_extractor(ext):
+    """Map a file extension to (cache kind, extractor, extra args)."""
+    if ext in ['jpg', 'jpeg', 'png', 'bmp', 'gif', 'webp']:
+        return 'image', extract_text_from_image, ()
+    elif ext == 'pdf':
+        return 'pdf', extract_text_from_pdf, (
+            parse_page_range(request.form.get('pages')),)
+    elif ext == 'docx':
+        return 'docx', extract_text_from_docx, ()
+    elif ext == 'txt':
+        return 'txt', extract_text_from_txt, ()
+    return None, None, ()
+
+
+def text_chunks(text):
+    """Split already-extracted text into (index, chunk) stream pages."""
+    for index, offset in enumerate(range(0, len(text), STREAM_CHUNK_CHARS)):
+        yield index, text[offset:offset + STREAM_CHUNK_CHARS]
+
+
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
     """Handle file upload and text extraction."""
@@ -282,35 +714,226 @@ def upload_file():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
 
-        # Save file
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-
-        # Detect file type and extract text
-        ext = filename.lower().split('.')[-1]
-        extracted_text = ""
-
-        if ext in ['jpg', 'jpeg', 'png', 'bmp', 'gif', 'webp']:
-            extracted_text = extract_text_from_image(filepath)
-        elif ext == 'pdf':
-            extracted_text = extract_text_from_pdf(filepath)
-        elif ext == 'docx':
-            extracted_text = extract_text_from_docx(filepath)
-        elif ext == 'txt':
-            extracted_text = extract_text_from_txt(filepath)
-        else:
+        # Detect file type
+        ext = file.filename.lower().split('.')[-1]
+        kind, extractor, args = resolve_extractor(ext)
+        if kind is None:
             return jsonify({'error': 'Unsupported file type'}), 400
 
-        # Clean up file
-        os.remove(filepath)
+        # Read the upload once; it only touches disk above the spill size
+        with UploadBuffer(file, app.config['UPLOAD_FOLDER']) as upload:
+            filename = upload.filename
+
+            # Same bytes + same extractor version => reuse earlier result
+            extracted_text = extraction_cache.lookup(
+                kind, upload.digest, *args)
+            cached = extracted_text is not None
+
+            if not cached:
+                def extract():
+                    text = extractor.__wrapped__(upload.source, *args)
+                    extraction_cache.store(kind, upload.digest, text, *args)
+                    return text
+
+                # A class uploading the same file extracts it once
+                cache_key = extraction_cache.key_for(
+                    kind, upload.digest, *args)
+                extracted_text, role = singleflight.do(
+                    cache_key, extract, lookup=partial(
+                        extraction_cache.get, cache_key, record=False))
+                cached = role != singleflight.LEADER
+
+        # Keep the full text server-side; clients refer to it by id
+        document_id = store_document(
+            get_session_id(), filename, extracted_text,
+            DOCUMENT_TTL_SECONDS)
+        if document_id is None:
+            return jsonify({'error': 'Could not store the document'}), 500
 
         return jsonify({
             'success': True,
             'filename': filename,
             'fileType': ext,
+            'cached': cached,
             'extractedText': extracted_text[:500],  # Preview
-            'fullText': extracted_text
+            'documentId': document_id,
+            'textLength': len(extracted_text),
+            'expiresIn': DOCUMENT_TTL_SECONDS
+        })
+
+    except OcrPoolBusy:
+        return jsonify({
+            'error': 'OCR is busy, please try again in a moment'
+        }), 503
+    except GeminiBusy as e:
+        return busy_response(
+            'AI service is busy, please try again in a moment',
+            e.retry_after)
+    except GeminiTimeout:
+        return timeout_response()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/upload/stream', methods=['POST'])
+def upload_file_stream():
+    """Upload a file and stream extracted text page by page as SSE.
+
+    Events: ``start`` (file info and page total when known), one ``page``
+    per page or chunk as soon as it is ready (PDF pages arrive in
+    completion order), then ``done`` with the document id and stats, or
+    ``error``.
+    """
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file uploaded'}), 400
+
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+
+        ext = file.filename.lower().split('.')[-1]
+        kind, extractor, args = resolve_extractor(ext)
+        if kind is None:
+            return jsonify({'error': 'Unsupported file type'}), 400
+
+        session_id = get_session_id()
+        upload = UploadBuffer(file, app.config['UPLOAD_FOLDER'])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    def pdf_pages(ocr_pages):
+        for page_no, page_text, _, ocred in iter_pdf_pages(
+                upload.source, args[0], STREAM_PDF_BATCH_PAGES):
+            if ocred:
+                ocr_pages.append(page_no + 1)
+            yield page_no, page_text
+
+    def generate():
+        began = time.perf_counter()
+        first_text_at = None
+        try:
+            with upload:
+                text = extraction_cache.lookup(kind, upload.digest, *args)
+                cached = text is not None
+                total = None
+                ocr_pages = []
+                cacheable = True
+
+                if cached:
+                    pages, joiner = text_chunks(text), ''
+                elif kind == 'pdf':
+                    total = count_pdf_pages(upload.source, args[0])
+                    pages, joiner = pdf_pages(ocr_pages), ''
+                elif kind == 'docx':
+                    pages = iter_docx_pages(
+                        upload.source, STREAM_CHUNK_CHARS)
+                    joiner = '\n'
+                else:
+                    extracted = extractor.__wrapped__(upload.source, *args)
+                    cacheable = extraction_cache.is_cacheable(extracted)
+                    pages = text_chunks(extracted)
+                    joiner = ''
+
+                yield sse_event('start', {
+                    'filename': upload.filename,
+                    'fileType': ext,
+                    'cached': cached,
+                    'total': total
+                })
+
+                collected = {}
+                for page_no, page_text in pages:
+                    if first_text_at is None:
+                        first_text_at = time.perf_counter() - began
+                    collected[page_no] = page_text
+                    yield sse_event('page', {
+                        'page': page_no + 1,
+                        'text': page_text,
+                        'done': len(collected),
+                        'total': total
+                    })
+
+                if not cached:
+                    text = joiner.join(
+                        collected[page_no] for page_no in sorted(collected)
+                    ).strip()
+                    if cacheable:
+                        extraction_cache.store(
+                            kind, upload.digest, text, *args)
+
+            document_id = store_document(
+                session_id, upload.filename, text, DOCUMENT_TTL_SECONDS)
+            if document_id is None:
+                yield sse_event('error', {
+                    'error': 'Could not store the document'
+                })
+                return
+
+            yield sse_event('done', {
+                'success': True,
+                'documentId': document_id,
+                'textLength': len(text),
+                'pages': len(collected),
+                'ocrPages': ocr_pages,
+                'cached': cached,
+                'expiresIn': DOCUMENT_TTL_SECONDS,
+                'timeToFirstText': (
+                    round(first_text_at, 3)
+                    if first_text_at is not None else None
+                ),
+                'elapsed': round(time.perf_counter() - began, 3)
+            })
+
+        except OcrPoolBusy:
+            yield sse_event('error', {
+                'error': 'OCR is busy, please try again in a moment'
+            })
+        except GeminiBusy as e:
+            yield sse_event('error', {
+                'error': 'AI service is busy, please try again in a moment',
+                'retryAfter': e.retry_after
+            })
+        except Exception as e:
+            yield sse_event('error', {'error': str(e)})
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache, no-transform',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+    # The generator may never start if the client disconnects first
+    response.call_on_close(upload.close)
+    return response
+
+
+@app.route('/api/documents/<document_id>/text', methods=['GET'])
+def document_text(document_id):
+    """Page through the text of an uploaded document."""
+    try:
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = request.args.get('limit', 20000, type=int)
+        limit = min(max(1, limit), DOCUMENT_RANGE_MAX_CHARS)
+
+        document = get_document_range(
+            document_id, get_session_id(), offset, limit)
+        if document is None:
+            return jsonify({'error': 'Document not found or expired'}), 404
+
+        next_offset = offset + len(document['text'])
+        return jsonify({
+            'success': True,
+            'documentId': document_id,
+            'filename': document['filename'],
+            'text': document['text'],
+            'offset': offset,
+            'total': document['total'],
+            'nextOffset': (
+                next_offset if next_offset < document['total'] else None
+            )
         })
 
     except Exception as e:
@@ -319,35 +942,285 @@ def upload_file():
 
 @app.route('/api/analyze', methods=['POST'])
 def analyze_content():
-    """Analyze content with AI."""
+    """Analyze content (or a stored document) with AI."""
     try:
         data = request.json
         content = data.get('content', '')
         prompt = data.get('prompt', None)
+        document_id = data.get('document_id')
+
+        if document_id and not content:
+            content = get_document(document_id, get_session_id())
+            if content is None:
+                return jsonify({
+                    'error': 'Document not found or expired'
+                }), 404
 
         if not content:
             return jsonify({'error': 'No content provided'}), 400
 
-        result = analyze_with_ai(content, prompt)
+        details = analyze_with_ai_details(
+            content, prompt,
+            use_cache=data.get('cache', True) is not False,
+            approximate=data.get('approximate', True) is not False)
+
+        return jsonify(dict(details, success=True))
+
+    except GeminiBusy as e:
+        return busy_response(
+            'AI service is busy, please try again in a moment',
+            e.retry_after)
+    except GeminiTimeout:
+        return timeout_response()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def analyze_batch_item(index, item, use_cache, session_id):
+    """Analyze one batch item; failures become an error record."""
+    began = time.perf_counter()
+    record = {'index': index}
+    try:
+        if not isinstance(item, dict):
+            raise ValueError('Item must be an object')
+        content = item.get('content') or ''
+        if item.get('document_id') and not content:
+            content = get_document(item['document_id'], session_id)
+            if content is None:
+                raise LookupError('Document not found or expired')
+        if not content:
+            raise ValueError('No content provided')
+
+        # Each item gets the usual budget, not a share of the whole batch
+        deadline = time.monotonic() + REQUEST_BUDGET_SECONDS
+        for attempt in range(ANALYZE_BATCH_BUSY_RETRIES + 1):
+            try:
+                details = analyze_with_ai_details(
+                    content, item.get('prompt'), use_cache=use_cache,
+                    deadline=deadline)
+                break
+            except GeminiBusy as e:
+                # Wait our turn instead of failing the item outright
+                wait = min(e.retry_after or 1.0,
+                           deadline - time.monotonic())
+                if attempt == ANALYZE_BATCH_BUSY_RETRIES or wait <= 0:
+                    raise
+                time.sleep(wait)
+
+        if details['result'].startswith('Error'):
+            record.update(success=False, status=500,
+                          error=details['result'])
+        else:
+            record.update(details, success=True)
+    except GeminiBusy:
+        record.update(success=False, status=503,
+                      error='AI service is busy')
+    except GeminiTimeout:
+        record.update(success=False, status=504,
+                      error='AI service took too long')
+    except LookupError as e:
+        record.update(success=False, status=404, error=str(e))
+    except Exception as e:
+        record.update(success=False, status=400 if isinstance(
+            e, ValueError) else 500, error=str(e))
+    record['elapsed'] = round(time.perf_counter() - began, 3)
+    return record
+
+
+@app.route('/api/analyze/batch', methods=['POST'])
+def analyze_batch():
+    """Analyze many items concurrently, streaming NDJSON results.
+
+    Body: ``{"items": [{"content": ..., "prompt": ...}, ...],
+    "concurrency": 4}``. Items may use ``document_id`` instead of
+    ``content``. One JSON line is written per item as it finishes
+    (completion order, tagged with ``index``), then a summary line with
+    ``"done": true``. A failed item never affects the others.
+
+    Large or scheduled runs should send ``"background": true``: the batch
+    then runs off the request and the 202 answer carries a ``job_id`` to
+    poll at ``/api/analyze/batch/<job_id>``.
+    """
+    try:
+        data = request.json or {}
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Request body must be an object'}), 400
+        items = data.get('items')
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'No items provided'}), 400
+        if len(items) > ANALYZE_BATCH_MAX_ITEMS:
+            return jsonify({
+                'error': 'At most {} items per batch'.format(
+                    ANALYZE_BATCH_MAX_ITEMS)
+            }), 400
 
+        concurrency = max(1, min(
+            int(data.get('concurrency') or ANALYZE_BATCH_CONCURRENCY),
+            ANALYZE_BATCH_MAX_CONCURRENCY, len(items)))
+        use_cache = data.get('cache', True) is not False
+        session_id = get_session_id()
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    if data.get('background'):
+        job_id = batch_jobs.create(session_id, len(items), concurrency)
+        schedule_batch_job(job_id, items, concurrency, use_cache, session_id)
         return jsonify({
             'success': True,
-            'result': result
-        })
+            'job_id': job_id,
+            'total': len(items),
+            'status_url': '/api/analyze/batch/{}'.format(job_id)
+        }), 202
+
+    def generate():
+        began = time.perf_counter()
+        succeeded = 0
+        pool = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            futures = [
+                pool.submit(analyze_batch_item, i, item, use_cache,
+                            session_id)
+                for i, item in enumerate(items)
+            ]
+            for future in as_completed(futures):
+                record = future.result()
+                succeeded += record['success']
+                yield json.dumps(record) + '\n'
+            yield json.dumps({
+                'done': True,
+                'total': len(items),
+                'succeeded': succeeded,
+                'failed': len(items) - succeeded,
+                'elapsed': round(time.perf_counter() - began, 3)
+            }) + '\n'
+            track_interaction(session_id, 'text-to-text', 'analyze-batch', {
+                'items': len(items),
+                'succeeded': succeeded,
+                'concurrency': concurrency
+            })
+        finally:
+            # Client went away: drop items that have not started
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={
+            'Cache-Control': 'no-cache, no-transform',
+            'X-Accel-Buffering': 'no'
+        }
+    )
 
+
+def run_batch_job(job_id, items, concurrency, use_cache, session_id):
+    """Analyze a background batch, storing each record as it finishes."""
+    began = time.perf_counter()
+    succeeded = 0
+    try:
+        batch_jobs.start(job_id)
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [
+                pool.submit(analyze_batch_item, i, item, use_cache,
+                            session_id)
+                for i, item in enumerate(items)
+            ]
+            for future in as_completed(futures):
+                record = future.result()
+                succeeded += record['success']
+                batch_jobs.add_result(job_id, record)
+        batch_jobs.finish(job_id, round(time.perf_counter() - began, 3))
+        track_interaction(session_id, 'text-to-text', 'analyze-batch', {
+            'items': len(items),
+            'succeeded': succeeded,
+            'concurrency': concurrency,
+            'background': True
+        })
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        print(f"Error running batch job {job_id}: {e}")
+
+
+def schedule_batch_job(job_id, items, concurrency, use_cache, session_id):
+    """Run a background batch on this worker's job threads."""
+    global _batch_job_pool
+    if _batch_job_pool is None:
+        _batch_job_pool = ThreadPoolExecutor(max_workers=BATCH_JOB_WORKERS)
+    _batch_job_pool.submit(
+        run_batch_job, job_id, items, concurrency, use_cache, session_id)
+
+
+@app.route('/api/analyze/batch/<job_id>', methods=['GET'])
+def analyze_batch_status(job_id):
+    """Progress of a background batch plus a page of its results.
+
+    ``offset``/``limit`` page through the results in completion order;
+    pass back ``next_offset`` to fetch only what finished since.
+    """
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = max(1, min(int(request.args.get('limit', 100)), 1000))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    job = batch_jobs.get(job_id, get_session_id(), offset, limit)
+    if job is None:
+        return jsonify({'error': 'Batch job not found or expired'}), 404
+    return jsonify(dict(job, success=True))
 
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
-    """Handle general chat messages with language detection."""
+    """Handle general chat messages with language detection.
+
+    Send ``"stream": true`` (or ``Accept: text/event-stream``) to receive
+    the answer as SSE ``chunk`` events followed by ``done``.
+
+    Send ``"conversation": true`` to start a server-side conversation and
+    ``"conversation_id"`` on follow-ups; earlier turns (and the document)
+    are then kept here instead of being resent. A single question needs
+    no conversation (and can be answered from the response cache), so
+    clients start one with the second turn, passing the first exchange
+    as ``"history": [{"role": "user", "content": ...}, {"role":
+    "model", "content": ...}]``.
+    """
     try:
         data = request.json
         message = data.get('message', '')
+        document_id = data.get('document_id')
+        conversation_id = data.get('conversation_id')
+        stream = bool(data.get('stream')) or (
+            request.accept_mimetypes.best == 'text/event-stream')
 
         if not message:
             return jsonify({'error': 'No message provided'}), 400
+        history = data.get('history') or []
+        if not isinstance(history, list):
+            return jsonify({'error': 'history must be a list'}), 400
+
+        session_id = get_session_id()
+        conversation = None
+        if conversation_id:
+            conversation = conversations.get(conversation_id, session_id)
+            if conversation is None:
+                return jsonify({
+                    'error': 'Conversation not found or expired'
+                }), 404
+
+        document = None
+        if document_id and (conversation is None
+                            or document_id != conversation['document_id']):
+            document = get_document(document_id, session_id)
+            if document is None:
+                return jsonify({
+                    'error': 'Document not found or expired'
+                }), 404
+
+        if conversation is None and data.get('conversation'):
+            conversation_id = conversations.create(session_id)
+            conversations.seed(conversation_id, history)
+            conversation = conversations.get(conversation_id, session_id)
+
+        if document is not None and conversation is None:
+            message = "{}\n\nDocument content:\n{}".format(
+                message, document)
 
         # Detect language / ಭಾಷೆ ಪತ್ತೆ
         detected_lang = LanguageDetector.detect_language(message)
@@ -360,35 +1233,181 @@ def chat():
             # English input - ಇಂಗ್ಲಿಷ್ ಇನ್‌ಪುಟ್
             processed_message = process_english_text(message)
 
-        # Re-check API key from environment
-        api_key = os.getenv('GEMINI_API_KEY') or GEMINI_API_KEY
-        if not api_key:
+        # Configured once per worker (picks up a key set after start-up)
+        if not gemini_client.configure():
             return jsonify({'error': 'API key not configured'}), 500
 
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.0-flash-exp')
+        # Requests can opt out with "cache": false
+        use_cache = data.get('cache', True) is not False
+        deadline = request_deadline()
+
+        if conversation is not None:
+            if document is not None:
+                context = conversation_document_context(
+                    document, use_cache, deadline)
+                conversations.set_document(conversation_id, document_id,
+                                           context)
+                conversation['document_context'] = context
+            # Answers depend on the history, so they are never cached
+            contents, context_tokens = conversations.build_contents(
+                conversation, processed_message)
+            if stream:
+                return chat_stream(message, contents, detected_lang,
+                                   conversation_id=conversation_id)
+            response, model = gemini_client.generate_with_fallback(
+                CHAT_MODEL, contents, deadline=deadline)
+            answer = response.text.strip()
+            conversations.add_turn(conversation_id, message, answer)
+            schedule_compaction(conversation_id)
+
+            track_interaction(session_id, 'text-to-text', 'chat', {
+                'message_length': len(message),
+                'response_length': len(answer),
+                'language': detected_lang,
+                'cached': False,
+                'conversation_turn': conversation['turn_count'] + 1
+            })
 
-        # Use the processed message with language context
-        response = model.generate_content(processed_message)
+            return jsonify({
+                'success': True,
+                'response': answer,
+                'language': detected_lang,
+                'cached': False,
+                'coalesced': False,
+                'model': model,
+                'conversation_id': conversation_id,
+                'context_tokens': context_tokens
+            })
+
+        cache_key = response_cache.make_key(
+            CHAT_MODEL, 'chat', processed_message, detected_lang)
+        cached = response_cache.get(cache_key, 'chat') if use_cache else None
+
+        if stream:
+            return chat_stream(message, processed_message, detected_lang,
+                               cache_key if use_cache else None, cached)
+
+        role = None
+        answered_by = {}
+        if cached is not None:
+            answer = cached
+        else:
+            def call():
+                # Use the processed message with language context
+                response, model = gemini_client.generate_with_fallback(
+                    CHAT_MODEL, processed_message, deadline=deadline)
+                answered_by['model'] = model
+                answer = response.text.strip()
+                if use_cache and model == CHAT_MODEL:
+                    response_cache.put(cache_key, answer, 'chat')
+                return answer
+
+            answer, role = singleflight.do(cache_key, call, lookup=partial(
+                response_cache.get, cache_key, 'chat', record=False
+            ) if use_cache else None, deadline=deadline)
 
         # Track interaction
-        session_id = get_session_id()
         track_interaction(session_id, 'text-to-text', 'chat', {
             'message_length': len(message),
-            'response_length': len(response.text.strip()),
-            'language': detected_lang
+            'response_length': len(answer),
+            'language': detected_lang,
+            'cached': cached is not None
         })
 
         return jsonify({
             'success': True,
-            'response': response.text.strip(),
-            'language': detected_lang  # Return detected language
+            'response': answer,
+            'language': detected_lang,  # Return detected language
+            'cached': cached is not None,
+            'coalesced': role not in (None, singleflight.LEADER),
+            'model': answered_by.get('model')
         })
 
+    except GeminiBusy as e:
+        return busy_response(
+            'AI service is busy, please try again in a moment',
+            e.retry_after)
+    except GeminiTimeout:
+        return timeout_response()
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def chat_stream(message, contents, detected_lang, cache_key=None,
+                cached=None, conversation_id=None):
+    """Stream a chat answer as SSE, tracking the interaction at the end.
+
+    A `cached` answer is sent as a single chunk; otherwise the streamed
+    answer is stored under `cache_key` once it completes. In a
+    conversation the completed exchange is recorded as its next turn.
+    """
+    session_id = get_session_id()
+    if cached is not None:
+        response = [cached]
+    else:
+        # Streams hold the connection open longer than a JSON answer
+        response = gemini_client.generate_content(
+            CHAT_MODEL, contents, stream=True,
+            deadline=time.monotonic() + REQUEST_BUDGETS['chat_stream'])
+
+    def generate():
+        parts = []
+        failed = False
+        try:
+            yield sse_event('start', {
+                'language': detected_lang,
+                'cached': cached is not None,
+                'conversation_id': conversation_id
+            })
+            for chunk in response:
+                if isinstance(chunk, str):
+                    parts.append(chunk)
+                    yield sse_event('chunk', {'text': chunk})
+                    continue
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Chunk without text parts (e.g. safety metadata)
+                    continue
+                if text:
+                    parts.append(text)
+                    yield sse_event('chunk', {'text': text})
+            # Only complete answers are cached or kept as history
+            if cache_key and cached is None:
+                response_cache.put(cache_key, ''.join(parts).strip(), 'chat')
+            if conversation_id:
+                conversations.add_turn(
+                    conversation_id, message, ''.join(parts).strip())
+                schedule_compaction(conversation_id)
+            yield sse_event('done', {
+                'success': True,
+                'language': detected_lang,
+                'conversation_id': conversation_id
+            })
+        except Exception as e:
+            failed = True
+            yield sse_event('error', {'error': str(e)})
+        finally:
+            # Runs when the stream closes, including client disconnects
+            if not failed:
+                track_interaction(session_id, 'text-to-text', 'chat', {
+                    'message_length': len(message),
+                    'response_length': len(''.join(parts).strip()),
+                    'language': detected_lang,
+                    'streamed': True,
+                    'cached': cached is not None
+                })
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache, no-transform',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
 @app.route('/api/download-pdf', methods=['POST'])
 def download_pdf():
     """Generate and download PDF of AI response."""
@@ -512,6 +1531,26 @@ def get_usage():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Get cache and performance counters for this worker."""
+    try:
+        return jsonify({
+            'success': True,
+            'extraction_cache': extraction_cache.get_stats(),
+            'response_cache': response_cache.get_stats(),
+            'simhash_index': simhash_index.get_stats(),
+            'single_flight': singleflight.get_stats(),
+            'ocr_pool': ocr_pool.get_stats(),
+            'gemini_setup': gemini_client.get_stats(),
+            'gemini_limiter': gemini_client.limiter.get_stats(),
+            'gemini_files': gemini_files.get_stats(),
+            'upscale': upscale.get_stats()
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/generate-image', methods=['POST'])
 def generate_image():
     """Generate image from text using Pollinations AI."""
@@ -580,57 +1619,27 @@ def generate_image():
         return jsonify({'error': str(e)}), 500
 
 
-def upscale_image_local(filepath, scale_factor):
+def upscale_image_local(source, scale_factor):
     """
     FREE local image enhancement using OpenCV and PIL.
     No API calls, no rate limits, completely free!
+    `source` is a file path or the encoded image bytes. Returns the output
+    size and an iterator over its RGB row bands.
     """
     import cv2
     import numpy as np
-    from PIL import Image, ImageEnhance, ImageFilter
-
-    # Read image with OpenCV
-    img = cv2.imread(filepath)
 
-    # Get original dimensions
+    # Read image with OpenCV (decode in memory when we have the bytes)
+    if isinstance(source, bytes):
+        img = cv2.imdecode(
+            np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+    else:
+        img = cv2.imread(source)
     height, width = img.shape[:2]
-    new_width = int(width * scale_factor)
-    new_height = int(height * scale_factor)
-
-    # Use INTER_CUBIC for upscaling (high quality)
-    upscaled = cv2.resize(img, (new_width, new_height),
-                          interpolation=cv2.INTER_CUBIC)
-
-    # Apply enhancement filters
-    # 1. Denoise
-    denoised = cv2.fastNlMeansDenoisingColored(
-        upscaled, None, 10, 10, 7, 21)
-
-    # 2. Sharpen
-    kernel = np.array([[-1, -1, -1],
-                       [-1, 9, -1],
-                       [-1, -1, -1]])
-    sharpened = cv2.filter2D(denoised, -1, kernel)
-
-    # Convert to PIL for additional enhancements
-    img_pil = Image.fromarray(cv2.cvtColor(sharpened, cv2.COLOR_BGR2RGB))
-
-    # 3. Enhance contrast
-    enhancer = ImageEnhance.Contrast(img_pil)
-    img_pil = enhancer.enhance(1.2)
-
-    # 4. Enhance color
-    enhancer = ImageEnhance.Color(img_pil)
-    img_pil = enhancer.enhance(1.1)
 
-    # 5. Enhance sharpness
-    enhancer = ImageEnhance.Sharpness(img_pil)
-    img_pil = enhancer.enhance(1.3)
-
-    # 6. Apply unsharp mask for extra detail
-    img_pil = img_pil.filter(ImageFilter.UnsharpMask(radius=2, percent=150))
-
-    return img_pil
+    # Denoise, upscale and enhance tile by tile across the worker pool
+    return (width * scale_factor, height * scale_factor,
+            upscale.iter_rows(img, scale_factor))
 
 
 @app.route('/api/upscale', methods=['POST'])
@@ -642,6 +1651,8 @@ def upscale_image():
 
         image_file = request.files['image']
         scale = request.form.get('scale', '2')  # 2x or 4x
+        if scale not in ('2', '4'):
+            return jsonify({'error': 'scale must be 2 or 4'}), 400
         face_enhance = request.form.get('face_enhance', 'false') == 'true'
         method = request.form.get('method', 'local')
 
@@ -651,63 +1662,87 @@ def upscale_image():
         print(f"Face Enhance: {face_enhance}")
         print(f"Method: {method}")
 
-        # Save uploaded image temporarily
-        filename = secure_filename(image_file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        unique_filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        image_file.save(filepath)
+        # Keep the uploaded image in memory (spills only when very large)
+        upload = UploadBuffer(image_file, app.config['UPLOAD_FOLDER'])
 
         # Choose enhancement method
         if method == 'local':
             print("Using FREE local enhancement (OpenCV + PIL)...")
 
-            # Use local enhancement
-            enhanced_img = upscale_image_local(filepath, int(scale))
-
-            # Save enhanced image
-            output_filename = f"enhanced_{unique_filename}"
-            output_path = os.path.join(
-                app.config['UPLOAD_FOLDER'], output_filename)
-            enhanced_img.save(output_path, 'PNG', quality=95, optimize=True)
-
-            # Convert to base64 for response
-            import base64
-            import io
-            buffered = io.BytesIO()
-            enhanced_img.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            image_url = f"data:image/png;base64,{img_str}"
-
-            # Clean up uploaded file
-            try:
-                os.remove(filepath)
-            except Exception:
-                pass
-
-            print("Local upscaling successful!")
-
-            return jsonify({
-                'success': True,
-                'image_url': image_url,
-                'scale': scale,
+            # Check the budgets from the header before decoding anything
+            with upload:
+                try:
+                    with Image.open(as_file(upload.source)) as header:
+                        width, height = header.size
+                except Image.DecompressionBombError as e:
+                    return jsonify({'error': str(e)}), 413
+                except Exception:
+                    return jsonify({'error': 'Unsupported image'}), 400
+                try:
+                    allowed = upscale.admit(width, height, int(scale))
+                    reservation = upscale.reserve(width, height, allowed)
+                except upscale.UpscaleTooLarge as e:
+                    return jsonify({'error': str(e)}), 413
+                except upscale.UpscaleBusy as e:
+                    return busy_response(str(e), e.retry_after)
+
+                try:
+                    out_width, out_height, rows = upscale_image_local(
+                        upload.source, allowed)
+                    # Fail with a proper status if even the first tiles do
+                    first = next(rows)
+                except Exception:
+                    reservation.release()
+                    raise
+
+            meta = {
+                'scale': str(allowed),
                 'method': 'local',
-                'message': 'Enhanced using FREE local processing (OpenCV)'
-            })
+                'message': 'Enhanced using FREE local processing (OpenCV)',
+                'clamped': allowed != int(scale)
+            }
+            if allowed != int(scale):
+                print(f"Scale clamped to {allowed}x to fit the budget")
+
+            def generate():
+                # PNG-encode and base64 the rows as the tiles come back.
+                # "success" goes last: the status is already sent, so a
+                # failure mid-stream must still end in parseable JSON.
+                try:
+                    yield json.dumps(meta)[:-1] + (
+                        ', "image_url": "data:image/png;base64,')
+                    try:
+                        yield from base64_chunks(encode_png(
+                            chain([first], rows), out_width, out_height))
+                    except Exception as e:
+                        print(f"Error upscaling image: {e}")
+                        yield '", "success": false, "error": {}}}'.format(
+                            json.dumps('Upscaling failed: {}'.format(e)))
+                        return
+                    yield '", "success": true}'
+                    print("Local upscaling successful!")
+                finally:
+                    rows.close()
+                    reservation.release()
+
+            response = Response(
+                stream_with_context(generate()), mimetype='application/json')
+            # Also release if the client goes away before the body starts
+            response.call_on_close(reservation.release)
+            return response
 
         else:  # method == 'replicate'
-            # Read image and convert to base64
-            import base64
-            with open(filepath, 'rb') as f:
-                image_data = base64.b64encode(f.read()).decode('utf-8')
+            # Convert image to base64
+            with upload:
+                image_data = upload.b64encode()
 
             # Use Replicate API
             import replicate
 
             print("Calling Replicate API for upscaling...")
 
-            # Set API token
-            os.environ["REPLICATE_API_TOKEN"] = REPLICATE_API_KEY
+            client = replicate.Client(
+                api_token=REPLICATE_API_KEY, base_url=REPLICATE_BASE_URL)
 
             # Use Real-ESRGAN model
             model_version = (
@@ -716,7 +1751,7 @@ def upscale_image():
                 "1d7b"
             )
 
-            output = replicate.run(
+            output = client.run(
                 model_version,
                 input={
                     "image": f"data:image/jpeg;base64,{image_data}",
@@ -725,12 +1760,6 @@ def upscale_image():
                 }
             )
 
-            # Clean up uploaded file
-            try:
-                os.remove(filepath)
-            except Exception:
-                pass
-
             print(f"Upscaling successful! Output: {output}")
 
             return jsonify({
@@ -804,25 +1833,16 @@ def outpaint_image():
                 'error': 'Prompt required to describe expansion'
             }), 400
 
-        # Save uploaded image temporarily
-        filename = secure_filename(image_file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        unique_filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        image_file.save(filepath)
-
-        # Read image as base64
-        import base64
-        with open(filepath, 'rb') as f:
-            image_data = base64.b64encode(f.read()).decode('utf-8')
+        # Read the image once into memory (never spilled: it is needed
+        # both for the base64 payload and for the Gemini fallback)
+        upload = UploadBuffer(
+            image_file, app.config['UPLOAD_FOLDER'],
+            threshold=app.config['MAX_CONTENT_LENGTH'])
+        image_data = upload.b64encode()
 
         # Prepare LightX AI Expander API request
         import requests
 
-        lightx_url = (
-            "https://api.lightxeditor.com/external/api/v1/outpainting"
-        )
-
         headers = {
             'x-api-key': LIGHTX_API_KEY,
             'Content-Type': 'application/json'
@@ -850,7 +1870,7 @@ def outpaint_image():
 
         try:
             response = requests.post(
-                lightx_url, json=payload, headers=headers, timeout=30
+                LIGHTX_API_URL, json=payload, headers=headers, timeout=30
             )
 
             print(f"LightX Status: {response.status_code}")
@@ -863,12 +1883,6 @@ def outpaint_image():
                 if image_url:
                     print(f"Success! Image URL: {image_url}")
 
-                    # Clean up uploaded file
-                    try:
-                        os.remove(filepath)
-                    except Exception:
-                        pass
-
                     return jsonify({
                         'success': True,
                         'image_url': image_url,
@@ -883,18 +1897,17 @@ def outpaint_image():
         print("Using Pollinations AI fallback...")
         enhanced_prompt = prompt
 
-        if GEMINI_API_KEY:
+        if gemini_client.is_configured():
             try:
-                genai.configure(api_key=GEMINI_API_KEY)
-                model = genai.GenerativeModel('gemini-2.5-flash')
-                img = Image.open(filepath)
+                img = Image.open(upload.open())
                 analysis_prompt = (
                     f"Create detailed description for "
                     f"expanding: {prompt}. "
                     f"Add what should complete the scene."
                 )
-                ai_response = model.generate_content(
-                    [analysis_prompt, img]
+                ai_response = gemini_client.generate_content(
+                    ANALYSIS_MODEL, [analysis_prompt, img],
+                    deadline=request_deadline()
                 )
                 enhanced_prompt = ai_response.text.strip()
                 print(f"Enhanced: {enhanced_prompt[:100]}...")
@@ -911,12 +1924,6 @@ def outpaint_image():
 
         print("Fallback image generated")
 
-        # Clean up uploaded file
-        try:
-            os.remove(filepath)
-        except Exception:
-            pass
-
         return jsonify({
             'success': True,
             'image_url': image_url,
@@ -946,28 +1953,20 @@ def transcribe_audio():
 
         print(f"Audio file: {audio_file.filename}")
 
-        # Save audio temporarily
-        filename = secure_filename(audio_file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        unique_filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(
-            app.config['UPLOAD_FOLDER'], unique_filename
-        )
-        audio_file.save(filepath)
+        # Keep audio in memory; it is streamed straight to Gemini
+        upload = UploadBuffer(
+            audio_file, app.config['UPLOAD_FOLDER'],
+            threshold=app.config['MAX_CONTENT_LENGTH'])
+        mime_type = (mimetypes.guess_type(upload.filename)[0] or
+                     upload.mimetype)
 
         try:
             # Use Gemini AI to transcribe
-            if not GEMINI_API_KEY:
+            if not gemini_client.is_configured():
                 return jsonify({
                     'error': 'Gemini API not configured'
                 }), 500
 
-            genai.configure(api_key=GEMINI_API_KEY)
-            model = genai.GenerativeModel('gemini-2.5-flash')
-
-            # Upload audio file to Gemini
-            uploaded_audio = genai.upload_file(filepath)
-
             prompt = (
                 "Transcribe this audio accurately. "
                 "Provide the exact words spoken with proper punctuation "
@@ -975,29 +1974,44 @@ def transcribe_audio():
                 "your transcription."
             )
 
-            response = model.generate_content([prompt, uploaded_audio])
+            # Short clips go inline; longer ones reuse an earlier upload
+            began = time.perf_counter()
+            audio_part, mode = gemini_files.media_part(upload, mime_type)
+            try:
+                response, model = gemini_client.generate_with_fallback(
+                    ANALYSIS_MODEL, [prompt, audio_part],
+                    deadline=request_deadline())
+            except gemini_files.STALE_FILE_ERRORS:
+                if mode != gemini_files.REUSE:
+                    raise
+                # The remote copy expired early; upload it again
+                gemini_files.forget(upload.digest)
+                audio_part, mode = gemini_files.media_part(
+                    upload, mime_type)
+                response, model = gemini_client.generate_with_fallback(
+                    ANALYSIS_MODEL, [prompt, audio_part],
+                    deadline=request_deadline())
             transcription = response.text.strip()
+            gemini_files.record_latency(
+                mode, upload.size, time.perf_counter() - began)
 
             print(f"Transcription complete: {transcription[:100]}...")
 
-            # Clean up
-            try:
-                os.remove(filepath)
-            except Exception:
-                pass
-
             return jsonify({
                 'success': True,
-                'transcription': transcription
+                'transcription': transcription,
+                'model': model,
+                'upload_mode': mode
             })
 
+        except GeminiBusy as e:
+            return busy_response(
+                'AI service is busy, please try again in a moment',
+                e.retry_after)
+        except GeminiTimeout:
+            return timeout_response()
         except Exception as e:
             print(f"Gemini transcription error: {str(e)}")
-            # Clean up
-            try:
-                os.remove(filepath)
-            except Exception:
-                pass
             return jsonify({
                 'error': f'Transcription failed: {str(e)}'
             }), 500
@@ -1174,7 +2188,9 @@ if __name__ == '__main__':
     print("🚀 AI Assistant Web App Starting...")
     print("=" * 60)
     print("\n📍 URL: http://localhost:5000")
-    api_status = '✓ Configured' if GEMINI_API_KEY else '✗ Missing'
+    api_status = (
+        '✓ Configured' if gemini_client.is_configured() else '✗ Missing'
+    )
     print("🔑 API Key: {}".format(api_status))
     print("\n" + "=" * 60 + "\n")
     app.run(debug=True, host="0.0.0.0", port=5000, use_reloader=False)
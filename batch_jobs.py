@@ -0,0 +1,127 @@
+"""
+Batch analysis jobs
+Background /api/analyze/batch runs whose progress and results live in SQLite
+
+A nightly batch of hundreds of documents can take far longer than any
+HTTP request should stay open, so with ``"background": true`` the batch
+runs on a worker thread and every finished item is stored here. Clients
+poll the status endpoint (from any worker) and page through the results.
+Jobs wait as queued until a job thread picks them up; a running job
+whose worker died stops updating and is reported as interrupted.
+"""
+
+import json
+import os
+import time
+import uuid
+
+from database import get_db_connection
+
+BATCH_JOB_TTL_SECONDS = int(
+    os.getenv('BATCH_JOB_TTL_SECONDS', str(7 * 24 * 3600)))
+# A running job that has not finished an item for this long is dead
+BATCH_JOB_STALE_SECONDS = int(os.getenv('BATCH_JOB_STALE_SECONDS', '600'))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+INTERRUPTED = 'interrupted'
+
+
+def create(session_id, total, concurrency):
+    """Register a new job and return its id."""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # Sweep expired jobs while we are here
+    cursor.execute('''
+        DELETE FROM batch_results WHERE job_id IN (
+            SELECT job_id FROM batch_jobs WHERE expires_at < ?)
+    ''', (now,))
+    cursor.execute('DELETE FROM batch_jobs WHERE expires_at < ?', (now,))
+
+    cursor.execute('''
+        INSERT INTO batch_jobs
+        (job_id, session_id, status, total, concurrency, created_at,
+         updated_at, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (job_id, session_id, QUEUED, total, concurrency, now, now,
+          now + BATCH_JOB_TTL_SECONDS))
+    conn.commit()
+    conn.close()
+    return job_id
+
+
+def add_result(job_id, record):
+    """Store one finished item's record and bump the job's counters."""
+    now = time.time()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO batch_results (job_id, item_index, record)
+        VALUES (?, ?, ?)
+    ''', (job_id, record['index'], json.dumps(record)))
+    cursor.execute('''
+        UPDATE batch_jobs
+        SET completed = completed + 1, succeeded = succeeded + ?,
+            updated_at = ?
+        WHERE job_id = ?
+    ''', (1 if record['success'] else 0, now, job_id))
+    conn.commit()
+    conn.close()
+
+
+def start(job_id):
+    """Mark a queued job as running; staleness counts from now."""
+    conn = get_db_connection()
+    conn.execute('''
+        UPDATE batch_jobs SET status = ?, updated_at = ? WHERE job_id = ?
+    ''', (RUNNING, time.time(), job_id))
+    conn.commit()
+    conn.close()
+
+
+def finish(job_id, elapsed):
+    conn = get_db_connection()
+    conn.execute('''
+        UPDATE batch_jobs SET status = ?, elapsed = ?, updated_at = ?
+        WHERE job_id = ?
+    ''', (DONE, elapsed, time.time(), job_id))
+    conn.commit()
+    conn.close()
+
+
+def get(job_id, session_id, offset=0, limit=100):
+    """A session's job status with results from `offset`, or None.
+
+    Results are in completion order, each tagged with its item ``index``.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT job_id, status, total, completed, succeeded, concurrency,
+               created_at, updated_at, elapsed
+        FROM batch_jobs
+        WHERE job_id = ? AND session_id = ? AND expires_at >= ?
+    ''', (job_id, session_id, time.time()))
+    row = cursor.fetchone()
+    if row is None:
+        conn.close()
+        return None
+    cursor.execute('''
+        SELECT record FROM batch_results WHERE job_id = ?
+        ORDER BY id LIMIT ? OFFSET ?
+    ''', (job_id, limit, offset))
+    results = [json.loads(r['record']) for r in cursor.fetchall()]
+    conn.close()
+
+    job = dict(row)
+    if job['status'] == RUNNING and (
+            time.time() - job['updated_at'] > BATCH_JOB_STALE_SECONDS):
+        job['status'] = INTERRUPTED
+    job['failed'] = job['completed'] - job['succeeded']
+    job['results'] = results
+    job['next_offset'] = offset + len(results)
+    return job
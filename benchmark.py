@@ -0,0 +1,339 @@
+"""
+Performance benchmarks
+Compares optimized code paths against the previous implementations
+
+Usage:
+    python benchmark.py docx [path.docx] [--size-mb 50]
+    python benchmark.py gemini-setup [--calls 200]
+    python benchmark.py simhash [--entries 100000]
+    python benchmark.py transcribe [--seconds 5 30 120 300]
+    python benchmark.py upscale [--megapixels 0.5 2 12] [--scales 2 4]
+"""
+
+import argparse
+import io
+import os
+import time
+import tracemalloc
+
+from extractors import extract_docx_text
+
+
+def legacy_docx_text(source):
+    """The previous python-docx extractor (paragraphs only)."""
+    from docx import Document
+    doc = Document(source)
+    return "\n".join([para.text for para in doc.paragraphs]).strip()
+
+
+def build_docx(size_mb):
+    """Build a synthetic report: paragraphs, tables and embedded media."""
+    from docx import Document
+    from docx.shared import Inches
+    from PIL import Image
+
+    doc = Document()
+    target = size_mb * 1024 * 1024
+    written = 0
+    section = 0
+    while written < target:
+        doc.add_heading('Section {}'.format(section), level=1)
+        for i in range(200):
+            doc.add_paragraph(
+                'Paragraph {} of section {}. '.format(i, section) * 5)
+        table = doc.add_table(rows=50, cols=4)
+        for row in table.rows:
+            for cell in row.cells:
+                cell.text = 'cell {}'.format(section)
+        # Fresh incompressible image each time; identical media is deduped
+        media = io.BytesIO()
+        Image.frombytes('RGB', (1024, 1024), os.urandom(1024 * 1024 * 3)).save(
+            media, 'PNG')
+        written += media.tell()
+        media.seek(0)
+        doc.add_picture(media, width=Inches(2))
+        section += 1
+
+    out = io.BytesIO()
+    doc.save(out)
+    return out.getvalue()
+
+
+def measure(label, func, source):
+    """Run an extractor once, reporting wall time and peak Python memory."""
+    tracemalloc.start()
+    began = time.perf_counter()
+    text = func(io.BytesIO(source) if isinstance(source, bytes) else source)
+    elapsed = time.perf_counter() - began
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{:<12} {:>8.2f}s  peak {:>8.1f} MB  {:>10,} chars".format(
+        label, elapsed, peak / 1024 / 1024, len(text)))
+    return text
+
+
+def bench_docx(args):
+    if args.path:
+        source = args.path
+        size = os.path.getsize(args.path)
+    else:
+        print("Building {} MB synthetic DOCX...".format(args.size_mb))
+        source = build_docx(args.size_mb)
+        size = len(source)
+
+    print("=" * 60)
+    print("DOCX extraction ({:.1f} MB file)".format(size / 1024 / 1024))
+    print("=" * 60)
+    legacy = measure('python-docx', legacy_docx_text, source)
+    streamed = measure('streaming', extract_docx_text, source)
+    print("Table text recovered: {:,} extra chars".format(
+        len(streamed) - len(legacy)))
+
+
+def bench_gemini_setup(args):
+    """Per-call configure + construct (old) vs the shared registry (new).
+
+    Only client setup is timed; no request is sent to the API.
+    """
+    import google.generativeai as genai
+    from google.generativeai import client as genai_clients
+    import gemini_client
+
+    api_key = os.getenv('GEMINI_API_KEY', 'benchmark-key')
+
+    began = time.perf_counter()
+    for _ in range(args.calls):
+        genai.configure(api_key=api_key)
+        genai.GenerativeModel('gemini-2.5-flash')
+        # configure() is lazy; the transport is built on the first call
+        genai_clients.get_default_generative_client()
+    legacy = (time.perf_counter() - began) / args.calls
+
+    gemini_client.warm_up(['gemini-2.5-flash'], ping=False)
+    began = time.perf_counter()
+    for _ in range(args.calls):
+        gemini_client.get_model('gemini-2.5-flash')
+    shared = (time.perf_counter() - began) / args.calls
+
+    print("=" * 60)
+    print("Gemini per-call setup ({} calls)".format(args.calls))
+    print("=" * 60)
+    print("{:<22} {:>10.3f} ms/call".format('configure+construct', legacy * 1000))
+    print("{:<22} {:>10.3f} ms/call".format('shared registry', shared * 1000))
+
+
+def bench_simhash(args):
+    """Lookup latency of the near-duplicate index and OCR-noise recall."""
+    import random
+    from simhash_index import SimHashIndex, fingerprint
+
+    rng = random.Random(0)
+    words = ['word{}'.format(i) for i in range(5000)]
+    index = SimHashIndex()
+    for i in range(args.entries):
+        index.add('scope', rng.getrandbits(64), 'key{}'.format(i))
+
+    worksheet = [rng.choice(words) for _ in range(400)]
+    fp = fingerprint(' '.join(worksheet))
+    index.add('scope', fp, 'worksheet')
+
+    began = time.perf_counter()
+    for _ in range(args.lookups):
+        index.nearest('scope', rng.getrandbits(64))
+    miss = (time.perf_counter() - began) / args.lookups
+
+    matched = 0
+    began = time.perf_counter()
+    for _ in range(args.lookups):
+        # Simulate OCR noise: corrupt a few words per re-upload
+        noisy = list(worksheet)
+        for pos in rng.sample(range(len(noisy)), args.typos):
+            noisy[pos] = noisy[pos][:-1] + '1'
+        match = index.nearest('scope', fingerprint(' '.join(noisy)))
+        matched += bool(match and match[0] == 'worksheet')
+    noisy_total = (time.perf_counter() - began) / args.lookups
+
+    print("=" * 60)
+    print("SimHash index ({:,} entries, max distance {})".format(
+        len(index), index.max_distance))
+    print("=" * 60)
+    print("{:<28} {:>10.4f} ms".format('lookup (miss)', miss * 1000))
+    print("{:<28} {:>10.4f} ms".format(
+        'fingerprint + lookup', noisy_total * 1000))
+    print("{:<28} {:>10.1%}".format(
+        '{} typos / 400 words found'.format(args.typos),
+        matched / args.lookups))
+
+
+def build_wav(seconds, rate=16000):
+    """Mono 16-bit speech-band tone with noise, `seconds` long."""
+    import wave
+    import numpy as np
+
+    t = np.arange(int(seconds * rate)) / rate
+    signal = 0.3 * np.sin(2 * np.pi * 220 * t) + 0.05 * np.random.default_rng(
+        0).standard_normal(len(t))
+    out = io.BytesIO()
+    with wave.open(out, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes((signal * 32767).astype('<i2').tobytes())
+    return out.getvalue()
+
+
+def bench_transcribe(args):
+    """Inline vs Files API upload vs reused upload, by clip length.
+
+    Sends real requests; needs GEMINI_API_KEY.
+    """
+    from werkzeug.datastructures import FileStorage
+    import gemini_client
+    import gemini_files
+    from upload_buffer import UploadBuffer
+
+    if not gemini_client.configure():
+        print("GEMINI_API_KEY is not set")
+        return
+
+    def transcribe(upload, mode):
+        began = time.perf_counter()
+        part, used = gemini_files.media_part(upload, 'audio/wav', mode)
+        prepared = time.perf_counter() - began
+        gemini_client.generate_content(
+            args.model, ['Transcribe this audio.', part])
+        return used, prepared, time.perf_counter() - began
+
+    print("=" * 60)
+    print("Audio transcription by clip length ({})".format(args.model))
+    print("=" * 60)
+    print("{:>8} {:>9}  {:<8} {:>10} {:>10}".format(
+        'seconds', 'size', 'mode', 'prepare', 'total'))
+    for seconds in args.seconds:
+        data = build_wav(seconds)
+        upload = UploadBuffer(
+            FileStorage(io.BytesIO(data), filename='clip.wav'), '.',
+            threshold=len(data))
+        runs = []
+        # Inline data shares the 20 MB request limit with the prompt
+        if upload.size < 19 * 1024 * 1024:
+            runs.append(gemini_files.INLINE)
+        gemini_files.forget(upload.digest)
+        runs.extend([gemini_files.UPLOAD, None])
+        for mode in runs:
+            used, prepared, total = transcribe(upload, mode)
+            print("{:>8} {:>7.1f}MB  {:<8} {:>8.0f}ms {:>8.0f}ms".format(
+                seconds, upload.size / 1024 / 1024, used,
+                prepared * 1000, total * 1000))
+        gemini_files.forget(upload.digest)
+
+
+def legacy_upscale(img, scale):
+    """The previous local upscaler: resize first, then denoise."""
+    import cv2
+    import numpy as np
+    from PIL import Image, ImageEnhance, ImageFilter
+
+    height, width = img.shape[:2]
+    upscaled = cv2.resize(img, (width * scale, height * scale),
+                          interpolation=cv2.INTER_CUBIC)
+    denoised = cv2.fastNlMeansDenoisingColored(upscaled, None, 10, 10, 7, 21)
+    kernel = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
+    sharpened = cv2.filter2D(denoised, -1, kernel)
+    img_pil = Image.fromarray(cv2.cvtColor(sharpened, cv2.COLOR_BGR2RGB))
+    img_pil = ImageEnhance.Contrast(img_pil).enhance(1.2)
+    img_pil = ImageEnhance.Color(img_pil).enhance(1.1)
+    img_pil = ImageEnhance.Sharpness(img_pil).enhance(1.3)
+    return img_pil.filter(ImageFilter.UnsharpMask(radius=2, percent=150))
+
+
+def build_photo(megapixels):
+    """Smooth synthetic photo with sensor-like noise, 4:3."""
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    base = cv2.resize(
+        rng.integers(0, 256, (max(2, height // 40), max(2, width // 40), 3),
+                     dtype=np.uint8),
+        (width, height), interpolation=cv2.INTER_CUBIC)
+    noise = rng.normal(0, 12, base.shape)
+    return np.clip(base + noise, 0, 255).astype(np.uint8)
+
+
+def bench_upscale(args):
+    """Seconds per source megapixel, legacy vs tiled denoise-first."""
+    import upscale
+
+    if upscale.UPSCALE_WORKERS > 1:
+        # Start the workers outside the timings
+        upscale.get_pool()
+    print("=" * 60)
+    print("Local upscale ({} workers, {} px tiles)".format(
+        upscale.UPSCALE_WORKERS, upscale.UPSCALE_TILE))
+    print("=" * 60)
+    print("{:>6} {:>6}  {:>12} {:>12} {:>9}".format(
+        'MP', 'scale', 'legacy s/MP', 'tiled s/MP', 'speed-up'))
+    for megapixels in args.megapixels:
+        img = build_photo(megapixels)
+        mp = img.shape[0] * img.shape[1] / 1e6
+        for scale in args.scales:
+            began = time.perf_counter()
+            upscale.upscale_image(img, scale)
+            tiled = (time.perf_counter() - began) / mp
+            legacy = None
+            # The old path takes minutes on large photos
+            if mp * scale * scale <= args.legacy_max_mp:
+                began = time.perf_counter()
+                legacy_upscale(img, scale)
+                legacy = (time.perf_counter() - began) / mp
+            print("{:>6.1f} {:>5}x  {:>12} {:>12.2f} {:>9}".format(
+                mp, scale,
+                '{:.2f}'.format(legacy) if legacy else 'skipped', tiled,
+                '{:.1f}x'.format(legacy / tiled) if legacy else '-'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    docx_parser = sub.add_parser('docx', help='DOCX extraction')
+    docx_parser.add_argument('path', nargs='?')
+    docx_parser.add_argument('--size-mb', type=int, default=50)
+    docx_parser.set_defaults(func=bench_docx)
+
+    gemini_parser = sub.add_parser('gemini-setup', help='Gemini client setup')
+    gemini_parser.add_argument('--calls', type=int, default=200)
+    gemini_parser.set_defaults(func=bench_gemini_setup)
+
+    simhash_parser = sub.add_parser('simhash', help='Near-duplicate index')
+    simhash_parser.add_argument('--entries', type=int, default=100000)
+    simhash_parser.add_argument('--lookups', type=int, default=2000)
+    simhash_parser.add_argument('--typos', type=int, default=3)
+    simhash_parser.set_defaults(func=bench_simhash)
+
+    transcribe_parser = sub.add_parser(
+        'transcribe', help='Inline vs uploaded audio')
+    transcribe_parser.add_argument(
+        '--seconds', type=int, nargs='+', default=[5, 30, 120, 300])
+    transcribe_parser.add_argument('--model', default='gemini-2.5-flash')
+    transcribe_parser.set_defaults(func=bench_transcribe)
+
+    upscale_parser = sub.add_parser('upscale', help='Local image upscaling')
+    upscale_parser.add_argument(
+        '--megapixels', type=float, nargs='+', default=[0.5, 2, 12])
+    upscale_parser.add_argument(
+        '--scales', type=int, nargs='+', default=[2, 4])
+    upscale_parser.add_argument(
+        '--legacy-max-mp', type=float, default=16,
+        help='Skip the old path above this many output megapixels')
+    upscale_parser.set_defaults(func=bench_upscale)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
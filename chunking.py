@@ -0,0 +1,70 @@
+"""
+Prompt-sized chunking
+Splits long documents on page and paragraph boundaries by token estimate
+"""
+
+import re
+
+# Gemini averages about four bytes of UTF-8 per token: ~4 chars of English,
+# ~1.3 chars of Kannada (three bytes per character).
+BYTES_PER_TOKEN = 4
+
+_BLOCK_RE = re.compile(r'\f|\n[ \t]*\n')
+
+
+def estimate_tokens(text):
+    """Cheap, offline token estimate for budgeting prompts."""
+    return len(text.encode('utf-8')) // BYTES_PER_TOKEN + 1
+
+
+def _hard_split(text, max_tokens):
+    """Split one oversized block by lines, then by characters."""
+    pieces = []
+    current = []
+    size = 0
+    for line in text.split('\n'):
+        tokens = estimate_tokens(line)
+        if tokens > max_tokens:
+            # A single huge line (e.g. OCR without newlines); keep order
+            if current:
+                pieces.append('\n'.join(current))
+                current, size = [], 0
+            step = max(1, max_tokens * BYTES_PER_TOKEN // 3)
+            pieces.extend(line[i:i + step] for i in range(0, len(line), step))
+            continue
+        if current and size + tokens > max_tokens:
+            pieces.append('\n'.join(current))
+            current, size = [], 0
+        current.append(line)
+        size += tokens
+    if current:
+        pieces.append('\n'.join(current))
+    return pieces
+
+
+def split_content(text, max_tokens):
+    """Pack pages/paragraphs into chunks of at most ~max_tokens each.
+
+    Blocks are never split unless a single block is over the budget, so
+    each chunk starts and ends on a paragraph (or page) boundary.
+    """
+    chunks = []
+    current = []
+    size = 0
+    for block in _BLOCK_RE.split(text):
+        block = block.strip('\n')
+        if not block.strip():
+            continue
+        tokens = estimate_tokens(block)
+        parts = [block] if tokens <= max_tokens else _hard_split(
+            block, max_tokens)
+        for part in parts:
+            tokens = estimate_tokens(part)
+            if current and size + tokens > max_tokens:
+                chunks.append('\n\n'.join(current))
+                current, size = [], 0
+            current.append(part)
+            size += tokens
+    if current:
+        chunks.append('\n\n'.join(current))
+    return chunks
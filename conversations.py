@@ -0,0 +1,298 @@
+"""
+Chat conversations
+Server-side chat history with a token-budgeted window and running summary
+
+Each conversation belongs to one session. A turn's prompt is the attached
+document's context, the running summary of older turns, as many recent
+turns as fit CHAT_HISTORY_TOKENS and the new message, so its size stays
+bounded however long the conversation gets. Once the recent turns
+outgrow the window, the oldest are folded into the summary. The latest
+exchange is always in the prompt, cut to the window if it is larger.
+"""
+
+import os
+import threading
+import time
+import uuid
+
+from chunking import BYTES_PER_TOKEN, estimate_tokens
+from database import get_db_connection
+
+CHAT_HISTORY_TOKENS = int(os.getenv('CHAT_HISTORY_TOKENS', '3000'))
+CHAT_SUMMARY_TOKENS = int(os.getenv('CHAT_SUMMARY_TOKENS', '800'))
+CHAT_DOCUMENT_TOKENS = int(os.getenv('CHAT_DOCUMENT_TOKENS', '12000'))
+CONVERSATION_TTL_SECONDS = int(
+    os.getenv('CONVERSATION_TTL_SECONDS', str(24 * 3600)))
+
+COMPACTION_INSTRUCTION = """You maintain the running summary of a \
+conversation between a user and an AI assistant.
+Merge the previous summary with the new turns into one updated summary.
+
+- Keep the user's goals, questions, facts they shared and decisions made
+- Keep the key points of the assistant's answers
+- Drop greetings, repetition and formatting
+- Plain text, no markdown symbols
+- At most {} words
+""".format(CHAT_SUMMARY_TOKENS * 3 // 4)
+
+_compacting = set()
+_compacting_lock = threading.Lock()
+
+
+def create(session_id, document_id=None):
+    """Start a conversation for a session and return its id."""
+    conversation_id = uuid.uuid4().hex
+    now = time.time()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # Sweep expired conversations while we are here
+    cursor.execute('''
+        DELETE FROM conversation_turns WHERE conversation_id IN (
+            SELECT conversation_id FROM conversations WHERE expires_at < ?)
+    ''', (now,))
+    cursor.execute('DELETE FROM conversations WHERE expires_at < ?', (now,))
+
+    cursor.execute('''
+        INSERT INTO conversations
+        (conversation_id, session_id, document_id, created_at, updated_at,
+         expires_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (conversation_id, session_id, document_id, now, now,
+          now + CONVERSATION_TTL_SECONDS))
+    conn.commit()
+    conn.close()
+    return conversation_id
+
+
+def get(conversation_id, session_id):
+    """Load a session's conversation with its uncompacted turns, or None."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT conversation_id, document_id, document_context, summary,
+               turn_count
+        FROM conversations
+        WHERE conversation_id = ? AND session_id = ? AND expires_at >= ?
+    ''', (conversation_id, session_id, time.time()))
+    row = cursor.fetchone()
+    if row is None:
+        conn.close()
+        return None
+    cursor.execute('''
+        SELECT id, role, content, tokens FROM conversation_turns
+        WHERE conversation_id = ? AND compacted = 0
+        ORDER BY id
+    ''', (conversation_id,))
+    turns = [dict(turn) for turn in cursor.fetchall()]
+    conn.close()
+    conversation = dict(row)
+    conversation['turns'] = turns
+    return conversation
+
+
+def set_document(conversation_id, document_id, context):
+    """Attach a document's (possibly condensed) text for later turns."""
+    conn = get_db_connection()
+    conn.execute('''
+        UPDATE conversations SET document_id = ?, document_context = ?
+        WHERE conversation_id = ?
+    ''', (document_id, context, conversation_id))
+    conn.commit()
+    conn.close()
+
+
+def add_turn(conversation_id, message, answer):
+    """Append a user message and the model's answer."""
+    now = time.time()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany('''
+        INSERT INTO conversation_turns
+        (conversation_id, role, content, tokens, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [
+        (conversation_id, 'user', message, estimate_tokens(message), now),
+        (conversation_id, 'model', answer, estimate_tokens(answer), now)
+    ])
+    cursor.execute('''
+        UPDATE conversations
+        SET turn_count = turn_count + 1, updated_at = ?, expires_at = ?
+        WHERE conversation_id = ?
+    ''', (now, now + CONVERSATION_TTL_SECONDS, conversation_id))
+    conn.commit()
+    conn.close()
+
+
+def _clip(text, tokens):
+    """`text` cut to about `tokens` tokens, marking the cut."""
+    if estimate_tokens(text) <= tokens:
+        return text
+    # Leave room for the marker
+    limit = max(0, tokens - 3) * BYTES_PER_TOKEN
+    return text.encode('utf-8')[:limit].decode('utf-8', 'ignore') + ' [...]'
+
+
+def clip_exchange(message, answer):
+    """A user/model exchange cut to fit CHAT_HISTORY_TOKENS together.
+
+    The message keeps up to half the window and the answer gets the rest,
+    so an over-long answer is shortened rather than lost.
+    """
+    budget = CHAT_HISTORY_TOKENS - 2
+    message = _clip(message, min(estimate_tokens(message), budget // 2))
+    return message, _clip(answer, budget - estimate_tokens(message))
+
+
+def seed(conversation_id, history):
+    """Record turns the client had before the conversation existed.
+
+    `history` is a list of ``{"role": "user"|"model", "content": ...}``
+    items; complete user/model pairs are kept, newest first, as long as
+    they fit CHAT_HISTORY_TOKENS. The newest pair is always kept, cut to
+    the window if needed. Returns the number of exchanges kept.
+    """
+    pairs = []
+    items = [item for item in history if isinstance(item, dict)]
+    for user, model in zip(items, items[1:]):
+        if (user.get('role') == 'user' and model.get('role') == 'model'
+                and isinstance(user.get('content'), str)
+                and isinstance(model.get('content'), str)):
+            pairs.append((user['content'], model['content']))
+
+    kept = []
+    used = 0
+    for message, answer in reversed(pairs):
+        used += estimate_tokens(message) + estimate_tokens(answer)
+        if used > CHAT_HISTORY_TOKENS:
+            if not kept:
+                kept.append(clip_exchange(message, answer))
+            break
+        kept.append((message, answer))
+    for message, answer in reversed(kept):
+        add_turn(conversation_id, message, answer)
+    return len(kept)
+
+
+def build_contents(conversation, message):
+    """Gemini `contents` for the next turn, within the token budgets.
+
+    Returns (contents, estimated_prompt_tokens).
+    """
+    preamble = []
+    if conversation.get('document_context'):
+        preamble.append("Document the user is asking about:\n{}".format(
+            conversation['document_context']))
+    if conversation.get('summary'):
+        preamble.append("Summary of the conversation so far:\n{}".format(
+            conversation['summary']))
+
+    # Newest turns first until the window is full
+    window = []
+    used = 0
+    for turn in reversed(conversation['turns']):
+        if used + turn['tokens'] > CHAT_HISTORY_TOKENS:
+            break
+        window.append(turn)
+        used += turn['tokens']
+    window.reverse()
+    # The history must open with a user turn
+    while window and window[0]['role'] != 'user':
+        used -= window.pop(0)['tokens']
+    latest = conversation['turns'][-2:]
+    if not window and [turn['role'] for turn in latest] == ['user', 'model']:
+        # The latest exchange alone overflows the window; send it cut down
+        window = [
+            {'role': turn['role'], 'content': content}
+            for turn, content in zip(latest, clip_exchange(
+                latest[0]['content'], latest[1]['content']))
+        ]
+        used = sum(estimate_tokens(turn['content']) for turn in window)
+
+    contents = []
+    tokens = used + estimate_tokens(message)
+    if preamble:
+        text = '\n\n'.join(preamble)
+        contents.append({'role': 'user', 'parts': [text]})
+        contents.append({'role': 'model', 'parts': ['Understood.']})
+        tokens += estimate_tokens(text)
+    contents.extend(
+        {'role': turn['role'], 'parts': [turn['content']]} for turn in window)
+    contents.append({'role': 'user', 'parts': [message]})
+    return contents, tokens
+
+
+def needs_compaction(conversation_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT COALESCE(SUM(tokens), 0) AS total FROM conversation_turns
+        WHERE conversation_id = ? AND compacted = 0
+    ''', (conversation_id,))
+    total = cursor.fetchone()['total']
+    conn.close()
+    return total > CHAT_HISTORY_TOKENS
+
+
+def compact(conversation_id, summarize):
+    """Fold the oldest turns into the summary until half the window is free.
+
+    `summarize(previous_summary, transcript)` returns the new summary. Only
+    one compaction per conversation runs at a time in this worker.
+    """
+    with _compacting_lock:
+        if conversation_id in _compacting:
+            return False
+        _compacting.add(conversation_id)
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT summary FROM conversations WHERE conversation_id = ?',
+            (conversation_id,))
+        row = cursor.fetchone()
+        cursor.execute('''
+            SELECT id, role, content, tokens FROM conversation_turns
+            WHERE conversation_id = ? AND compacted = 0
+            ORDER BY id
+        ''', (conversation_id,))
+        turns = cursor.fetchall()
+        conn.close()
+        if row is None:
+            return False
+
+        total = sum(turn['tokens'] for turn in turns)
+        if total <= CHAT_HISTORY_TOKENS:
+            return False
+        # Keep at least the latest exchange verbatim
+        folded = []
+        for turn in turns[:-2]:
+            if total <= CHAT_HISTORY_TOKENS // 2 and (
+                    folded and folded[-1]['role'] == 'model'):
+                break
+            folded.append(turn)
+            total -= turn['tokens']
+        if not folded:
+            return False
+
+        transcript = '\n\n'.join(
+            '{}: {}'.format(
+                'User' if turn['role'] == 'user' else 'Assistant',
+                turn['content'])
+            for turn in folded)
+        summary = summarize(row['summary'] or '', transcript)
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'UPDATE conversations SET summary = ? WHERE conversation_id = ?',
+            (summary, conversation_id))
+        cursor.executemany(
+            'UPDATE conversation_turns SET compacted = 1 WHERE id = ?',
+            [(turn['id'],) for turn in folded])
+        conn.commit()
+        conn.close()
+        return True
+    finally:
+        with _compacting_lock:
+            _compacting.discard(conversation_id)
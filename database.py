@@ -6,6 +6,8 @@ import sqlite3
 from datetime import datetime
 import json
 import os
+import time
+import uuid
 
 DATABASE_PATH = 'app_data.db'
 
@@ -81,6 +83,142 @@ def init_database():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_analytics_cache_expires
+        ON analytics_cache (expires_at)
+    ''')
+
+    # SimHash fingerprints of analyzed content (near-duplicate reuse)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS simhash_index (
+            cache_key TEXT PRIMARY KEY,
+            scope TEXT NOT NULL,
+            fingerprint INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_simhash_index_created
+        ON simhash_index (created_at)
+    ''')
+
+    # Cross-worker single-flight locks for identical in-flight AI calls
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS inflight_locks (
+            lock_key TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+    # Extraction cache table (content-addressed upload text)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS extraction_cache (
+            cache_key TEXT PRIMARY KEY,
+            extracted_text TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            hit_count INTEGER DEFAULT 0,
+            last_accessed REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_extraction_cache_accessed
+        ON extraction_cache (last_accessed)
+    ''')
+
+    # Extracted documents, referenced by id instead of resending the text
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS documents (
+            document_id TEXT PRIMARY KEY,
+            session_id TEXT,
+            filename TEXT,
+            content TEXT NOT NULL,
+            char_count INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_documents_expires
+        ON documents (expires_at)
+    ''')
+
+    # Server-side chat conversations: running summary plus recent turns
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            conversation_id TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            document_id TEXT,
+            document_context TEXT,
+            summary TEXT,
+            turn_count INTEGER DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_expires
+        ON conversations (expires_at)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_turns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            compacted INTEGER DEFAULT 0,
+            created_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversation_turns_conversation
+        ON conversation_turns (conversation_id, compacted)
+    ''')
+
+    # Gemini Files API uploads, reused by content hash until reaped
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS gemini_files (
+            content_hash TEXT PRIMARY KEY,
+            file_name TEXT NOT NULL,
+            uri TEXT NOT NULL,
+            mime_type TEXT,
+            size_bytes INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+    ''')
+
+    # Background batch analyses and their per-item results
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            job_id TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            completed INTEGER DEFAULT 0,
+            succeeded INTEGER DEFAULT 0,
+            concurrency INTEGER NOT NULL,
+            elapsed REAL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS batch_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            item_index INTEGER NOT NULL,
+            record TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_batch_results_job
+        ON batch_results (job_id, id)
+    ''')
 
     conn.commit()
     conn.close()
@@ -471,6 +609,92 @@ def get_recommendations(session_id):
         }
 
 
+def store_document(session_id, filename, content, ttl_seconds):
+    """Store extracted text under a new document id and return the id."""
+    try:
+        document_id = uuid.uuid4().hex
+        now = time.time()
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        # Sweep expired documents while we are here
+        cursor.execute('DELETE FROM documents WHERE expires_at < ?', (now,))
+
+        cursor.execute('''
+            INSERT INTO documents
+            (document_id, session_id, filename, content, char_count,
+             expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (
+            document_id,
+            session_id,
+            filename,
+            content,
+            len(content),
+            now + ttl_seconds
+        ))
+
+        conn.commit()
+        conn.close()
+        return document_id
+    except Exception as e:
+        print(f"Error storing document: {e}")
+        return None
+
+
+def get_document(document_id, session_id):
+    """Get the full text of a session's unexpired document, or None."""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT content FROM documents
+            WHERE document_id = ? AND session_id = ? AND expires_at >= ?
+        ''', (document_id, session_id, time.time()))
+
+        row = cursor.fetchone()
+        conn.close()
+        return row['content'] if row else None
+    except Exception as e:
+        print(f"Error getting document: {e}")
+        return None
+
+
+def get_document_range(document_id, session_id, offset, limit):
+    """Get a slice of a document's text without loading all of it.
+
+    Returns a dict with the text slice and the total length, or None if
+    the document does not exist, has expired or belongs to another
+    session.
+    """
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        # SQLite substr() is 1-based
+        cursor.execute('''
+            SELECT substr(content, ?, ?) AS text, char_count, filename,
+                   expires_at
+            FROM documents
+            WHERE document_id = ? AND session_id = ? AND expires_at >= ?
+        ''', (offset + 1, limit, document_id, session_id, time.time()))
+
+        row = cursor.fetchone()
+        conn.close()
+        if not row:
+            return None
+        return {
+            'text': row['text'],
+            'total': row['char_count'],
+            'filename': row['filename'],
+            'expires_at': row['expires_at']
+        }
+    except Exception as e:
+        print(f"Error getting document range: {e}")
+        return None
+
+
 # Initialize database on module import
 if not os.path.exists(DATABASE_PATH):
     init_database()
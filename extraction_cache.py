@@ -0,0 +1,228 @@
+"""
+Content-addressed extraction cache
+Stores extracted upload text in SQLite keyed by SHA-256 of the file bytes
+"""
+
+import functools
+import hashlib
+import inspect
+import os
+import threading
+import time
+
+from database import get_db_connection
+
+# Bump a version whenever the matching extractor changes its output so
+# stale entries are never served.
+EXTRACTOR_VERSIONS = {
+    'image': 2,
+    'pdf': 2,
+    'docx': 2,
+    'txt': 2
+}
+
+EXTRACTION_CACHE_MAX_BYTES = int(
+    os.getenv('EXTRACTION_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+_CHUNK_SIZE = 1024 * 1024
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def stream_digest(stream):
+    """SHA-256 of a binary stream; the stream is rewound afterwards."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    """SHA-256 of a file on disk."""
+    with open(path, 'rb') as f:
+        return stream_digest(f)
+
+
+def source_digest(source):
+    """SHA-256 of an extractor source: in-memory bytes or a file path."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(source).hexdigest()
+    return file_digest(source)
+
+
+def make_key(kind, digest, variant=''):
+    """Build the cache key for an extractor kind and content digest."""
+    key = '{}:v{}:{}'.format(kind, EXTRACTOR_VERSIONS[kind], digest)
+    if variant:
+        key += ':' + variant
+    return key
+
+
+def get(key, record=True):
+    """Return cached text for a key, or None on a miss."""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT extracted_text FROM extraction_cache WHERE cache_key = ?',
+            (key,)
+        )
+        row = cursor.fetchone()
+        if row:
+            cursor.execute('''
+                UPDATE extraction_cache
+                SET hit_count = hit_count + 1, last_accessed = ?
+                WHERE cache_key = ?
+            ''', (time.time(), key))
+            conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"Error reading extraction cache: {e}")
+        row = None
+
+    if record:
+        _count('hits' if row else 'misses')
+    return row['extracted_text'] if row else None
+
+
+def put(key, text):
+    """Store extracted text and evict least recently used entries."""
+    size = len(text.encode('utf-8'))
+    if size > EXTRACTION_CACHE_MAX_BYTES:
+        return False
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO extraction_cache
+            (cache_key, extracted_text, size_bytes, last_accessed)
+            VALUES (?, ?, ?, ?)
+        ''', (key, text, size, time.time()))
+
+        cursor.execute(
+            'SELECT COALESCE(SUM(size_bytes), 0) AS total '
+            'FROM extraction_cache'
+        )
+        total = cursor.fetchone()['total']
+        evicted = 0
+        if total > EXTRACTION_CACHE_MAX_BYTES:
+            cursor.execute('''
+                SELECT cache_key, size_bytes FROM extraction_cache
+                ORDER BY last_accessed ASC
+            ''')
+            victims = []
+            for row in cursor.fetchall():
+                if total <= EXTRACTION_CACHE_MAX_BYTES:
+                    break
+                victims.append((row['cache_key'],))
+                total -= row['size_bytes']
+            cursor.executemany(
+                'DELETE FROM extraction_cache WHERE cache_key = ?', victims)
+            evicted = len(victims)
+
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"Error writing extraction cache: {e}")
+        return False
+
+    _count('stores')
+    if evicted:
+        _count('evictions', evicted)
+    return True
+
+
+class UncachedText(str):
+    """Extractor output to serve but never store.
+
+    Used for text from a fallback model tier: like fallback analyses in
+    response_cache, it must not pin a worse answer to the file's content
+    hash.
+    """
+
+
+def is_cacheable(text):
+    """Error and fallback strings must not be cached."""
+    return bool(text) and not isinstance(text, UncachedText) and (
+        not text.startswith('Error')) and text != 'Could not analyze image'
+
+
+def _variant(args, kwargs):
+    """Encode extra extractor arguments into the key suffix."""
+    if not (args or kwargs):
+        return ''
+    return repr((args, sorted(kwargs.items())))
+
+
+def key_for(kind, digest, *args, **kwargs):
+    """Cache key of extractor `kind` run with these extra arguments."""
+    return make_key(kind, digest, _variant(args, kwargs))
+
+
+def lookup(kind, digest, *args, **kwargs):
+    """Look up the cached output of extractor `kind` for a content digest."""
+    return get(key_for(kind, digest, *args, **kwargs))
+
+
+def store(kind, digest, text, *args, **kwargs):
+    """Cache extractor output unless it is an error string."""
+    if is_cacheable(text):
+        put(key_for(kind, digest, *args, **kwargs), text)
+
+
+def cached_extractor(kind):
+    """Decorate an extractor(source, ...) with the content-addressed cache.
+
+    Callers that already hashed the upload pass ``digest=`` to skip a
+    second read of the file. Extra arguments (e.g. a PDF page range) become
+    part of the key, with defaults filled in and keywords bound to their
+    positions so every spelling of a call shares one entry. The
+    undecorated function stays available as ``__wrapped__``.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(source, *args, digest=None, **kwargs):
+            bound = signature.bind(source, *args, **kwargs)
+            bound.apply_defaults()
+            args, kwargs = bound.args[1:], bound.kwargs
+            digest = digest or source_digest(source)
+            text = lookup(kind, digest, *args, **kwargs)
+            if text is not None:
+                return text
+            text = func(source, *args, **kwargs)
+            store(kind, digest, text, *args, **kwargs)
+            return text
+        return wrapper
+    return decorator
+
+
+def get_stats():
+    """Hit/miss counters for this worker plus the shared table size."""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*) AS entries, COALESCE(SUM(size_bytes), 0) AS bytes
+            FROM extraction_cache
+        ''')
+        row = cursor.fetchone()
+        conn.close()
+        stats['entries'] = row['entries']
+        stats['bytes'] = row['bytes']
+    except Exception as e:
+        print(f"Error reading extraction cache stats: {e}")
+    stats['max_bytes'] = EXTRACTION_CACHE_MAX_BYTES
+    return stats
@@ -0,0 +1,466 @@
+"""
+Document text extractors
+Page-parallel PDF extraction backed by a shared process pool, with OCR
+for scanned pages that have no text layer, streaming DOCX extraction and
+encoding-sniffing TXT extraction
+"""
+
+import codecs
+import mmap
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+)
+from xml.etree import ElementTree
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+from ocr import ocr_image
+from upload_buffer import as_file
+
+# Documents with fewer pages than this are extracted on the request thread;
+# the pool start-up and pickling overhead is not worth it below that.
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', '32'))
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+# A page with fewer characters than this and at least one image is treated
+# as scanned and sent to OCR.
+PDF_MIN_TEXT_CHARS = int(os.getenv('PDF_MIN_TEXT_CHARS', '20'))
+PDF_OCR_DPI = int(os.getenv('PDF_OCR_DPI', '300'))
+PDF_OCR_MAX_SIDE = int(os.getenv('PDF_OCR_MAX_SIDE', '4000'))
+_PDF_OCR_MIN_DPI = 100
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+_page_ocr_pool = None
+
+
+def _get_pdf_pool():
+    """Lazily create the process pool shared by all requests in a worker.
+
+    Workers are spawned, not forked: the pool starts from a request thread
+    while other threads may hold MuPDF or SQLite locks, and a forked child
+    would inherit those locks held forever.
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'))
+        return _pdf_pool
+
+
+def _get_page_ocr_pool():
+    """Threads that OCR rasterized pages (the OCR itself runs out of process)."""
+    global _page_ocr_pool
+    if _page_ocr_pool is None:
+        _page_ocr_pool = ThreadPoolExecutor(max_workers=PDF_WORKERS)
+    return _page_ocr_pool
+
+
+def open_pdf(source):
+    """Open a PDF from a filesystem path or an in-memory buffer."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=source, filetype='pdf')
+    return fitz.open(source)
+
+
+def _needs_ocr(page, text):
+    """True when a page has no usable text layer but does carry images."""
+    return len(text.strip()) < PDF_MIN_TEXT_CHARS and bool(page.get_images())
+
+
+def _extract_page(doc, page_no):
+    began = time.perf_counter()
+    page = doc[page_no]
+    text = page.get_text()
+    return (page_no, text, time.perf_counter() - began,
+            _needs_ocr(page, text))
+
+
+def _extract_page_batch(source, start, stop):
+    """Extract pages [start, stop) in a pool worker.
+
+    Each worker opens its own document handle; fitz documents cannot be
+    shared between processes.
+    """
+    doc = open_pdf(source)
+    try:
+        return [_extract_page(doc, page_no) for page_no in range(start, stop)]
+    finally:
+        doc.close()
+
+
+def _ocr_dpi(rect):
+    """Rasterization DPI: PDF_OCR_DPI, lowered so huge pages stay bounded."""
+    long_side_inches = max(rect.width, rect.height) / 72.0
+    if long_side_inches <= 0:
+        return PDF_OCR_DPI
+    dpi = min(PDF_OCR_DPI, PDF_OCR_MAX_SIDE / long_side_inches)
+    return int(max(_PDF_OCR_MIN_DPI, dpi))
+
+
+def _render_page(source, page_no):
+    """Rasterize one page to 8-bit grayscale at an adaptive DPI."""
+    doc = open_pdf(source)
+    try:
+        page = doc[page_no]
+        dpi = _ocr_dpi(page.rect)
+        pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+        return pix.width, pix.height, dpi, pix.samples
+    finally:
+        doc.close()
+
+
+def _ocr_rendered(rendered, began):
+    width, height, dpi, samples = rendered
+    img = Image.frombytes('L', (width, height), samples)
+    img.info['dpi'] = (dpi, dpi)
+    return ocr_image(img), time.perf_counter() - began
+
+
+def _ocr_page(source, page_no, in_process=False):
+    """Rasterize and OCR one scanned page.
+
+    Rendering happens in the PDF process pool (PyMuPDF is not thread-safe)
+    and each OCR thread only holds one raster at a time, so memory stays
+    bounded on long scanned documents.
+    """
+    began = time.perf_counter()
+    if in_process:
+        rendered = _render_page(source, page_no)
+    else:
+        rendered = _get_pdf_pool().submit(
+            _render_page, source, page_no).result()
+    return _ocr_rendered(rendered, began)
+
+
+def _resolve_page_range(page_count, page_range):
+    """Clamp an optional (first, last) 1-based inclusive range to the doc."""
+    if not page_range:
+        return 0, page_count
+    first, last = page_range
+    start = max(0, (first or 1) - 1)
+    stop = min(page_count, last or page_count)
+    return start, max(start, stop)
+
+
+def _split_batches(start, stop, parts):
+    """Split [start, stop) into at most `parts` contiguous batches."""
+    total = stop - start
+    size, extra = divmod(total, parts)
+    batches = []
+    cursor = start
+    for i in range(parts):
+        length = size + (1 if i < extra else 0)
+        if length:
+            batches.append((cursor, cursor + length))
+            cursor += length
+    return batches
+
+
+def count_pdf_pages(source, page_range=None):
+    """Number of pages that extraction over `page_range` will produce."""
+    doc = open_pdf(source)
+    try:
+        start, stop = _resolve_page_range(doc.page_count, page_range)
+        return stop - start
+    finally:
+        doc.close()
+
+
+def iter_pdf_pages(source, page_range=None, batch_pages=None):
+    """Yield (page_no, text, seconds, ocred) as each page finishes.
+
+    Pages come out in completion order, not document order. Text-layer
+    pages are yielded first; pages without one are rasterized and OCRed
+    in parallel and yielded as their OCR completes. `batch_pages` sets how
+    many pages each pool task extracts: smaller batches give earlier first
+    results, the default (one batch per worker) gives the best throughput.
+    Documents below PDF_PARALLEL_MIN_PAGES are extracted in-process.
+    """
+    scanned = []
+    doc = open_pdf(source)
+    try:
+        start, stop = _resolve_page_range(doc.page_count, page_range)
+        parallel = not (
+            stop - start < PDF_PARALLEL_MIN_PAGES or PDF_WORKERS < 2)
+        if not parallel:
+            for page_no in range(start, stop):
+                page_no, text, seconds, needs_ocr = _extract_page(
+                    doc, page_no)
+                if needs_ocr:
+                    scanned.append((page_no, seconds))
+                else:
+                    yield page_no, text, seconds, False
+    finally:
+        doc.close()
+
+    if parallel:
+        parts = PDF_WORKERS
+        if batch_pages:
+            parts = max(parts, -(-(stop - start) // batch_pages))
+        pool = _get_pdf_pool()
+        futures = [
+            pool.submit(_extract_page_batch, source, batch_start, batch_stop)
+            for batch_start, batch_stop in _split_batches(start, stop, parts)
+        ]
+        for future in as_completed(futures):
+            for page_no, text, seconds, needs_ocr in future.result():
+                if needs_ocr:
+                    scanned.append((page_no, seconds))
+                else:
+                    yield page_no, text, seconds, False
+
+    if len(scanned) == 1 or (scanned and PDF_WORKERS < 2):
+        for page_no, seconds in scanned:
+            text, ocr_seconds = _ocr_page(source, page_no, in_process=True)
+            yield page_no, text + '\n', seconds + ocr_seconds, True
+    elif scanned:
+        # Render tasks get a path, not a pickled copy of the whole PDF each
+        spill = None
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            with tempfile.NamedTemporaryFile(
+                    suffix='.pdf', delete=False) as f:
+                f.write(source)
+            source = spill = f.name
+        ocr_futures = {}
+        try:
+            threads = _get_page_ocr_pool()
+            ocr_futures = {
+                threads.submit(_ocr_page, source, page_no):
+                    (page_no, seconds)
+                for page_no, seconds in scanned
+            }
+            for future in as_completed(ocr_futures):
+                page_no, seconds = ocr_futures[future]
+                text, ocr_seconds = future.result()
+                yield page_no, text + '\n', seconds + ocr_seconds, True
+        finally:
+            if spill is not None:
+                for future in ocr_futures:
+                    future.cancel()
+                wait(ocr_futures)
+                os.remove(spill)
+
+
+def extract_pdf_pages(source, page_range=None):
+    """Extract PDF text page by page.
+
+    `source` is a path or the PDF bytes. Returns a dict with the page texts
+    in document order, per-page timings (seconds), the pages that had to be
+    OCRed and the total wall time. Large documents are spread across the
+    process pool in contiguous page batches. Pages without a text layer are
+    rasterized and OCRed in parallel; the rest keep the fast get_text path.
+    """
+    began = time.perf_counter()
+    results = sorted(iter_pdf_pages(source, page_range))
+    return {
+        'pages': [text for _, text, _, _ in results],
+        'page_numbers': [page_no + 1 for page_no, _, _, _ in results],
+        'page_timings': [round(seconds, 4) for _, _, seconds, _ in results],
+        'ocr_pages': [page_no + 1 for page_no, _, _, ocred in results
+                      if ocred],
+        'parallel': (len(results) >= PDF_PARALLEL_MIN_PAGES and
+                     PDF_WORKERS >= 2),
+        'elapsed': round(time.perf_counter() - began, 4)
+    }
+
+
+def extract_pdf_text(source, page_range=None):
+    """Extract PDF text as a single string, joining the pages once."""
+    result = extract_pdf_pages(source, page_range)
+    print("PDF extraction: {} pages ({} OCRed) in {}s (parallel={})".format(
+        len(result['pages']), len(result['ocr_pages']), result['elapsed'],
+        result['parallel']))
+    return "".join(result['pages']).strip()
+
+
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_W_BODY, _W_P, _W_TBL, _W_TR, _W_TC = (
+    _W + 'body', _W + 'p', _W + 'tbl', _W + 'tr', _W + 'tc')
+_W_T, _W_TAB, _W_BR, _W_CR = _W + 't', _W + 'tab', _W + 'br', _W + 'cr'
+
+
+def _paragraph_text(paragraph):
+    """Visible text of a w:p element (deleted revisions are skipped)."""
+    parts = []
+    for node in paragraph.iter():
+        if node.tag == _W_T:
+            parts.append(node.text or '')
+        elif node.tag == _W_TAB:
+            parts.append('\t')
+        elif node.tag in (_W_BR, _W_CR):
+            parts.append('\n')
+    return ''.join(parts)
+
+
+def iter_docx_blocks(source):
+    """Yield DOCX paragraphs and table rows in document order.
+
+    Streams word/document.xml straight out of the zip with iterparse, so
+    media parts are never decompressed and finished elements are dropped
+    as we go. Table rows are yielded as tab-separated cells; nested tables
+    are folded into the text of their enclosing cell.
+    """
+    with zipfile.ZipFile(as_file(source)) as archive:
+        with archive.open('word/document.xml') as xml:
+            body = None
+            rows = []   # cells of each open table row (innermost last)
+            cells = []  # paragraphs of each open table cell
+            tables = 0
+            for event, elem in ElementTree.iterparse(
+                    xml, events=('start', 'end')):
+                tag = elem.tag
+                if event == 'start':
+                    if tag == _W_BODY:
+                        body = elem
+                    elif tag == _W_TBL:
+                        tables += 1
+                    elif tag == _W_TR:
+                        rows.append([])
+                    elif tag == _W_TC:
+                        cells.append([])
+                    continue
+
+                if tag == _W_P:
+                    text = _paragraph_text(elem)
+                    if cells:
+                        cells[-1].append(text)
+                    else:
+                        yield text
+                    elem.clear()
+                elif tag == _W_TC:
+                    rows[-1].append(
+                        '\n'.join(text for text in cells.pop() if text))
+                elif tag == _W_TR:
+                    row = '\t'.join(rows.pop())
+                    if cells:
+                        cells[-1].append(row)
+                    else:
+                        yield row
+                    elem.clear()
+                elif tag == _W_TBL:
+                    tables -= 1
+                else:
+                    continue
+
+                # Top-level block finished: drop everything parsed so far
+                if not tables and body is not None:
+                    body.clear()
+
+
+def iter_docx_pages(source, page_chars=3000):
+    """Group DOCX blocks into chunks of about `page_chars` characters.
+
+    DOCX has no fixed pages; these chunks let callers deliver text
+    progressively. Joining the chunks with newlines gives the full text.
+    """
+    page = []
+    size = 0
+    page_no = 0
+    for block in iter_docx_blocks(source):
+        page.append(block)
+        size += len(block) + 1
+        if size >= page_chars:
+            yield page_no, "\n".join(page)
+            page_no += 1
+            page = []
+            size = 0
+    if page:
+        yield page_no, "\n".join(page)
+
+
+def extract_docx_text(source):
+    """Extract DOCX text, including tables, with bounded memory."""
+    return "\n".join(iter_docx_blocks(source)).strip()
+
+
+# The prompt can only use a bounded amount of text, so never decode more.
+TXT_MAX_CHARS = int(os.getenv('TXT_MAX_CHARS', '1000000'))
+TXT_MMAP_MIN_BYTES = int(os.getenv('TXT_MMAP_MIN_BYTES', str(1024 * 1024)))
+_TXT_SAMPLE_BYTES = 64 * 1024
+_TXT_CHUNK_BYTES = 256 * 1024
+
+# UTF-32 LE starts with the UTF-16 LE BOM, so it must be checked first.
+_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+
+def sniff_encoding(sample):
+    """Guess a text encoding from a BOM or, failing that, a byte sample."""
+    for bom, encoding in _BOMS:
+        if sample.startswith(bom):
+            return encoding
+
+    # BOM-less UTF-16: ASCII-range text leaves NULs in every other byte
+    half = max(1, len(sample) // 2)
+    even_nuls = sample[0::2].count(0)
+    odd_nuls = sample[1::2].count(0)
+    if odd_nuls > half * 0.3 and even_nuls < half * 0.05:
+        return 'utf-16-le'
+    if even_nuls > half * 0.3 and odd_nuls < half * 0.05:
+        return 'utf-16-be'
+
+    try:
+        # Not final: the sample may end in the middle of a character
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        # Legacy Windows / Latin-1 exports
+        return 'cp1252'
+
+
+def _decode_bounded(buf, max_chars):
+    """Incrementally decode a bytes-like buffer up to `max_chars`."""
+    encoding = sniff_encoding(bytes(buf[:_TXT_SAMPLE_BYTES]))
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    parts = []
+    count = 0
+    size = len(buf)
+    for offset in range(0, size, _TXT_CHUNK_BYTES):
+        end = offset + _TXT_CHUNK_BYTES
+        part = decoder.decode(buf[offset:end], final=end >= size)
+        parts.append(part)
+        count += len(part)
+        if count >= max_chars:
+            break
+    text = ''.join(parts)
+    return text[:max_chars], encoding, count > max_chars
+
+
+def extract_txt_text(source, max_chars=None):
+    """Extract text from a TXT upload of unknown encoding.
+
+    Files above TXT_MMAP_MIN_BYTES are memory-mapped rather than read, and
+    decoding stops once `max_chars` (default TXT_MAX_CHARS) is reached.
+    """
+    max_chars = max_chars or TXT_MAX_CHARS
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        text, encoding, truncated = _decode_bounded(source, max_chars)
+    else:
+        with open(source, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < TXT_MMAP_MIN_BYTES:
+                text, encoding, truncated = _decode_bounded(
+                    f.read(), max_chars)
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    text, encoding, truncated = _decode_bounded(
+                        mm, max_chars)
+    if truncated:
+        print("TXT extraction: truncated to {} chars ({})".format(
+            max_chars, encoding))
+    return text.strip()
@@ -0,0 +1,485 @@
+"""
+Gemini client
+Process-wide registry of configured, reused GenerativeModel handles,
+behind a shared per-model rate limiter
+
+genai.configure() rebuilds the underlying API clients, so it runs once per
+worker (and again only if the key changes). Model handles are cached by
+model name, generation config and system instruction, so every request
+reuses the same transport connection.
+"""
+
+import datetime
+import json
+import os
+import random
+import threading
+import time
+
+import google.generativeai as genai
+import requests
+from google.api_core import exceptions as api_exceptions
+from google.generativeai import caching
+from google.generativeai import client as genai_clients
+
+from chunking import estimate_tokens
+from rate_limiter import RateLimiter, RateLimited
+
+# Budgets per model; GEMINI_MODEL_LIMITS overrides them, e.g.
+# '{"gemini-2.5-flash": {"rpm": 1000, "tpm": 4000000}}'. 0 = unlimited.
+GEMINI_RPM = int(os.getenv('GEMINI_RPM', '60'))
+GEMINI_TPM = int(os.getenv('GEMINI_TPM', '1000000'))
+GEMINI_MODEL_LIMITS = json.loads(os.getenv('GEMINI_MODEL_LIMITS', '{}'))
+GEMINI_QUEUE_DEPTH = int(os.getenv('GEMINI_QUEUE_DEPTH', '32'))
+GEMINI_MAX_QUEUE_WAIT = float(os.getenv('GEMINI_MAX_QUEUE_WAIT', '30'))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '4'))
+GEMINI_RETRY_BASE_SECONDS = float(
+    os.getenv('GEMINI_RETRY_BASE_SECONDS', '1'))
+GEMINI_RETRY_MAX_SECONDS = float(os.getenv('GEMINI_RETRY_MAX_SECONDS', '20'))
+
+# 429 and 503: quota or capacity, worth retrying after a pause
+RETRYABLE_ERRORS = (
+    api_exceptions.TooManyRequests, api_exceptions.ServiceUnavailable)
+
+# Gemini bills a fixed 258 tokens per (small) image
+_IMAGE_TOKENS = 258
+
+# Per-request deadlines: a model that cannot answer in time hands over to
+# the next tier, e.g. '{"gemini-2.5-flash": ["gemini-2.5-flash-lite"]}'.
+GEMINI_FALLBACK_MODELS = json.loads(os.getenv(
+    'GEMINI_FALLBACK_MODELS', json.dumps({
+        'gemini-2.5-flash': ['gemini-2.5-flash-lite'],
+        'gemini-2.0-flash-exp': ['gemini-2.0-flash-lite']
+    })))
+# Share of the remaining budget held back for the fallback tier
+GEMINI_FALLBACK_RESERVE = float(os.getenv('GEMINI_FALLBACK_RESERVE', '0.35'))
+
+# The REST transport (GEMINI_API_ENDPOINT) raises requests' own Timeout
+DEADLINE_ERRORS = (api_exceptions.DeadlineExceeded, TimeoutError,
+                   requests.exceptions.Timeout)
+
+# Put system instructions in an explicit context cache so their tokens are
+# billed at the cached rate. Off by default: creating a cache is a
+# blocking call on first use of each instruction, and the API rejects
+# instructions below its minimum cacheable size (those are skipped here
+# by estimate, and use a plain handle).
+GEMINI_CONTEXT_CACHE = os.getenv(
+    'GEMINI_CONTEXT_CACHE', 'false').lower() == 'true'
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv('GEMINI_CONTEXT_CACHE_TTL', '3600'))
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(
+    os.getenv('GEMINI_CONTEXT_CACHE_MIN_TOKENS', '1024'))
+_CONTEXT_CACHE_REFRESH = 300
+# After a transient failure, use plain handles for a while before retrying
+_CONTEXT_CACHE_RETRY_SECONDS = 60
+
+# Send Gemini traffic elsewhere, e.g. mock_services.py for load tests
+GEMINI_API_ENDPOINT = os.getenv('GEMINI_API_ENDPOINT', '').rstrip('/')
+
+limiter = RateLimiter(
+    limits=GEMINI_MODEL_LIMITS,
+    default={'rpm': GEMINI_RPM, 'tpm': GEMINI_TPM},
+    max_waiting=GEMINI_QUEUE_DEPTH,
+    max_wait=GEMINI_MAX_QUEUE_WAIT)
+
+
+class GeminiBusy(RateLimited):
+    """Gemini is rate limited or overloaded; the caller should retry later."""
+
+
+class GeminiTimeout(Exception):
+    """No model tier answered before the request's deadline."""
+
+
+_lock = threading.Lock()
+_models = {}
+_tier_stats = {}
+_usage_stats = {}
+_context_lock = threading.Lock()
+_context_caches = {}
+_context_unsupported = set()
+_context_retry_at = {}
+_api_key = None
+_stats = {
+    'configure_calls': 0,
+    'models_created': 0,
+    'model_reuses': 0,
+    'setup_seconds': 0.0,
+    'retries': 0,
+    'retry_seconds': 0.0,
+    'retries_exhausted': 0,
+    'context_caches_created': 0,
+    'context_cache_refreshes': 0,
+    'context_cache_unsupported': 0,
+    'context_cache_errors': 0
+}
+
+
+def configure(api_key=None):
+    """Configure the SDK once; returns True when a key is available."""
+    global _api_key
+    api_key = api_key or os.getenv('GEMINI_API_KEY')
+    if not api_key:
+        return False
+    if api_key == _api_key:
+        return True
+    with _lock:
+        if api_key != _api_key:
+            began = time.perf_counter()
+            if GEMINI_API_ENDPOINT:
+                # REST works with plain http://; uploads find their URL
+                # in the discovery document served by the same host
+                genai_clients.GENAI_API_DISCOVERY_URL = (
+                    GEMINI_API_ENDPOINT + '/$discovery/rest')
+                genai.configure(
+                    api_key=api_key, transport='rest',
+                    client_options={'api_endpoint': GEMINI_API_ENDPOINT})
+            else:
+                genai.configure(api_key=api_key)
+            _models.clear()
+            _context_caches.clear()
+            _context_unsupported.clear()
+            _context_retry_at.clear()
+            _api_key = api_key
+            _stats['configure_calls'] += 1
+            _stats['setup_seconds'] += time.perf_counter() - began
+    return True
+
+
+def is_configured():
+    return _api_key is not None
+
+
+def _model_key(name, generation_config, system_instruction):
+    config = json.dumps(generation_config, sort_keys=True, default=str) if (
+        generation_config) else ''
+    return name, config, system_instruction or ''
+
+
+def get_model(name, generation_config=None, system_instruction=None):
+    """Return the shared GenerativeModel for this name/config."""
+    key = _model_key(name, generation_config, system_instruction)
+    if system_instruction and GEMINI_CONTEXT_CACHE and estimate_tokens(
+            system_instruction) >= GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+        model = _context_cached_model(
+            key, name, generation_config, system_instruction)
+        if model is not None:
+            return model
+    model = _models.get(key)
+    if model is not None:
+        with _lock:
+            _stats['model_reuses'] += 1
+        return model
+
+    with _lock:
+        model = _models.get(key)
+        if model is None:
+            began = time.perf_counter()
+            model = genai.GenerativeModel(
+                name,
+                generation_config=generation_config,
+                system_instruction=system_instruction
+            )
+            _models[key] = model
+            _stats['models_created'] += 1
+            _stats['setup_seconds'] += time.perf_counter() - began
+        else:
+            _stats['model_reuses'] += 1
+    return model
+
+
+def _context_cached_model(key, name, generation_config, system_instruction):
+    """Handle bound to a context cache of the system instruction, or None."""
+    entry = _context_caches.get(key)
+    if entry is not None and (
+            entry[1] - time.monotonic() > _CONTEXT_CACHE_REFRESH):
+        with _lock:
+            _stats['model_reuses'] += 1
+        return entry[0]
+    if key in _context_unsupported or (
+            _context_retry_at.get(key, 0) > time.monotonic()):
+        return None
+
+    with _context_lock:
+        entry = _context_caches.get(key)
+        now = time.monotonic()
+        if entry is not None and entry[1] - now > _CONTEXT_CACHE_REFRESH:
+            return entry[0]
+        ttl = datetime.timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL)
+        began = time.perf_counter()
+        try:
+            if entry is not None:
+                # Extend the server-side cache before it expires
+                entry[2].update(ttl=ttl)
+                model, cached = entry[0], entry[2]
+                counter = 'context_cache_refreshes'
+            else:
+                cached = caching.CachedContent.create(
+                    model='models/{}'.format(name),
+                    system_instruction=system_instruction,
+                    ttl=ttl)
+                model = genai.GenerativeModel.from_cached_content(
+                    cached, generation_config=generation_config)
+                counter = 'context_caches_created'
+        except api_exceptions.InvalidArgument as e:
+            # Too small to cache, or the model does not support it
+            print(f"Context caching unavailable for {name}: {e}")
+            _context_caches.pop(key, None)
+            _context_unsupported.add(key)
+            with _lock:
+                _stats['context_cache_unsupported'] += 1
+            return None
+        except Exception as e:
+            print(f"Error creating context cache for {name}: {e}")
+            _context_caches.pop(key, None)
+            _context_retry_at[key] = now + _CONTEXT_CACHE_RETRY_SECONDS
+            with _lock:
+                _stats['context_cache_errors'] += 1
+            return None
+        _context_caches[key] = (model, now + GEMINI_CONTEXT_CACHE_TTL, cached)
+        with _lock:
+            _stats[counter] += 1
+            _stats['setup_seconds'] += time.perf_counter() - began
+    return model
+
+
+def _drop_context_cache(key):
+    """Forget a context cache the server no longer has."""
+    with _context_lock:
+        return _context_caches.pop(key, None) is not None
+
+
+def usage_of(response):
+    """Token counts from a response's usage_metadata (empty if absent)."""
+    usage = getattr(response, 'usage_metadata', None)
+    if not usage:
+        return {}
+    return {
+        'prompt_tokens': getattr(usage, 'prompt_token_count', 0),
+        'cached_tokens': getattr(usage, 'cached_content_token_count', 0),
+        'output_tokens': getattr(usage, 'candidates_token_count', 0),
+        'total_tokens': getattr(usage, 'total_token_count', 0)
+    }
+
+
+def _record_usage(model_name, usage):
+    with _lock:
+        counters = _usage_stats.setdefault(model_name, {
+            'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0,
+            'output_tokens': 0
+        })
+        counters['calls'] += 1
+        for name in ('prompt_tokens', 'cached_tokens', 'output_tokens'):
+            counters[name] += usage.get(name) or 0
+
+
+def estimate_request_tokens(contents):
+    """Rough input-token count of a generate_content payload."""
+    if isinstance(contents, str):
+        return estimate_tokens(contents)
+    if isinstance(contents, (list, tuple)):
+        return sum(estimate_request_tokens(part) for part in contents)
+    if isinstance(contents, dict):
+        # {'role': ..., 'parts': [...]} turns of a multi-turn chat
+        return estimate_request_tokens(contents.get('parts', []))
+    if hasattr(contents, 'size') and hasattr(contents, 'mode'):
+        return _IMAGE_TOKENS
+    return 0
+
+
+def _backoff_delay(attempt):
+    """Exponential backoff with full jitter."""
+    ceiling = min(GEMINI_RETRY_MAX_SECONDS,
+                  GEMINI_RETRY_BASE_SECONDS * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+
+def generate_content(model_name, contents, generation_config=None,
+                     system_instruction=None, deadline=None, **kwargs):
+    """Run generate_content on the shared handle for `model_name`.
+
+    Each attempt first takes a slot from the model's rate limiter. 429 and
+    503 answers are retried with jittered exponential backoff. Raises
+    GeminiBusy when the limiter queue is full or retries run out.
+
+    `deadline` is a time.monotonic() value: queueing and backoff never
+    run past it and the RPC itself is cancelled when it is reached
+    (GeminiTimeout).
+    """
+    model = get_model(model_name, generation_config, system_instruction)
+    estimate = estimate_request_tokens(contents) + (
+        estimate_tokens(system_instruction) if system_instruction else 0)
+    attempt = 0
+    recached = False
+    while True:
+        remaining = _remaining(deadline)
+        try:
+            limiter.acquire(model_name, estimate, max_wait=remaining)
+        except RateLimited as e:
+            raise GeminiBusy(str(e), retry_after=e.retry_after) from e
+
+        call_kwargs = kwargs
+        remaining = _remaining(deadline)
+        if remaining is not None:
+            call_kwargs = dict(kwargs, request_options=dict(
+                kwargs.get('request_options') or {}, timeout=remaining))
+        try:
+            response = model.generate_content(contents, **call_kwargs)
+        except DEADLINE_ERRORS as e:
+            _count_tier(model_name, 'timeouts')
+            raise GeminiTimeout(
+                '{} did not answer in time'.format(model_name)) from e
+        except api_exceptions.NotFound:
+            # Our context cache expired or was deleted server-side
+            if recached or not (system_instruction and _drop_context_cache(
+                    _model_key(model_name, generation_config,
+                               system_instruction))):
+                raise
+            recached = True
+            model = get_model(
+                model_name, generation_config, system_instruction)
+            continue
+        except RETRYABLE_ERRORS as e:
+            limiter.backoff(model_name)
+            delay = _backoff_delay(attempt)
+            remaining = _remaining(deadline)
+            if attempt >= GEMINI_MAX_RETRIES or (
+                    remaining is not None and delay >= remaining):
+                with _lock:
+                    _stats['retries_exhausted'] += 1
+                raise GeminiBusy(
+                    'Gemini is busy, please try again shortly',
+                    retry_after=GEMINI_RETRY_MAX_SECONDS) from e
+            with _lock:
+                _stats['retries'] += 1
+                _stats['retry_seconds'] += delay
+            time.sleep(delay)
+            attempt += 1
+            continue
+        except Exception as e:
+            if not is_deadline_error(e):
+                raise
+            _count_tier(model_name, 'timeouts')
+            raise GeminiTimeout(
+                '{} did not answer in time'.format(model_name)) from e
+
+        # Charge output tokens (and correct the input estimate)
+        if not kwargs.get('stream'):
+            usage = usage_of(response)
+            if usage:
+                _record_usage(model_name, usage)
+            if usage.get('total_tokens'):
+                limiter.adjust(model_name, usage['total_tokens'] - estimate)
+        return response
+
+
+def is_deadline_error(e):
+    """True for a timeout from either transport, however it is wrapped."""
+    while e is not None:
+        if isinstance(e, DEADLINE_ERRORS):
+            return True
+        # gRPC errors the SDK did not map (e.g. raised mid-stream)
+        code = getattr(e, 'code', None)
+        if callable(code) and getattr(
+                code(), 'name', None) == 'DEADLINE_EXCEEDED':
+            return True
+        e = e.__cause__ or e.__context__
+    return False
+
+
+def _remaining(deadline):
+    """Seconds left before `deadline`; raises GeminiTimeout if none."""
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise GeminiTimeout('Request deadline exceeded')
+    return remaining
+
+
+def _count_tier(model_name, name):
+    with _lock:
+        counters = _tier_stats.setdefault(
+            model_name, {'answered': 0, 'timeouts': 0, 'fallbacks': 0})
+        counters[name] += 1
+
+
+def model_tiers(model_name):
+    """The model followed by its faster/cheaper fallbacks."""
+    return [model_name] + list(GEMINI_FALLBACK_MODELS.get(model_name, []))
+
+
+def generate_with_fallback(model_name, contents, deadline=None, **kwargs):
+    """generate_content that falls back to cheaper tiers; (response, model).
+
+    Every tier but the last gets the remaining budget minus
+    GEMINI_FALLBACK_RESERVE of it, so if it times out or is rate limited
+    the next tier still has time to answer. Without a deadline, only
+    GeminiBusy moves the call to the next tier.
+    """
+    tiers = model_tiers(model_name)
+    for i, name in enumerate(tiers):
+        last = i == len(tiers) - 1
+        budget_deadline = deadline
+        if deadline is not None and not last:
+            remaining = _remaining(deadline)
+            budget_deadline = time.monotonic() + remaining * (
+                1 - GEMINI_FALLBACK_RESERVE)
+        try:
+            response = generate_content(
+                name, contents, deadline=budget_deadline, **kwargs)
+        except (GeminiTimeout, GeminiBusy):
+            if last:
+                raise
+            _count_tier(name, 'fallbacks')
+            continue
+        _count_tier(name, 'answered')
+        return response, name
+
+
+def _ping(names):
+    for name in names:
+        try:
+            genai.get_model('models/{}'.format(name))
+        except Exception as e:
+            print(f"Gemini warm-up failed for {name}: {e}")
+
+
+def warm_up(model_names, ping=True):
+    """Create handles for `model_names` now instead of on first request.
+
+    With `ping`, a background thread also fetches each model's metadata so
+    the transport connection is open before real traffic arrives.
+    """
+    if not configure():
+        return False
+    for name in model_names:
+        get_model(name)
+    # Build the transport now rather than inside the first request
+    began = time.perf_counter()
+    genai_clients.get_default_generative_client()
+    with _lock:
+        _stats['setup_seconds'] += time.perf_counter() - began
+    if ping:
+        threading.Thread(
+            target=_ping, args=(list(model_names),), daemon=True).start()
+    return True
+
+
+def get_stats():
+    """Setup-cost and retry counters for this worker."""
+    with _lock:
+        stats = dict(_stats)
+    created = stats['models_created'] + stats['configure_calls']
+    stats['setup_seconds'] = round(stats['setup_seconds'], 4)
+    stats['retry_seconds'] = round(stats['retry_seconds'], 3)
+    stats['avg_setup_ms'] = round(
+        stats['setup_seconds'] * 1000 / created, 3) if created else 0.0
+    stats['cached_models'] = len(_models)
+    with _lock:
+        stats['tiers'] = {name: dict(c) for name, c in _tier_stats.items()}
+        stats['usage'] = {name: dict(c) for name, c in _usage_stats.items()}
+    for counters in stats['usage'].values():
+        counters['avg_prompt_tokens'] = round(
+            counters['prompt_tokens'] / counters['calls'], 1)
+    stats['context_caches'] = len(_context_caches)
+    return stats
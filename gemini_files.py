@@ -0,0 +1,261 @@
+"""
+Gemini media parts
+Small clips go inline; larger files are uploaded once per content hash
+
+An upload through the Files API is an extra round trip before the actual
+request, which dominates the latency of short clips. Clips up to
+GEMINI_INLINE_MAX_BYTES are therefore sent inline with the request.
+Larger ones are uploaded, and the remote handle is kept in SQLite under
+the upload's SHA-256 so re-transcribing the same recording (in any
+worker) skips the upload. A background reaper deletes remote files that
+have not been used for GEMINI_FILE_TTL_SECONDS.
+"""
+
+import os
+import threading
+import time
+from functools import partial
+
+import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
+
+import singleflight
+from database import get_db_connection
+
+# Inline data counts towards Gemini's 20 MB request limit
+GEMINI_INLINE_MAX_BYTES = int(
+    os.getenv('GEMINI_INLINE_MAX_BYTES', str(4 * 1024 * 1024)))
+GEMINI_FILE_TTL_SECONDS = int(
+    os.getenv('GEMINI_FILE_TTL_SECONDS', str(6 * 3600)))
+GEMINI_FILE_REAP_SECONDS = int(os.getenv('GEMINI_FILE_REAP_SECONDS', '600'))
+
+# Gemini deletes uploads after 48 hours; stop handing them out before that
+_REMOTE_LIFETIME = 48 * 3600 - 3600
+
+# A reused handle whose remote file has gone away
+STALE_FILE_ERRORS = (api_exceptions.NotFound, api_exceptions.PermissionDenied)
+
+INLINE = 'inline'
+UPLOAD = 'upload'
+REUSE = 'reuse'
+
+_SIZE_BUCKETS = [
+    (256 * 1024, '<256KB'),
+    (1024 * 1024, '<1MB'),
+    (4 * 1024 * 1024, '<4MB'),
+    (16 * 1024 * 1024, '<16MB')
+]
+
+_lock = threading.Lock()
+_reaper = None
+_latency = {}
+_stats = {
+    'inline': 0,
+    'uploads': 0,
+    'reuses': 0,
+    'upload_seconds': 0.0,
+    'stale_handles': 0,
+    'reaped': 0,
+    'reap_errors': 0
+}
+
+
+def _count(name, amount=1):
+    with _lock:
+        _stats[name] += amount
+
+
+def size_bucket(size):
+    for limit, label in _SIZE_BUCKETS:
+        if size < limit:
+            return label
+    return '>=16MB'
+
+
+def _lookup(digest):
+    """The live remote file for a content hash, or None."""
+    now = time.time()
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT file_name, uri, mime_type FROM gemini_files
+            WHERE content_hash = ? AND last_used >= ? AND created_at >= ?
+        ''', (digest, now - GEMINI_FILE_TTL_SECONDS, now - _REMOTE_LIFETIME))
+        row = cursor.fetchone()
+        if row is not None:
+            cursor.execute(
+                'UPDATE gemini_files SET last_used = ? WHERE content_hash = ?',
+                (now, digest))
+            conn.commit()
+        conn.close()
+        return dict(row) if row else None
+    except Exception as e:
+        print(f"Error looking up Gemini file: {e}")
+        return None
+
+
+def _upload(upload, mime_type):
+    began = time.perf_counter()
+    with upload.open() as f:
+        remote = genai.upload_file(f, mime_type=mime_type)
+    _count('upload_seconds', time.perf_counter() - began)
+    _count('uploads')
+    handle = {
+        'file_name': remote.name,
+        'uri': remote.uri,
+        'mime_type': remote.mime_type or mime_type
+    }
+    now = time.time()
+    try:
+        conn = get_db_connection()
+        conn.execute('''
+            INSERT OR REPLACE INTO gemini_files
+            (content_hash, file_name, uri, mime_type, size_bytes, created_at,
+             last_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (upload.digest, handle['file_name'], handle['uri'],
+              handle['mime_type'], upload.size, now, now))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"Error storing Gemini file handle: {e}")
+    return handle
+
+
+def media_part(upload, mime_type, mode=None):
+    """Gemini content part for an UploadBuffer; returns (part, mode).
+
+    ``mode`` is ``'inline'``, ``'upload'`` or ``'reuse'`` (an earlier
+    upload of the same bytes). Pass ``mode`` to force inline or upload.
+    """
+    start_reaper()
+    if mode == INLINE or (
+            mode is None and upload.size <= GEMINI_INLINE_MAX_BYTES):
+        _count('inline')
+        if upload.data is not None:
+            data = upload.data
+        else:
+            with upload.open() as f:
+                data = f.read()
+        return {'mime_type': mime_type, 'data': data}, INLINE
+
+    handle = _lookup(upload.digest) if mode is None else None
+    if handle is None:
+        # Concurrent requests for the same recording share one upload
+        handle, role = singleflight.do(
+            'gemini-file:' + upload.digest,
+            partial(_upload, upload, mime_type),
+            lookup=partial(_lookup, upload.digest))
+        mode = UPLOAD if role == singleflight.LEADER else REUSE
+    else:
+        mode = REUSE
+    if mode == REUSE:
+        _count('reuses')
+    return {
+        'file_data': {
+            'mime_type': handle['mime_type'],
+            'file_uri': handle['uri']
+        }
+    }, mode
+
+
+def forget(digest):
+    """Drop a content hash's handle (and its remote file, if still there)."""
+    _count('stale_handles')
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT file_name FROM gemini_files WHERE content_hash = ?',
+            (digest,))
+        row = cursor.fetchone()
+        cursor.execute(
+            'DELETE FROM gemini_files WHERE content_hash = ?', (digest,))
+        conn.commit()
+        conn.close()
+        if row is not None:
+            genai.delete_file(row['file_name'])
+    except Exception as e:
+        print(f"Error forgetting Gemini file: {e}")
+
+
+def reap():
+    """Delete remote files that expired here; returns how many."""
+    now = time.time()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT content_hash, file_name FROM gemini_files
+        WHERE last_used < ? OR created_at < ?
+    ''', (now - GEMINI_FILE_TTL_SECONDS, now - _REMOTE_LIFETIME))
+    rows = cursor.fetchall()
+    reaped = 0
+    for row in rows:
+        # Claim the row first so only one worker deletes each file
+        cursor.execute(
+            'DELETE FROM gemini_files WHERE content_hash = ? '
+            'AND file_name = ?', (row['content_hash'], row['file_name']))
+        conn.commit()
+        if cursor.rowcount != 1:
+            continue
+        try:
+            genai.delete_file(row['file_name'])
+            reaped += 1
+        except api_exceptions.NotFound:
+            pass
+        except Exception as e:
+            _count('reap_errors')
+            print(f"Error deleting Gemini file: {e}")
+    conn.close()
+    _count('reaped', reaped)
+    return reaped
+
+
+def _reap_forever():
+    while True:
+        time.sleep(GEMINI_FILE_REAP_SECONDS)
+        try:
+            reap()
+        except Exception as e:
+            print(f"Error reaping Gemini files: {e}")
+
+
+def start_reaper():
+    """Start this worker's reaper thread unless it is already running.
+
+    Called at app start-up, so files uploaded by other workers are reaped
+    even where nothing has been uploaded yet.
+    """
+    global _reaper
+    with _lock:
+        if _reaper is None:
+            _reaper = threading.Thread(target=_reap_forever, daemon=True)
+            _reaper.start()
+
+
+def record_latency(mode, size, seconds):
+    """Add one request's end-to-end time to the per-mode, per-size stats."""
+    key = (mode, size_bucket(size))
+    with _lock:
+        entry = _latency.setdefault(
+            key, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        entry['count'] += 1
+        entry['total_seconds'] += seconds
+        entry['max_seconds'] = max(entry['max_seconds'], seconds)
+
+
+def get_stats():
+    with _lock:
+        stats = dict(_stats, upload_seconds=round(_stats['upload_seconds'], 3))
+        latency = {}
+        for (mode, bucket), entry in sorted(_latency.items()):
+            latency.setdefault(mode, {})[bucket] = {
+                'count': entry['count'],
+                'avg_ms': round(
+                    entry['total_seconds'] / entry['count'] * 1000, 1),
+                'max_ms': round(entry['max_seconds'] * 1000, 1)
+            }
+        stats['latency'] = latency
+        stats['reaper_running'] = _reaper is not None
+    return stats
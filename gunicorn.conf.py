@@ -0,0 +1,20 @@
+"""
+Gunicorn settings
+Loaded by the Procfile / render.yaml start command (gunicorn -c)
+
+Chat, progressive upload and batch analysis stream one response for
+minutes. A sync worker is killed as soon as a single request runs past
+--timeout, so these run threaded workers instead: their main loop keeps
+heartbeating while a thread streams, and --timeout only catches a worker
+that is really stuck.
+"""
+
+import os
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', '5000'))
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+# Let in-flight streams finish on redeploys
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '120'))
@@ -0,0 +1,699 @@
+"""
+Mock external services
+Local stand-in for the Gemini, LightX and Replicate APIs used by app.py
+
+Load-test the app without API keys or quota:
+
+    python mock_services.py --port 8090 --error-rate 0.02
+    GEMINI_API_KEY=mock GEMINI_API_ENDPOINT=http://localhost:8090 \\
+    LIGHTX_API_URL=http://localhost:8090/external/api/v1/outpainting \\
+    REPLICATE_API_KEY=mock REPLICATE_BASE_URL=http://localhost:8090 \\
+    gunicorn app:app
+
+Modes:
+    mock    synthetic answers with the configured latency and errors
+    record  forward every call to the real APIs and save the responses
+            in --cassettes (the app's own API keys are passed through)
+    replay  serve saved responses, with their recorded timing unless
+            --latency is given; calls never recorded get a 404
+
+Latency specs are ``fixed:MS``, ``uniform:LO_MS:HI_MS`` or
+``lognormal:MEDIAN_MS:SIGMA``. --latency/--error-rate apply to every
+service; --config sets them per service, e.g.
+'{"gemini": {"latency": "lognormal:1500:0.6", "error_rate": 0.1}}'.
+
+Uploaded files, context caches and predictions live in memory, so run a
+single process (it is threaded). Test scripts can run it in-process with
+start() and app_env().
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import requests
+from flask import Flask, Response, jsonify, request, stream_with_context
+
+UPSTREAMS = {
+    'gemini': 'https://generativelanguage.googleapis.com',
+    'lightx': 'https://api.lightxeditor.com',
+    'replicate': 'https://api.replicate.com'
+}
+
+DEFAULT_SETTINGS = {
+    'gemini': {
+        'latency': 'lognormal:800:0.5',
+        'error_rate': 0.0,
+        'errors': [429, 503],
+        # Delay between streamed chunks and words per chunk
+        'stream_chunk_ms': 80,
+        'stream_chunk_words': 8,
+        'answer_words': 120
+    },
+    'lightx': {
+        'latency': 'lognormal:4000:0.4',
+        'error_rate': 0.0,
+        'errors': [500, 503]
+    },
+    'replicate': {
+        'latency': 'lognormal:6000:0.4',
+        'error_rate': 0.0,
+        'errors': [429, 500]
+    }
+}
+
+_GEMINI_STATUS = {
+    400: 'INVALID_ARGUMENT',
+    404: 'NOT_FOUND',
+    429: 'RESOURCE_EXHAUSTED',
+    500: 'INTERNAL',
+    503: 'UNAVAILABLE'
+}
+
+_WORDS = (
+    'the answer covers each point in order with a short explanation and '
+    'an example where it helps the reader follow along').split()
+
+app = Flask(__name__)
+
+settings = {name: dict(values) for name, values in DEFAULT_SETTINGS.items()}
+mode = 'mock'
+cassette_dir = 'cassettes'
+recorded_timing = False
+
+# Stands in for the mock's own URL inside cassettes
+_HOST = b'{mock}'
+
+_lock = threading.Lock()
+_files = {}
+_cached_contents = {}
+_predictions = {}
+_stats = {'requests': 0, 'errors_injected': 0, 'recorded': 0,
+          'replayed': 0, 'replay_misses': 0}
+
+
+class Latency:
+    """A latency distribution parsed from a spec string; samples seconds."""
+
+    def __init__(self, spec):
+        kind, *args = spec.split(':')
+        self.kind = kind
+        self.args = [float(a) for a in args]
+        if kind not in ('fixed', 'uniform', 'lognormal'):
+            raise ValueError('Unknown latency distribution: {}'.format(spec))
+
+    def sample(self):
+        if self.kind == 'fixed':
+            ms = self.args[0]
+        elif self.kind == 'uniform':
+            ms = random.uniform(self.args[0], self.args[1])
+        else:
+            ms = random.lognormvariate(math.log(self.args[0]), self.args[1])
+        return ms / 1000.0
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def _now_iso(offset_seconds=0):
+    moment = datetime.now(timezone.utc) + timedelta(seconds=offset_seconds)
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _base_url():
+    return request.host_url.rstrip('/')
+
+
+def _service(path):
+    if path.startswith('/external/'):
+        return 'lightx'
+    if path.startswith('/v1/'):
+        return 'replicate'
+    return 'gemini'
+
+
+def _error_response(service, status):
+    message = 'Injected {} error from mock {}'.format(status, service)
+    if service == 'gemini':
+        body = {'error': {
+            'code': status, 'message': message,
+            'status': _GEMINI_STATUS.get(status, 'UNKNOWN')}}
+    elif service == 'replicate':
+        body = {'detail': message, 'status': status}
+    else:
+        body = {'message': message}
+    return jsonify(body), status
+
+
+@app.before_request
+def simulate():
+    """Latency and injected errors (mock mode), or record/replay."""
+    _count('requests')
+    service = _service(request.path)
+    if request.path.startswith('/mock/') or request.path == '/stats':
+        return None
+    if mode == 'record':
+        return _record(service)
+    if mode == 'replay':
+        return _replay(service)
+
+    config = settings[service]
+    if random.random() < config['error_rate']:
+        _count('errors_injected')
+        # Errors come back quicker than answers
+        time.sleep(Latency(config['latency']).sample() / 4)
+        return _error_response(service, random.choice(config['errors']))
+    if ':streamGenerateContent' not in request.path:
+        # Streams pace themselves chunk by chunk
+        time.sleep(Latency(config['latency']).sample())
+    return None
+
+
+# ---------------------------------------------------------------------------
+# Record / replay
+# ---------------------------------------------------------------------------
+
+def _cassette_path(service):
+    """Cassette for this call, keyed by method, path, query and body.
+
+    The API key and the mock's own host are left out, so a recording can
+    be replayed with other keys on another port.
+    """
+    query = sorted((k, v) for k, v in request.args.items(multi=True)
+                   if k != 'key')
+    body = request.get_data().replace(_base_url().encode('utf-8'), _HOST)
+    digest = hashlib.sha256(json.dumps(
+        [request.method, request.path, query], sort_keys=True
+    ).encode('utf-8') + b'\x00' + body).hexdigest()
+    return os.path.join(cassette_dir, service, digest + '.json')
+
+
+def _record(service):
+    upstream = UPSTREAMS[service]
+    body = request.get_data().replace(
+        _base_url().encode('utf-8'), upstream.encode('utf-8'))
+    headers = {k: v for k, v in request.headers.items()
+               if k.lower() not in ('host', 'content-length',
+                                    'accept-encoding', 'connection')}
+    base = _base_url()
+    began = time.monotonic()
+    upstream_response = requests.request(
+        request.method, upstream + request.path,
+        params=list(request.args.items(multi=True)), data=body,
+        headers=headers, stream=True, timeout=300)
+    response_headers = {
+        k: v.replace(upstream, base)
+        for k, v in upstream_response.headers.items()
+        if k.lower() in ('content-type', 'location', 'x-goog-upload-url',
+                         'x-goog-upload-status', 'retry-after')
+    }
+    path = _cassette_path(service)
+    status = upstream_response.status_code
+
+    def save(chunks):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({
+                'method': request.method, 'path': request.path,
+                'status': status,
+                'headers': {k: v.replace(base, _HOST.decode('ascii'))
+                            for k, v in response_headers.items()},
+                'chunks': [[offset, base64.b64encode(
+                    data.replace(base.encode('utf-8'), _HOST)
+                ).decode('ascii')] for offset, data in chunks]
+            }, f)
+        _count('recorded')
+
+    if ':streamGenerateContent' in request.path:
+        # Forward chunks as they arrive, keeping their timing
+        def generate():
+            chunks = []
+            for data in upstream_response.iter_content(chunk_size=None):
+                chunks.append((time.monotonic() - began, data))
+                yield data
+            save(chunks)
+        return Response(stream_with_context(generate()), status=status,
+                        headers=response_headers)
+
+    data = upstream_response.content.replace(
+        upstream.encode('utf-8'), base.encode('utf-8'))
+    save([(time.monotonic() - began, data)])
+    return Response(data, status=status, headers=response_headers)
+
+
+def _replay(service):
+    path = _cassette_path(service)
+    if not os.path.exists(path):
+        _count('replay_misses')
+        return jsonify({'error': {
+            'code': 404, 'status': 'NOT_FOUND',
+            'message': 'No recording for {} {}'.format(
+                request.method, request.path)}}), 404
+    with open(path) as f:
+        recording = json.load(f)
+    _count('replayed')
+    base = _base_url()
+    chunks = [(offset, base64.b64decode(data).replace(
+        _HOST, base.encode('utf-8')))
+        for offset, data in recording['chunks']]
+    headers = {k: v.replace(_HOST.decode('ascii'), base)
+               for k, v in recording['headers'].items()}
+    latency = None if recorded_timing else Latency(
+        settings[service]['latency'])
+
+    def generate():
+        began = time.monotonic()
+        for i, (offset, data) in enumerate(chunks):
+            if latency is None:
+                time.sleep(max(0.0, offset - (time.monotonic() - began)))
+            elif i == 0:
+                time.sleep(latency.sample())
+            yield data
+
+    return Response(stream_with_context(generate()),
+                    status=recording['status'], headers=headers)
+
+
+# ---------------------------------------------------------------------------
+# Gemini
+# ---------------------------------------------------------------------------
+
+def _estimate_tokens(value):
+    return len(json.dumps(value).encode('utf-8')) // 4 + 1
+
+
+def _last_text(contents):
+    for content in reversed(contents or []):
+        for part in reversed(content.get('parts', [])):
+            if part.get('text'):
+                return part['text']
+    return ''
+
+
+def _answer(body, words):
+    """Deterministic answer text for a request body."""
+    prompt = ' '.join(_last_text(body.get('contents')).split())
+    seed = int(hashlib.sha256(
+        json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest(), 16)
+    rng = random.Random(seed)
+    filler = ' '.join(rng.choice(_WORDS) for _ in range(words))
+    return 'Mock answer to "{}": {}.'.format(prompt[:60], filler)
+
+
+def _usage(body, text):
+    prompt_tokens = _estimate_tokens(body.get('contents'))
+    usage = {
+        'promptTokenCount': prompt_tokens,
+        'candidatesTokenCount': len(text.encode('utf-8')) // 4 + 1
+    }
+    cached = _cached_contents.get(body.get('cachedContent'))
+    if cached is not None:
+        cached_tokens = cached['usageMetadata']['totalTokenCount']
+        usage['cachedContentTokenCount'] = cached_tokens
+        usage['promptTokenCount'] += cached_tokens
+    usage['totalTokenCount'] = (
+        usage['promptTokenCount'] + usage['candidatesTokenCount'])
+    return usage
+
+
+def _candidate(text, finish=True):
+    candidate = {
+        'content': {'parts': [{'text': text}], 'role': 'model'},
+        'index': 0
+    }
+    if finish:
+        candidate['finishReason'] = 'STOP'
+    return candidate
+
+
+@app.route('/$discovery/rest', methods=['GET'])
+def gemini_discovery():
+    """Just enough of the discovery document for genai.upload_file()."""
+    return jsonify({
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'generativelanguage:v1beta',
+        'name': 'generativelanguage',
+        'version': 'v1beta',
+        'rootUrl': _base_url() + '/',
+        'servicePath': '',
+        'baseUrl': _base_url() + '/',
+        'batchPath': 'batch',
+        'parameters': {
+            'key': {'type': 'string', 'location': 'query'},
+            'alt': {'type': 'string', 'location': 'query',
+                    'default': 'json'}
+        },
+        'schemas': {
+            'CreateFileRequest': {
+                'id': 'CreateFileRequest', 'type': 'object',
+                'properties': {'file': {'type': 'object'}}
+            },
+            'CreateFileResponse': {
+                'id': 'CreateFileResponse', 'type': 'object',
+                'properties': {'file': {'type': 'object'}}
+            }
+        },
+        'resources': {
+            'media': {
+                'methods': {
+                    'upload': {
+                        'id': 'generativelanguage.media.upload',
+                        'path': 'v1beta/files',
+                        'flatPath': 'v1beta/files',
+                        'httpMethod': 'POST',
+                        'parameters': {},
+                        'parameterOrder': [],
+                        'request': {'$ref': 'CreateFileRequest'},
+                        'response': {'$ref': 'CreateFileResponse'},
+                        'supportsMediaUpload': True,
+                        'mediaUpload': {
+                            'accept': ['*/*'],
+                            'maxSize': '2147483648',
+                            'protocols': {
+                                'simple': {
+                                    'multipart': True,
+                                    'path': '/upload/v1beta/files'
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    })
+
+
+@app.route('/v1beta/models/<path:action>', methods=['POST'])
+def gemini_generate(action):
+    model, _, method = action.partition(':')
+    body = request.get_json(force=True, silent=True) or {}
+    config = settings['gemini']
+    text = _answer(body, config['answer_words'])
+
+    if method == 'generateContent':
+        return jsonify({
+            'candidates': [_candidate(text)],
+            'usageMetadata': _usage(body, text),
+            'modelVersion': model
+        })
+    if method == 'countTokens':
+        return jsonify({'totalTokens': _estimate_tokens(body)})
+    if method != 'streamGenerateContent':
+        return _error_response('gemini', 404)
+
+    words = text.split(' ')
+    step = config['stream_chunk_words']
+    pieces = [' '.join(words[i:i + step]) + (' ' if i + step < len(words)
+                                             else '')
+              for i in range(0, len(words), step)]
+    sse = request.args.get('alt') == 'sse'
+    latency = Latency(config['latency'])
+
+    def generate():
+        # Time to first token, then a steady trickle of chunks
+        time.sleep(latency.sample())
+        for i, piece in enumerate(pieces):
+            last = i == len(pieces) - 1
+            chunk = {'candidates': [_candidate(piece, finish=last)],
+                     'modelVersion': model}
+            if last:
+                chunk['usageMetadata'] = _usage(body, text)
+            if sse:
+                yield 'data: {}\r\n\r\n'.format(json.dumps(chunk))
+            else:
+                # The REST transport reads one JSON array incrementally
+                yield ('[' if i == 0 else ',\r\n') + json.dumps(chunk)
+            if not last:
+                time.sleep(config['stream_chunk_ms'] / 1000.0)
+        if not sse:
+            yield ']'
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream' if sse else 'application/json')
+
+
+def _file_resource(file_id, mime_type, size):
+    return {
+        'name': 'files/{}'.format(file_id),
+        'mimeType': mime_type or 'application/octet-stream',
+        'sizeBytes': str(size),
+        'createTime': _now_iso(),
+        'updateTime': _now_iso(),
+        'expirationTime': _now_iso(48 * 3600),
+        'sha256Hash': '',
+        'uri': '{}/v1beta/files/{}'.format(_base_url(), file_id),
+        'state': 'ACTIVE'
+    }
+
+
+@app.route('/upload/v1beta/files', methods=['POST', 'PUT'])
+def gemini_upload():
+    """Simple, multipart and resumable uploads (content is discarded)."""
+    if request.args.get('uploadType') == 'resumable' and not request.args.get(
+            'upload_id'):
+        upload_id = uuid.uuid4().hex
+        location = '{}/upload/v1beta/files?uploadType=resumable&' \
+            'upload_id={}'.format(_base_url(), upload_id)
+        with _lock:
+            _files['pending/' + upload_id] = request.headers.get(
+                'X-Upload-Content-Type')
+        return Response('', status=200, headers={
+            'Location': location, 'X-Goog-Upload-URL': location})
+
+    upload_id = request.args.get('upload_id')
+    with _lock:
+        mime_type = _files.pop('pending/' + upload_id, None) if (
+            upload_id) else request.mimetype
+    file_id = uuid.uuid4().hex[:12]
+    resource = _file_resource(
+        file_id, mime_type, request.content_length or 0)
+    with _lock:
+        _files[resource['name']] = resource
+    return jsonify({'file': resource})
+
+
+@app.route('/v1beta/files/<file_id>', methods=['GET', 'DELETE'])
+def gemini_file(file_id):
+    name = 'files/{}'.format(file_id)
+    with _lock:
+        resource = _files.get(name)
+        if resource is not None and request.method == 'DELETE':
+            del _files[name]
+    if resource is None:
+        return _error_response('gemini', 404)
+    return jsonify(resource if request.method == 'GET' else {})
+
+
+@app.route('/v1beta/cachedContents', methods=['POST'])
+def gemini_create_cached_content():
+    body = request.get_json(force=True, silent=True) or {}
+    name = 'cachedContents/{}'.format(uuid.uuid4().hex[:12])
+    ttl = float(str(body.get('ttl', '3600s')).rstrip('s'))
+    resource = {
+        'name': name,
+        'model': body.get('model'),
+        'createTime': _now_iso(),
+        'updateTime': _now_iso(),
+        'expireTime': _now_iso(ttl),
+        'usageMetadata': {'totalTokenCount': _estimate_tokens(
+            [body.get('systemInstruction'), body.get('contents')])}
+    }
+    with _lock:
+        _cached_contents[name] = resource
+    return jsonify(resource)
+
+
+@app.route('/v1beta/cachedContents/<cache_id>',
+           methods=['GET', 'PATCH', 'DELETE'])
+def gemini_cached_content(cache_id):
+    name = 'cachedContents/{}'.format(cache_id)
+    with _lock:
+        resource = _cached_contents.get(name)
+        if resource is not None and request.method == 'DELETE':
+            del _cached_contents[name]
+    if resource is None:
+        return _error_response('gemini', 404)
+    if request.method == 'PATCH':
+        body = request.get_json(force=True, silent=True) or {}
+        if 'ttl' in body:
+            resource['expireTime'] = _now_iso(
+                float(str(body['ttl']).rstrip('s')))
+        resource['updateTime'] = _now_iso()
+    return jsonify(resource if request.method != 'DELETE' else {})
+
+
+# ---------------------------------------------------------------------------
+# LightX, Replicate and their images
+# ---------------------------------------------------------------------------
+
+@app.route('/external/api/v1/outpainting', methods=['POST'])
+def lightx_outpainting():
+    body = request.get_json(force=True, silent=True) or {}
+    digest = hashlib.sha256(
+        json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return jsonify({
+        'statusCode': 2000,
+        'message': 'SUCCESS',
+        'output_url': '{}/mock/images/{}.png'.format(_base_url(), digest)
+    })
+
+
+def _prediction_view(prediction):
+    view = dict(prediction)
+    ready_at = view.pop('ready_at')
+    if time.monotonic() >= ready_at:
+        view.update(status='succeeded', completed_at=_now_iso(),
+                    output='{}/mock/images/{}.png'.format(
+                        _base_url(), prediction['id']))
+    else:
+        view['status'] = 'processing'
+    return view
+
+
+@app.route('/v1/predictions', methods=['POST'])
+@app.route('/v1/models/<owner>/<name>/predictions', methods=['POST'])
+@app.route('/v1/deployments/<owner>/<name>/predictions', methods=['POST'])
+def replicate_create_prediction(owner=None, name=None):
+    body = request.get_json(force=True, silent=True) or {}
+    prediction_id = uuid.uuid4().hex[:20]
+    prediction = {
+        'id': prediction_id,
+        'model': '{}/{}'.format(owner, name) if owner else 'mock/model',
+        'version': body.get('version'),
+        'input': body.get('input', {}),
+        'logs': '',
+        'error': None,
+        'created_at': _now_iso(),
+        'urls': {
+            'get': '{}/v1/predictions/{}'.format(_base_url(), prediction_id),
+            'cancel': '{}/v1/predictions/{}/cancel'.format(
+                _base_url(), prediction_id)
+        },
+        # before_request already waited out the latency
+        'ready_at': time.monotonic()
+    }
+    with _lock:
+        _predictions[prediction_id] = prediction
+    return jsonify(_prediction_view(prediction)), 201
+
+
+@app.route('/v1/predictions/<prediction_id>', methods=['GET'])
+def replicate_get_prediction(prediction_id):
+    with _lock:
+        prediction = _predictions.get(prediction_id)
+    if prediction is None:
+        return jsonify({'detail': 'Not found.', 'status': 404}), 404
+    return jsonify(_prediction_view(prediction))
+
+
+@app.route('/v1/models/<owner>/<name>/versions/<version_id>',
+           methods=['GET'])
+def replicate_get_version(owner, name, version_id):
+    return jsonify({
+        'id': version_id,
+        'created_at': _now_iso(),
+        'cog_version': '0.9.0',
+        'openapi_schema': {'components': {'schemas': {
+            'Output': {'type': 'string', 'format': 'uri'}}}}
+    })
+
+
+@app.route('/mock/images/<name>', methods=['GET'])
+def mock_image(name):
+    """A small solid-colour PNG standing in for generated images."""
+    from PIL import Image
+
+    digest = hashlib.sha256(name.encode('utf-8')).digest()
+    out = io.BytesIO()
+    Image.new('RGB', (256, 256), tuple(digest[:3])).save(out, 'PNG')
+    return Response(out.getvalue(), mimetype='image/png')
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    with _lock:
+        return jsonify(dict(
+            _stats, mode=mode, files=len(_files),
+            cached_contents=len(_cached_contents),
+            predictions=len(_predictions), settings=settings))
+
+
+def app_env(url):
+    """Environment variables that point app.py's services at `url`."""
+    return {
+        'GEMINI_API_KEY': 'mock',
+        'GEMINI_API_ENDPOINT': url,
+        'LIGHTX_API_KEY': 'mock',
+        'LIGHTX_API_URL': url + '/external/api/v1/outpainting',
+        'REPLICATE_API_KEY': 'mock',
+        'REPLICATE_BASE_URL': url
+    }
+
+
+def start(host='127.0.0.1', port=0, latency='fixed:20'):
+    """Serve the mock from a background thread; returns its base URL.
+
+    For test scripts that run app.py in-process: put ``app_env(url)`` in
+    os.environ before importing app.
+    """
+    from werkzeug.serving import make_server
+
+    for values in settings.values():
+        values['latency'] = latency
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://{}:{}'.format(host, server.server_port)
+
+
+def main():
+    global mode, cassette_dir, recorded_timing
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--mode', choices=('mock', 'record', 'replay'),
+                        default='mock')
+    parser.add_argument('--cassettes', default='cassettes')
+    parser.add_argument('--latency', help='Latency spec for all services')
+    parser.add_argument('--error-rate', type=float,
+                        help='Share of calls failing with an API error')
+    parser.add_argument('--config', default='{}',
+                        help='Per-service settings as JSON')
+    parser.add_argument('--seed', type=int, help='Seed latency and errors')
+    args = parser.parse_args()
+
+    for name, values in settings.items():
+        if args.latency:
+            values['latency'] = args.latency
+        if args.error_rate is not None:
+            values['error_rate'] = args.error_rate
+        values.update(json.loads(args.config).get(name, {}))
+        # Fail at start-up, not on the first request
+        Latency(values['latency'])
+    if args.seed is not None:
+        random.seed(args.seed)
+    mode = args.mode
+    cassette_dir = args.cassettes
+    recorded_timing = args.latency is None
+
+    print("Mock services ({}) on http://{}:{}".format(
+        mode, args.host, args.port))
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
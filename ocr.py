@@ -0,0 +1,202 @@
+"""
+OCR pipeline
+NumPy pre-processing and banded, multi-core Tesseract
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageOps
+import pytesseract
+
+import ocr_pool
+
+# Tesseract is most accurate with text lines roughly this many pixels tall.
+OCR_TARGET_LINE_HEIGHT = int(os.getenv('OCR_TARGET_LINE_HEIGHT', '40'))
+OCR_BAND_HEIGHT = int(os.getenv('OCR_BAND_HEIGHT', '1000'))
+OCR_BAND_OVERLAP = int(os.getenv('OCR_BAND_OVERLAP', '60'))
+OCR_WORKERS = int(os.getenv('OCR_WORKERS', str(os.cpu_count() or 1)))
+# Larger inputs (and upscales) are capped here to bound memory per page
+OCR_MAX_PIXELS = int(os.getenv('OCR_MAX_PIXELS', str(16 * 1000 * 1000)))
+
+# Bands already run in parallel; stop each tesseract process (or pool
+# worker) from also spawning one OpenMP thread per core.
+os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+
+_MIN_SCALE, _MAX_SCALE = 0.25, 3.0
+_ocr_pool = None
+
+
+def _get_ocr_pool():
+    """Lazily create the thread pool that drives tesseract subprocesses."""
+    global _ocr_pool
+    if _ocr_pool is None:
+        _ocr_pool = ThreadPoolExecutor(max_workers=OCR_WORKERS)
+    return _ocr_pool
+
+
+def adaptive_binarize(gray, radius=15, sensitivity=0.15):
+    """Bradley-Roth local thresholding; text becomes 0, paper 255.
+
+    Every intermediate stays uint8, so a 12 MP page needs a few copies of
+    the grey image rather than float64 integral images.
+    """
+    import cv2
+
+    size = 2 * radius + 1
+    mean = cv2.boxFilter(gray, -1, (size, size),
+                         borderType=cv2.BORDER_REPLICATE)
+    threshold = cv2.convertScaleAbs(mean, alpha=1.0 - sensitivity)
+    return cv2.compare(gray, threshold, cv2.CMP_GE)
+
+
+def estimate_line_height(gray):
+    """Median height of text lines from the horizontal ink profile.
+
+    Runs on a downsampled copy so it stays cheap on 12 MP photos. Returns
+    None when no line structure is found (photos, diagrams).
+    """
+    step = max(1, gray.shape[1] // 1000)
+    small = gray[::step, ::step]
+    ink = adaptive_binarize(small) == 0
+    profile = ink.mean(axis=1) > 0.01
+
+    heights = []
+    run = 0
+    for has_ink in profile:
+        if has_ink:
+            run += 1
+        elif run:
+            heights.append(run)
+            run = 0
+    if run:
+        heights.append(run)
+
+    heights = [h for h in heights if h >= 2]
+    if len(heights) < 3:
+        return None
+    return float(np.median(heights)) * step
+
+
+def _choose_scale(gray, dpi):
+    """Scale factor that brings text lines to the OCR-optimal height."""
+    line_height = estimate_line_height(gray)
+    if line_height:
+        scale = OCR_TARGET_LINE_HEIGHT / line_height
+        # Close enough already; resampling would only cost time
+        if 0.7 <= scale <= 1.4:
+            scale = 1.0
+    elif dpi and 100 <= dpi <= 1200:
+        # Trust scanner metadata only; phones report a meaningless 72 DPI
+        scale = 300.0 / dpi
+    else:
+        scale = 1.0
+    return min(_MAX_SCALE, max(_MIN_SCALE, scale))
+
+
+def _limit_pixels(img):
+    """Downscale an image over OCR_MAX_PIXELS; returns (image, factor).
+
+    JPEGs are decoded at reduced size, so the full-size image is never
+    held. EXIF metadata is kept for the orientation fix that follows.
+    """
+    w, h = img.size
+    if w * h <= OCR_MAX_PIXELS:
+        return img, 1.0
+    factor = (OCR_MAX_PIXELS / (w * h)) ** 0.5
+    size = (max(1, int(w * factor)), max(1, int(h * factor)))
+    info = dict(img.info)
+    img.draft('L', size)
+    if img.size != size:
+        img = img.convert('L').resize(size, Image.BOX)
+    img.info.update(info)
+    return img, factor
+
+
+def preprocess(img):
+    """EXIF transpose, grayscale, resize and binarize an image for OCR."""
+    img, factor = _limit_pixels(img)
+    dpi = img.info.get('dpi', (None,))[0]
+    if dpi:
+        dpi *= factor
+    img = ImageOps.exif_transpose(img)
+    gray = np.asarray(img.convert('L'), dtype=np.uint8)
+
+    scale = _choose_scale(gray, dpi)
+    # Never upscale past the pixel cap
+    scale = min(scale, (OCR_MAX_PIXELS / gray.size) ** 0.5)
+    if abs(scale - 1.0) > 0.1:
+        h, w = gray.shape
+        resized = Image.fromarray(gray).resize(
+            (max(1, int(w * scale)), max(1, int(h * scale))),
+            Image.LANCZOS if scale > 1 else Image.BOX)
+        gray = np.asarray(resized, dtype=np.uint8)
+
+    radius = max(7, OCR_TARGET_LINE_HEIGHT // 2)
+    return adaptive_binarize(gray, radius=radius)
+
+
+def split_bands(binary, band_height=None, overlap=None):
+    """Split a page into horizontal bands, cutting at blank rows if possible.
+
+    Each cut is snapped to the emptiest row near the target position. When
+    that row still contains ink (no clean gap between lines), the bands
+    overlap by `overlap` rows and duplicated lines are merged afterwards.
+    """
+    band_height = band_height or OCR_BAND_HEIGHT
+    overlap = overlap or OCR_BAND_OVERLAP
+    height = binary.shape[0]
+    if height <= band_height + overlap:
+        return [(0, height)]
+
+    ink_per_row = (binary == 0).sum(axis=1)
+    bands = []
+    start = 0
+    while start < height:
+        target = start + band_height
+        if target + overlap >= height:
+            bands.append((start, height))
+            break
+        lo, hi = target - overlap, min(height, target + overlap)
+        cut = lo + int(np.argmin(ink_per_row[lo:hi]))
+        if ink_per_row[cut] == 0:
+            bands.append((start, cut))
+            start = cut
+        else:
+            bands.append((start, min(height, cut + overlap)))
+            start = max(start + 1, cut - overlap)
+    return bands
+
+
+def _merge_band_texts(texts, max_repeat=5):
+    """Join band texts, dropping lines repeated across an overlap."""
+    merged = []
+    for text in texts:
+        lines = text.strip('\n').split('\n')
+        tail = [line.strip() for line in merged[-max_repeat:]]
+        for k in range(min(max_repeat, len(tail), len(lines)), 0, -1):
+            if tail[-k:] == [line.strip() for line in lines[:k]]:
+                lines = lines[k:]
+                break
+        merged.extend(lines)
+    return '\n'.join(merged)
+
+
+def _ocr_band(band):
+    pool = ocr_pool.get_pool()
+    if pool is not None:
+        return pool.ocr(np.ascontiguousarray(band))
+    return pytesseract.image_to_string(
+        Image.fromarray(band), lang=ocr_pool.OCR_LANG)
+
+
+def ocr_image(img):
+    """Pre-process an image and OCR it band by band in parallel."""
+    binary = preprocess(img)
+    bands = [binary[top:bottom] for top, bottom in split_bands(binary)]
+    if len(bands) == 1 or OCR_WORKERS < 2:
+        texts = [_ocr_band(band) for band in bands]
+    else:
+        texts = list(_get_ocr_pool().map(_ocr_band, bands))
+    return _merge_band_texts(texts).strip()
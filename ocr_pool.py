@@ -0,0 +1,241 @@
+"""
+Persistent OCR worker pool
+Long-lived processes that keep Tesseract and its language data loaded
+
+Workers use tesserocr (Tesseract's C API), so the traineddata is loaded
+once per worker instead of once per call. Its wheels bundle libtesseract
+but not language data, so workers read the tessdata directory of the
+installed tesseract CLI (or OCR_TESSDATA). Without tesserocr a worker
+would only fork the tesseract CLI like pytesseract does, plus the pipe
+round trip, so the pool stays off and OCR runs through pytesseract
+threads instead; the same happens when no tessdata directory is found.
+"""
+
+import atexit
+import importlib.util
+import multiprocessing
+import os
+import queue
+import re
+import subprocess
+import threading
+
+from PIL import Image
+
+HAVE_TESSEROCR = importlib.util.find_spec('tesserocr') is not None
+# Per gunicorn worker, so split the cores between them
+_DEFAULT_POOL_SIZE = max(1, (os.cpu_count() or 1) // int(
+    os.getenv('WEB_CONCURRENCY', '1')))
+OCR_POOL_SIZE = int(os.getenv(
+    'OCR_POOL_SIZE', str(_DEFAULT_POOL_SIZE))) if HAVE_TESSEROCR else 0
+OCR_QUEUE_DEPTH = int(os.getenv('OCR_QUEUE_DEPTH', str(OCR_POOL_SIZE * 4)))
+OCR_JOB_TIMEOUT = float(os.getenv('OCR_JOB_TIMEOUT', '30'))
+OCR_WORKER_MAX_JOBS = int(os.getenv('OCR_WORKER_MAX_JOBS', '200'))
+OCR_LANG = os.getenv('OCR_LANG', 'eng')
+# Directory holding <lang>.traineddata; found from the tesseract CLI if unset
+OCR_TESSDATA = os.getenv('OCR_TESSDATA') or os.getenv('TESSDATA_PREFIX')
+
+
+class OcrPoolBusy(Exception):
+    """Raised when the OCR queue is full; callers should retry later."""
+
+
+class OcrTimeout(Exception):
+    """Raised when a worker does not answer within the job timeout."""
+
+
+def find_tessdata():
+    """Tessdata directory of the tesseract CLI pytesseract uses, or None."""
+    try:
+        output = subprocess.run(
+            ['tesseract', '--list-langs'], capture_output=True, text=True,
+            timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    # First line: List of available languages in "/usr/share/.../tessdata/"
+    match = re.search(r'"(.+)"', output)
+    return match.group(1) if match else None
+
+
+def _worker_main(conn, lang, tessdata):
+    """Worker loop: receive (height, width) + raw L pixels, reply text."""
+    import tesserocr
+
+    if tessdata:
+        api = tesserocr.PyTessBaseAPI(path=tessdata, lang=lang)
+    else:
+        api = tesserocr.PyTessBaseAPI(lang=lang)
+    try:
+        while True:
+            try:
+                header = conn.recv()
+            except EOFError:
+                break
+            if header is None:
+                break
+            height, width = header
+            img = Image.frombytes('L', (width, height), conn.recv_bytes())
+            try:
+                api.SetImage(img)
+                conn.send(('ok', api.GetUTF8Text()))
+            except Exception as e:
+                conn.send(('error', str(e)))
+    finally:
+        api.End()
+
+
+class _Worker:
+    def __init__(self, ctx, lang, tessdata):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main, args=(child_conn, lang, tessdata),
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def stop(self, kill=False):
+        try:
+            if kill:
+                self.process.kill()
+            else:
+                self.conn.send(None)
+                self.process.join(timeout=2)
+                if self.process.is_alive():
+                    self.process.kill()
+        except Exception:
+            pass
+        self.conn.close()
+
+
+class OcrWorkerPool:
+    """Bounded pool of OCR processes.
+
+    At most ``size`` jobs run at once and ``queue_depth`` more may wait;
+    beyond that ``OcrPoolBusy`` is raised immediately. Workers are
+    recycled after ``max_jobs`` jobs and killed after a job timeout.
+    """
+
+    def __init__(self, size=OCR_POOL_SIZE, queue_depth=OCR_QUEUE_DEPTH,
+                 job_timeout=OCR_JOB_TIMEOUT, max_jobs=OCR_WORKER_MAX_JOBS,
+                 lang=OCR_LANG, tessdata=None):
+        self.size = size
+        self.job_timeout = job_timeout
+        self.max_jobs = max_jobs
+        self.lang = lang
+        self.tessdata = tessdata
+        self._ctx = multiprocessing.get_context('spawn')
+        self._slots = threading.BoundedSemaphore(size + queue_depth)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.stats = {
+            'jobs': 0, 'errors': 0, 'timeouts': 0, 'rejected': 0,
+            'recycled': 0, 'waiting': 0
+        }
+        for _ in range(size):
+            self._idle.put(_Worker(self._ctx, lang, self.tessdata))
+
+    def _bump(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def ocr(self, pixels):
+        """OCR a 2-D uint8 NumPy array and return the text."""
+        if not self._slots.acquire(blocking=False):
+            self._bump('rejected')
+            raise OcrPoolBusy('OCR queue is full')
+        try:
+            self._bump('waiting')
+            try:
+                worker = self._idle.get(timeout=self.job_timeout)
+            except queue.Empty:
+                self._bump('timeouts')
+                raise OcrTimeout('No OCR worker became free in time')
+            finally:
+                self._bump('waiting', -1)
+            return self._run(worker, pixels)
+        finally:
+            self._slots.release()
+
+    def _run(self, worker, pixels):
+        height, width = pixels.shape
+        try:
+            worker.conn.send((height, width))
+            worker.conn.send_bytes(pixels.tobytes())
+            if not worker.conn.poll(self.job_timeout):
+                self._bump('timeouts')
+                worker.stop(kill=True)
+                worker = _Worker(self._ctx, self.lang, self.tessdata)
+                raise OcrTimeout('OCR job exceeded {}s'.format(
+                    self.job_timeout))
+            status, text = worker.conn.recv()
+        except (EOFError, OSError):
+            # Worker died mid-job; replace it and report the failure
+            self._bump('errors')
+            worker.stop(kill=True)
+            worker = _Worker(self._ctx, self.lang, self.tessdata)
+            raise
+        finally:
+            self._release(worker)
+
+        self._bump('jobs')
+        if status != 'ok':
+            self._bump('errors')
+            raise RuntimeError('OCR failed: {}'.format(text))
+        return text
+
+    def _release(self, worker):
+        worker.jobs += 1
+        if worker.jobs >= self.max_jobs and worker.process.is_alive():
+            worker.stop()
+            worker = _Worker(self._ctx, self.lang, self.tessdata)
+            self._bump('recycled')
+        if self._closed:
+            worker.stop()
+        else:
+            self._idle.put(worker)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['size'] = self.size
+        stats['idle'] = self._idle.qsize()
+        return stats
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break
+
+
+_pool = None
+_pool_disabled = OCR_POOL_SIZE == 0
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide pool, starting it on first use.
+
+    None when the pool is off: no tesserocr, OCR_POOL_SIZE=0 or no
+    tessdata directory to load the language from.
+    """
+    global _pool, _pool_disabled
+    with _pool_lock:
+        if _pool is None and not _pool_disabled:
+            tessdata = OCR_TESSDATA or find_tessdata()
+            if tessdata is None:
+                print("OCR pool disabled: no tessdata directory found")
+                _pool_disabled = True
+                return None
+            _pool = OcrWorkerPool(tessdata=tessdata)
+            atexit.register(_pool.close)
+        return _pool
+
+
+def get_stats():
+    """Pool counters, or None if the pool is disabled or not started."""
+    return _pool.get_stats() if _pool is not None else None
@@ -0,0 +1,98 @@
+"""
+Streaming PNG encoder
+Writes an RGB PNG from bands of rows as they are produced
+
+PIL can only encode a complete image, which means holding the whole
+output (and its compressed copy) in memory. Here each band of rows is
+Paeth-filtered and fed to one zlib stream, and IDAT chunks are yielded
+as soon as enough compressed data has built up.
+"""
+
+import base64
+import struct
+import zlib
+
+import numpy as np
+
+_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Rows are filtered this many bytes at a time to bound the int16 temporaries
+_FILTER_BYTES = 1024 * 1024
+_IDAT_BYTES = 256 * 1024
+
+
+def _chunk(kind, data):
+    return b''.join([
+        struct.pack('>I', len(data)), kind, data,
+        struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)])
+
+
+def paeth_filter(rows, prev):
+    """PNG filter type 4 for a (n, width * 3) uint8 block of scanlines.
+
+    ``prev`` is the scanline above the first row (zeros for the first).
+    Returns the block with the filter-type byte prepended to each row.
+    """
+    x = rows.astype(np.int16)
+    up = np.empty_like(x)
+    up[0] = prev
+    up[1:] = x[:-1]
+    left = np.zeros_like(x)
+    left[:, 3:] = x[:, :-3]
+    upleft = np.zeros_like(x)
+    upleft[:, 3:] = up[:, :-3]
+
+    p = left + up - upleft
+    pa = np.abs(p - left)
+    pb = np.abs(p - up)
+    pc = np.abs(p - upleft)
+    predictor = np.where((pa <= pb) & (pa <= pc), left,
+                         np.where(pb <= pc, up, upleft))
+
+    out = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    out[:, 0] = 4
+    out[:, 1:] = (x - predictor).astype(np.uint8)
+    return out
+
+
+def encode_png(bands, width, height, compress_level=6):
+    """Yield a PNG for `bands`, (rows, width, 3) uint8 RGB arrays in order."""
+    yield _SIGNATURE
+    yield _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0,
+                                      0))
+    compressor = zlib.compressobj(compress_level)
+    prev = np.zeros(width * 3, dtype=np.uint8)
+    step = max(1, _FILTER_BYTES // (width * 3))
+    pending = []
+    size = 0
+    written = 0
+    for band in bands:
+        rows = band.reshape(band.shape[0], width * 3)
+        for start in range(0, rows.shape[0], step):
+            block = rows[start:start + step]
+            data = compressor.compress(paeth_filter(block, prev).tobytes())
+            prev = block[-1].copy()
+            if data:
+                pending.append(data)
+                size += len(data)
+            if size >= _IDAT_BYTES:
+                yield _chunk(b'IDAT', b''.join(pending))
+                pending, size = [], 0
+        written += rows.shape[0]
+    if written != height:
+        raise ValueError('Expected {} rows, got {}'.format(height, written))
+    pending.append(compressor.flush())
+    yield _chunk(b'IDAT', b''.join(pending))
+    yield _chunk(b'IEND', b'')
+
+
+def base64_chunks(chunks):
+    """Base64-encode a byte stream piecewise (as one continuous string)."""
+    carry = b''
+    for data in chunks:
+        data = carry + data
+        cut = len(data) - len(data) % 3
+        carry = data[cut:]
+        if cut:
+            yield base64.b64encode(data[:cut]).decode('ascii')
+    if carry:
+        yield base64.b64encode(carry).decode('ascii')
@@ -0,0 +1,158 @@
+"""
+Rate limiting
+Per-model token buckets for requests and tokens per minute
+
+Callers reserve capacity up front and sleep off any deficit, so a burst
+is spread over the following seconds in arrival order instead of being
+sent all at once (and bounced with 429s). Only when the wait queue is
+full, or the wait would exceed its limit, is a call rejected.
+"""
+
+import threading
+import time
+
+
+class RateLimited(Exception):
+    """Raised when a call cannot be scheduled within the wait limits."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Bucket refilled at `per_minute / 60` per second, holding a minute.
+
+    The level may go negative: that is capacity already promised to
+    callers who are still waiting for it.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(
+            self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount):
+        """Seconds until `amount` would be available (0 if it is now)."""
+        amount = min(amount, self.capacity)
+        deficit = amount - self.level
+        return deficit / self.rate if deficit > 0 else 0.0
+
+
+class RateLimiter:
+    """Requests/tokens-per-minute limits shared by all threads of a worker.
+
+    ``limits`` maps a name (e.g. a model) to ``{'rpm': n, 'tpm': n}``;
+    names without an entry use ``default``. A budget of 0 means unlimited.
+    """
+
+    def __init__(self, limits=None, default=None, max_waiting=32,
+                 max_wait=30.0):
+        self.limits = limits or {}
+        self.default = default or {}
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self.stats = {}
+
+    def _get(self, name):
+        buckets = self._buckets.get(name)
+        if buckets is None:
+            limit = dict(self.default, **self.limits.get(name, {}))
+            buckets = self._buckets[name] = {
+                unit: TokenBucket(limit[unit])
+                for unit in ('rpm', 'tpm') if limit.get(unit)
+            }
+            self.stats[name] = {
+                'calls': 0, 'throttled': 0, 'rejected': 0,
+                'queue_wait_seconds': 0.0, 'max_queue_wait_seconds': 0.0,
+                'backoffs': 0
+            }
+        return buckets
+
+    def acquire(self, name, tokens=0, max_wait=None):
+        """Reserve one request and `tokens`; sleep until they are due.
+
+        Returns the seconds spent waiting. Raises RateLimited without
+        waiting when the queue is full or the wait would be longer than
+        the limiter's (or the caller's tighter) `max_wait`.
+        """
+        if max_wait is None or max_wait > self.max_wait:
+            max_wait = self.max_wait
+        amounts = {'rpm': 1, 'tpm': tokens}
+        with self._lock:
+            buckets = self._get(name)
+            stats = self.stats[name]
+            now = time.monotonic()
+            wait = 0.0
+            for unit, bucket in buckets.items():
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_for(amounts[unit]))
+            if wait > 0 and (self._waiting >= self.max_waiting
+                             or wait > max_wait):
+                stats['rejected'] += 1
+                raise RateLimited(
+                    'Rate limit for {} reached'.format(name),
+                    retry_after=wait)
+            for unit, bucket in buckets.items():
+                bucket.level -= min(amounts[unit], bucket.capacity)
+            stats['calls'] += 1
+            if wait > 0:
+                stats['throttled'] += 1
+                self._waiting += 1
+
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+                    stats['queue_wait_seconds'] += wait
+                    stats['max_queue_wait_seconds'] = max(
+                        stats['max_queue_wait_seconds'], wait)
+        return wait
+
+    def adjust(self, name, tokens):
+        """Charge (or refund) tokens once the real usage is known."""
+        with self._lock:
+            bucket = self._get(name).get('tpm')
+            if bucket is not None and tokens:
+                bucket.refill(time.monotonic())
+                bucket.level -= tokens
+
+    def backoff(self, name):
+        """The upstream said slow down: empty the request bucket.
+
+        Later callers then queue behind a refill instead of piling more
+        requests onto a quota that is already exhausted.
+        """
+        with self._lock:
+            buckets = self._get(name)
+            self.stats[name]['backoffs'] += 1
+            bucket = buckets.get('rpm')
+            if bucket is not None:
+                bucket.refill(time.monotonic())
+                bucket.level = min(bucket.level, 0.0)
+
+    def get_stats(self):
+        with self._lock:
+            stats = {}
+            for name, counters in self.stats.items():
+                limit = dict(self.default, **self.limits.get(name, {}))
+                stats[name] = dict(
+                    counters,
+                    queue_wait_seconds=round(
+                        counters['queue_wait_seconds'], 3),
+                    max_queue_wait_seconds=round(
+                        counters['max_queue_wait_seconds'], 3),
+                    rpm=limit.get('rpm', 0),
+                    tpm=limit.get('tpm', 0))
+            return {'models': stats, 'waiting': self._waiting}
@@ -62,7 +62,9 @@ const ImageEnhancePage = () => {
       if (response.data.success) {
         setEnhancedImage(response.data.image_url);
       } else {
-        setError('Failed to enhance image. Please try again.');
+        setError(
+          response.data.error || 'Failed to enhance image. Please try again.'
+        );
       }
     } catch (err) {
       console.error('Enhancement error:', err);
@@ -8,6 +8,20 @@ import FeatureHistory from '../components/FeatureHistory';
 import axios from 'axios';
 import { trackFeatureUsage } from '../utils/analytics';
 
+// The server returns at most a capped slice per request; follow nextOffset
+const fetchDocumentText = async (documentId) => {
+  const parts = [];
+  let offset = 0;
+  while (offset !== null) {
+    const { data } = await axios.get(`/api/documents/${documentId}/text`, {
+      params: { offset, limit: 100000 },
+    });
+    parts.push(data.text);
+    offset = data.nextOffset;
+  }
+  return parts.join('');
+};
+
 const ImageToTextPage = () => {
   const navigate = useNavigate();
   const { addRecentSearch, getRecentSearches } = useRecentSearches();
@@ -62,13 +76,19 @@ const ImageToTextPage = () => {
         },
       });
 
-      const { fullText } = uploadResponse.data;
-      setExtractedText(fullText);
+      const { documentId, extractedText: preview, textLength } = uploadResponse.data;
 
-      const analyzeResponse = await axios.post('/api/analyze', {
-        content: fullText,
-        prompt: customPrompt || null,
-      });
+      // Analyze by document id; fetch the full text only when the preview is cut short
+      const [analyzeResponse, fullText] = await Promise.all([
+        axios.post('/api/analyze', {
+          document_id: documentId,
+          prompt: customPrompt || null,
+        }),
+        textLength > preview.length
+          ? fetchDocumentText(documentId)
+          : Promise.resolve(preview),
+      ]);
+      setExtractedText(fullText);
 
       const { result } = analyzeResponse.data;
       setAiAnalysis(result);
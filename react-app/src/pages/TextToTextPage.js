@@ -20,6 +20,11 @@ const TextToTextPage = () => {
   const [selectedFile, setSelectedFile] = useState(null);
   const [summarizeMode, setSummarizeMode] = useState(false);
   const [extractedText, setExtractedText] = useState('');
+  // Server-side conversation: follow-ups send only the new message
+  const [conversationId, setConversationId] = useState(null);
+  // First exchange, sent along when the second turn starts the conversation
+  // (single questions stay on the cacheable path)
+  const [firstTurn, setFirstTurn] = useState(null);
 
   useEffect(() => {
     loadRecentSearches();
@@ -54,6 +59,7 @@ const TextToTextPage = () => {
   const handleRemoveFile = () => {
     setSelectedFile(null);
     setExtractedText('');
+    setConversationId(null);
   };
 
   const handleProcessPDF = async () => {
@@ -77,8 +83,8 @@ const TextToTextPage = () => {
         },
       });
 
-      const { fullText } = uploadResponse.data;
-      setExtractedText(fullText);
+      const { documentId, extractedText: preview } = uploadResponse.data;
+      setExtractedText(preview);
 
       // Then analyze or summarize
       let prompt = inputText.trim();
@@ -88,8 +94,18 @@ const TextToTextPage = () => {
         prompt = 'Please analyze this document and provide insights.';
       }
 
+      // The server keeps the document text; send only its id
       const analyzeResponse = await axios.post('/api/chat', {
-        message: `${prompt}\n\nDocument content:\n${fullText}`,
+        message: prompt,
+        document_id: documentId,
+      });
+      setConversationId(null);
+      setFirstTurn({
+        documentId,
+        history: [
+          { role: 'user', content: prompt },
+          { role: 'model', content: analyzeResponse.data.response },
+        ],
       });
 
       setOutputText(analyzeResponse.data.response);
@@ -124,8 +140,8 @@ const TextToTextPage = () => {
   };
 
   const handleProcess = async () => {
-    // If file is selected, process PDF instead
-    if (selectedFile) {
+    // If file is selected, process PDF instead (follow-ups go to its conversation)
+    if (selectedFile && !conversationId && !firstTurn) {
       handleProcessPDF();
       return;
     }
@@ -139,16 +155,69 @@ const TextToTextPage = () => {
     setOutputText('');
 
     try {
-      const response = await axios.post('/api/chat', {
-        message: inputText,
+      // Stream the answer so text appears as soon as the model produces it
+      const response = await fetch('/api/chat', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          message: inputText,
+          stream: true,
+          ...(conversationId && { conversation_id: conversationId }),
+          ...(!conversationId && firstTurn && {
+            conversation: true,
+            history: firstTurn.history,
+            document_id: firstTurn.documentId,
+          }),
+        }),
       });
+      if (response.status === 404 && (conversationId || firstTurn)) {
+        // Conversation (or its document) expired; the next message starts anew
+        setConversationId(null);
+        setFirstTurn(null);
+      }
+      if (!response.ok || !response.body) {
+        const data = await response.json().catch(() => ({}));
+        throw new Error(data.error || `Request failed (${response.status})`);
+      }
 
-      setOutputText(response.data.response);
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let result = '';
+      for (;;) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const raw of events) {
+          const event = (raw.match(/^event: (.*)$/m) || [])[1];
+          const data = JSON.parse((raw.match(/^data: (.*)$/m) || [])[1] || '{}');
+          if (event === 'start' && data.conversation_id) {
+            setConversationId(data.conversation_id);
+            setFirstTurn(null);
+          } else if (event === 'chunk') {
+            result += data.text;
+            setOutputText(result);
+          } else if (event === 'error') {
+            throw new Error(data.error);
+          }
+        }
+      }
+
+      if (!conversationId && !firstTurn) {
+        setFirstTurn({
+          history: [
+            { role: 'user', content: inputText },
+            { role: 'model', content: result },
+          ],
+        });
+      }
       setTimestamp(Date.now());
 
       addRecentSearch('TextToText', {
         input: inputText.substring(0, 100) + '...',
-        output: response.data.response.substring(0, 100) + '...',
+        output: result.substring(0, 100) + '...',
       });
 
       // Track feature usage with complete data
@@ -157,7 +226,7 @@ const TextToTextPage = () => {
         'chat',
         {
           text: inputText,
-          result: response.data.response
+          result: result
         },
         currentUser?.uid
       );
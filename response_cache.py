@@ -0,0 +1,203 @@
+"""
+Gemini response cache
+In-process LRU in front of the SQLite analytics_cache table
+
+Keys are a SHA-256 of the model name, prompt template, content and
+language after normalizing whitespace, so the same handout analyzed twice
+costs one Gemini call. Entries expire after a TTL; expired rows are swept
+from SQLite on write.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from database import get_db_connection
+
+RESPONSE_CACHE_TTL_SECONDS = int(
+    os.getenv('RESPONSE_CACHE_TTL_SECONDS', str(24 * 3600)))
+RESPONSE_CACHE_MEMORY_ENTRIES = int(
+    os.getenv('RESPONSE_CACHE_MEMORY_ENTRIES', '256'))
+RESPONSE_CACHE_SWEEP_SECONDS = int(
+    os.getenv('RESPONSE_CACHE_SWEEP_SECONDS', '300'))
+# Comma-separated endpoint names that never read or write the cache
+RESPONSE_CACHE_DISABLED = {
+    name.strip() for name in os.getenv(
+        'RESPONSE_CACHE_DISABLED', '').split(',') if name.strip()
+}
+
+# Bump to invalidate every entry (e.g. after changing how answers are
+# post-processed)
+_KEY_VERSION = 1
+
+_lock = threading.Lock()
+_memory = OrderedDict()
+_last_sweep = 0.0
+_stats = {}
+
+
+def _count(endpoint, name, amount=1):
+    with _lock:
+        counters = _stats.setdefault(endpoint, {
+            'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0,
+            'swept': 0
+        })
+        counters[name] += amount
+
+
+def normalize(text):
+    """Canonical form of prompt text: NFC, LF newlines, no trailing spaces."""
+    text = unicodedata.normalize('NFC', text or '')
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(line.rstrip() for line in lines).strip()
+
+
+def make_key(model, template, content, language='', **params):
+    """Hash of everything that determines the model's answer.
+
+    ``params`` carries any other prompt inputs, such as a user's custom
+    analysis instruction.
+    """
+    payload = json.dumps([
+        _KEY_VERSION,
+        model,
+        normalize(template),
+        normalize(content),
+        language or '',
+        sorted((name, normalize(str(value)))
+               for name, value in params.items() if value)
+    ], ensure_ascii=False)
+    return 'gemini:' + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def is_enabled(endpoint):
+    return endpoint not in RESPONSE_CACHE_DISABLED
+
+
+def _remember(key, text, expires_at):
+    if RESPONSE_CACHE_MEMORY_ENTRIES <= 0:
+        return
+    with _lock:
+        _memory[key] = (expires_at, text)
+        _memory.move_to_end(key)
+        while len(_memory) > RESPONSE_CACHE_MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def get(key, endpoint, record=True):
+    """Return the cached response for a key, or None on a miss.
+
+    Polling callers pass ``record=False`` to keep hit-rate stats honest.
+    """
+    if not is_enabled(endpoint):
+        return None
+    now = time.time()
+    with _lock:
+        entry = _memory.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                _memory.move_to_end(key)
+            else:
+                del _memory[key]
+                entry = None
+    if entry is not None:
+        if record:
+            _count(endpoint, 'memory_hits')
+        return entry[1]
+
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT cache_data, expires_at FROM analytics_cache
+            WHERE cache_key = ? AND expires_at > ?
+        ''', (key, now))
+        row = cursor.fetchone()
+        conn.close()
+    except Exception as e:
+        print(f"Error reading response cache: {e}")
+        row = None
+
+    if row is None:
+        if record:
+            _count(endpoint, 'misses')
+        return None
+    _remember(key, row['cache_data'], row['expires_at'])
+    if record:
+        _count(endpoint, 'db_hits')
+    return row['cache_data']
+
+
+def put(key, text, endpoint, ttl_seconds=None):
+    """Store a successful response in both tiers."""
+    if not text or not is_enabled(endpoint):
+        return False
+    now = time.time()
+    expires_at = now + (ttl_seconds or RESPONSE_CACHE_TTL_SECONDS)
+    _remember(key, text, expires_at)
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO analytics_cache
+            (cache_key, cache_data, expires_at)
+            VALUES (?, ?, ?)
+        ''', (key, text, expires_at))
+        swept = _sweep(cursor, now)
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"Error writing response cache: {e}")
+        return False
+
+    _count(endpoint, 'stores')
+    if swept:
+        _count(endpoint, 'swept', swept)
+    return True
+
+
+def _sweep(cursor, now):
+    """Delete expired rows, at most once per sweep interval."""
+    global _last_sweep
+    with _lock:
+        if now - _last_sweep < RESPONSE_CACHE_SWEEP_SECONDS:
+            return 0
+        _last_sweep = now
+    cursor.execute(
+        'DELETE FROM analytics_cache WHERE expires_at <= ?', (now,))
+    return cursor.rowcount
+
+
+def get_stats():
+    """Per-endpoint hit rates for this worker plus the shared table size."""
+    with _lock:
+        endpoints = {name: dict(c) for name, c in _stats.items()}
+        memory_entries = len(_memory)
+    for counters in endpoints.values():
+        hits = counters['memory_hits'] + counters['db_hits']
+        lookups = hits + counters['misses']
+        counters['hit_rate'] = round(hits / lookups, 3) if lookups else 0.0
+
+    stats = {
+        'endpoints': endpoints,
+        'memory_entries': memory_entries,
+        'memory_max_entries': RESPONSE_CACHE_MEMORY_ENTRIES,
+        'ttl_seconds': RESPONSE_CACHE_TTL_SECONDS,
+        'disabled': sorted(RESPONSE_CACHE_DISABLED)
+    }
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*) AS entries FROM analytics_cache
+            WHERE expires_at > ?
+        ''', (time.time(),))
+        stats['db_entries'] = cursor.fetchone()['entries']
+        conn.close()
+    except Exception as e:
+        print(f"Error reading response cache stats: {e}")
+    return stats
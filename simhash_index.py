@@ -0,0 +1,226 @@
+"""
+Near-duplicate content index
+64-bit SimHash fingerprints of analyzed content, kept in SQLite
+
+Re-submitted worksheets differ from earlier uploads only by a few OCR
+errors, so their exact cache key never matches. Their SimHash does: a few
+changed words flip only a few of its 64 bits. The index splits each
+fingerprint into bands; by the pigeonhole principle two fingerprints
+within ``max_distance`` bits agree exactly on at least one of
+``max_distance + 1`` bands, so a lookup is a handful of dict probes.
+"""
+
+import hashlib
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from database import get_db_connection
+
+SIMHASH_MAX_DISTANCE = int(os.getenv('SIMHASH_MAX_DISTANCE', '4'))
+# Short texts ("what is 2+2" vs "what is 2+3") are too easy to confuse
+SIMHASH_MIN_TOKENS = int(os.getenv('SIMHASH_MIN_TOKENS', '30'))
+SIMHASH_MAX_ENTRIES = int(os.getenv('SIMHASH_MAX_ENTRIES', '100000'))
+SIMHASH_TTL_SECONDS = int(
+    os.getenv('SIMHASH_TTL_SECONDS', os.getenv(
+        'RESPONSE_CACHE_TTL_SECONDS', str(24 * 3600))))
+# How often a worker picks up entries written by other workers
+SIMHASH_REFRESH_SECONDS = int(os.getenv('SIMHASH_REFRESH_SECONDS', '30'))
+
+_BITS = 64
+_TOKEN_RE = re.compile(r'\w+')
+_BIT_SHIFTS = np.arange(_BITS, dtype=np.uint64)
+
+
+def _token_hashes(tokens):
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(t.encode('utf-8'),
+                                        digest_size=8).digest(), 'little')
+         for t in tokens),
+        dtype=np.uint64, count=len(tokens))
+
+
+def fingerprint(text):
+    """SimHash of a text's words, or None if it is too short.
+
+    Words rather than word n-grams: one OCR error then changes one
+    feature instead of n, which keeps re-uploads within a few bits.
+    """
+    tokens = _TOKEN_RE.findall((text or '').lower())
+    if len(tokens) < SIMHASH_MIN_TOKENS:
+        return None
+    hashes = _token_hashes(tokens)
+    # Per bit: how many words set it, compared against half of them
+    bits = np.unpackbits(
+        hashes.astype('<u8').view(np.uint8).reshape(-1, 8),
+        axis=1, bitorder='little')
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 > len(hashes)
+    return int((votes.astype(np.uint64) << _BIT_SHIFTS).sum())
+
+
+def _to_signed(value):
+    # SQLite INTEGER is signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class SimHashIndex:
+    """Banded in-memory index of (scope, fingerprint) -> cache key.
+
+    ``scope`` separates fingerprints whose answers are not interchangeable
+    (different model, template or custom prompt).
+    """
+
+    def __init__(self, max_distance=SIMHASH_MAX_DISTANCE,
+                 max_entries=SIMHASH_MAX_ENTRIES):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        bands = min(_BITS, max_distance + 1)
+        width = _BITS // bands
+        # Last band takes any leftover bits
+        self._bands = [
+            (i * width, (1 << (width if i < bands - 1
+                               else _BITS - i * width)) - 1)
+            for i in range(bands)
+        ]
+        self._tables = [{} for _ in self._bands]
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _band_keys(self, scope, fp):
+        return [(scope, (fp >> shift) & mask) for shift, mask in self._bands]
+
+    def add(self, scope, fp, cache_key, created_at=None):
+        with self._lock:
+            if cache_key in self._entries:
+                self._discard(cache_key)
+            self._entries[cache_key] = (scope, fp, created_at or time.time())
+            for table, band in zip(self._tables, self._band_keys(scope, fp)):
+                table.setdefault(band, []).append(cache_key)
+            # Dicts keep insertion order, so the first entry is the oldest
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, cache_key):
+        scope, fp, _ = self._entries.pop(cache_key)
+        for table, band in zip(self._tables, self._band_keys(scope, fp)):
+            bucket = table.get(band)
+            if bucket:
+                bucket.remove(cache_key)
+                if not bucket:
+                    del table[band]
+
+    def remove(self, cache_key):
+        with self._lock:
+            if cache_key in self._entries:
+                self._discard(cache_key)
+
+    def nearest(self, scope, fp, exclude=()):
+        """Closest (cache_key, distance) within max_distance, or None."""
+        best = None
+        with self._lock:
+            for table, band in zip(self._tables, self._band_keys(scope, fp)):
+                for cache_key in table.get(band, ()):
+                    if cache_key in exclude:
+                        continue
+                    distance = (self._entries[cache_key][1] ^ fp).bit_count()
+                    if distance <= self.max_distance and (
+                            best is None or distance < best[1]):
+                        best = (cache_key, distance)
+        return best
+
+
+_index = SimHashIndex()
+_state_lock = threading.Lock()
+_loaded_until = None
+_last_refresh = 0.0
+
+
+def _refresh():
+    """Load entries written since the last refresh (by any worker)."""
+    global _loaded_until, _last_refresh
+    now = time.time()
+    with _state_lock:
+        if now - _last_refresh < SIMHASH_REFRESH_SECONDS:
+            return
+        _last_refresh = now
+        since = _loaded_until if _loaded_until is not None else (
+            now - SIMHASH_TTL_SECONDS)
+        try:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT cache_key, scope, fingerprint, created_at
+                FROM simhash_index
+                WHERE created_at > ?
+                ORDER BY created_at
+            ''', (since,))
+            rows = cursor.fetchall()
+            conn.close()
+        except Exception as e:
+            print(f"Error loading SimHash index: {e}")
+            return
+        for row in rows:
+            _index.add(row['scope'], row['fingerprint'] & ((1 << 64) - 1),
+                       row['cache_key'], row['created_at'])
+        if rows:
+            _loaded_until = rows[-1]['created_at']
+        elif _loaded_until is None:
+            _loaded_until = since
+
+
+def scope_key(*parts):
+    """Compact identifier for the inputs a cached answer depends on."""
+    return hashlib.sha256(
+        '\x00'.join(str(p or '') for p in parts).encode('utf-8')
+    ).hexdigest()[:16]
+
+
+def add(scope, fp, cache_key):
+    """Index a fingerprint in this worker and persist it for the others."""
+    if fp is None:
+        return
+    now = time.time()
+    _index.add(scope, fp, cache_key, now)
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'DELETE FROM simhash_index WHERE created_at < ?',
+            (now - SIMHASH_TTL_SECONDS,))
+        cursor.execute('''
+            INSERT OR REPLACE INTO simhash_index
+            (cache_key, scope, fingerprint, created_at)
+            VALUES (?, ?, ?, ?)
+        ''', (cache_key, scope, _to_signed(fp), now))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"Error storing SimHash fingerprint: {e}")
+
+
+def nearest(scope, fp, exclude=()):
+    """Closest indexed (cache_key, distance) for a fingerprint, or None."""
+    if fp is None:
+        return None
+    _refresh()
+    return _index.nearest(scope, fp, exclude)
+
+
+def remove(cache_key):
+    """Forget an entry whose cached answer has expired."""
+    _index.remove(cache_key)
+
+
+def get_stats():
+    return {
+        'entries': len(_index),
+        'max_entries': _index.max_entries,
+        'max_distance': _index.max_distance,
+        'bands': len(_index._bands)
+    }
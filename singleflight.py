@@ -0,0 +1,185 @@
+"""
+Single-flight request coalescing
+Identical concurrent calls share one execution
+
+Within a worker, the first caller for a key runs the call and later
+callers wait for its result. Across gunicorn workers, the leader also
+takes a row in the SQLite inflight_locks table; a leader in another worker
+that finds the row taken polls the shared cache (via ``lookup``) until
+the owner has stored its result, instead of making the same call again.
+"""
+
+import os
+import threading
+import time
+import uuid
+
+from database import get_db_connection
+
+# A crashed worker's lock stops blocking others after this long
+SINGLE_FLIGHT_LOCK_TTL = float(os.getenv('SINGLE_FLIGHT_LOCK_TTL', '120'))
+# Longest a worker waits on another worker before making the call itself
+SINGLE_FLIGHT_WAIT_SECONDS = float(
+    os.getenv('SINGLE_FLIGHT_WAIT_SECONDS', '60'))
+# With a deadline, wait at most this share of the time left so our own
+# call (or its fallback tier) still has a chance to answer
+SINGLE_FLIGHT_WAIT_SHARE = float(os.getenv('SINGLE_FLIGHT_WAIT_SHARE', '0.5'))
+SINGLE_FLIGHT_POLL_SECONDS = float(
+    os.getenv('SINGLE_FLIGHT_POLL_SECONDS', '0.1'))
+
+LEADER = 'leader'
+FOLLOWER = 'follower'
+REMOTE = 'remote'
+
+_OWNER = '{}:{}'.format(os.getpid(), uuid.uuid4().hex[:8])
+
+_lock = threading.Lock()
+_calls = {}
+_stats = {
+    'leaders': 0,
+    'followers': 0,
+    'remote_followers': 0,
+    'remote_timeouts': 0,
+    'remote_misses': 0,
+    'errors': 0,
+    'max_followers': 0
+}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.result = None
+        self.error = None
+
+
+def _count(name, amount=1):
+    with _lock:
+        _stats[name] += amount
+
+
+def _acquire(key):
+    """Take the cross-worker lock for `key`; True if this worker holds it."""
+    now = time.time()
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'DELETE FROM inflight_locks WHERE lock_key = ? AND expires_at < ?',
+            (key, now))
+        cursor.execute('''
+            INSERT OR IGNORE INTO inflight_locks (lock_key, owner, expires_at)
+            VALUES (?, ?, ?)
+        ''', (key, _OWNER, now + SINGLE_FLIGHT_LOCK_TTL))
+        acquired = cursor.rowcount == 1
+        conn.commit()
+        conn.close()
+        return acquired
+    except Exception as e:
+        # Coalescing is an optimization; never fail the request over it
+        print(f"Error taking single-flight lock: {e}")
+        return True
+
+
+def _release(key):
+    try:
+        conn = get_db_connection()
+        conn.execute(
+            'DELETE FROM inflight_locks WHERE lock_key = ? AND owner = ?',
+            (key, _OWNER))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"Error releasing single-flight lock: {e}")
+
+
+def _run_leader(key, fn, lookup, deadline=None):
+    if lookup is None:
+        return fn(), LEADER
+
+    wait = SINGLE_FLIGHT_WAIT_SECONDS
+    if deadline is not None:
+        wait = min(wait, (deadline - time.monotonic()) *
+                   SINGLE_FLIGHT_WAIT_SHARE)
+    wait_until = time.monotonic() + wait
+    waited = False
+    while not _acquire(key):
+        # Another worker is making this call; wait for its stored result
+        waited = True
+        time.sleep(SINGLE_FLIGHT_POLL_SECONDS)
+        result = lookup()
+        if result is not None:
+            _count('remote_followers')
+            return result, REMOTE
+        if time.monotonic() >= wait_until:
+            _count('remote_timeouts')
+            return fn(), LEADER
+
+    try:
+        # The previous owner may have finished just before we got the lock
+        result = lookup()
+        if result is not None:
+            _count('remote_followers')
+            return result, REMOTE
+        if waited:
+            # It released without storing anything (an uncacheable
+            # answer or an error); stop waiting and make the call
+            _count('remote_misses')
+        return fn(), LEADER
+    finally:
+        _release(key)
+
+
+def do(key, fn, lookup=None, deadline=None):
+    """Run fn() once per key at a time; return (result, role).
+
+    ``role`` is ``'leader'`` for the caller that ran fn, ``'follower'``
+    for callers in this worker that shared its result, and ``'remote'``
+    when the result came from another worker through ``lookup()``.
+    Without ``lookup`` only callers in this worker are coalesced. If the
+    leader raises, its followers raise the same exception. `deadline` (a
+    time.monotonic() value) bounds how long we wait on another worker.
+    """
+    with _lock:
+        call = _calls.get(key)
+        if call is not None:
+            call.followers += 1
+            _stats['followers'] += 1
+            _stats['max_followers'] = max(
+                _stats['max_followers'], call.followers)
+            leader = False
+        else:
+            call = _calls[key] = _Call()
+            _stats['leaders'] += 1
+            leader = True
+
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result, FOLLOWER
+
+    try:
+        call.result, role = _run_leader(key, fn, lookup, deadline)
+        return call.result, role
+    except Exception as e:
+        call.error = e
+        _count('errors')
+        raise
+    finally:
+        with _lock:
+            del _calls[key]
+        call.done.set()
+
+
+def get_stats():
+    """Coalescing counters for this worker."""
+    with _lock:
+        stats = dict(_stats)
+        stats['in_flight'] = len(_calls)
+    calls = stats['leaders'] + stats['followers']
+    stats['coalesced_rate'] = round(
+        (stats['followers'] + stats['remote_followers']) / calls, 3
+    ) if calls else 0.0
+    return stats
@@ -0,0 +1,26 @@
+"""
+Chunking Tests
+Offline checks for chunking.split_content (run with pytest)
+"""
+from chunking import _hard_split, estimate_tokens, split_content
+
+
+def test_hard_split_keeps_document_order():
+    text = 'first line\n' + 'X' * 100 + '\nlast line'
+    pieces = _hard_split(text, 10)
+    assert pieces[0] == 'first line'
+    assert pieces[-1] == 'last line'
+    assert ''.join(pieces[1:-1]) == 'X' * 100
+
+
+def test_split_content_respects_budget_and_order():
+    paragraphs = ['Paragraph {} '.format(i) * 20 for i in range(30)]
+    chunks = split_content('\n\n'.join(paragraphs), 200)
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk) <= 200 + 10 for chunk in chunks)
+    assert '\n\n'.join(chunks) == '\n\n'.join(p.strip('\n') for p in paragraphs)
+
+
+def test_split_content_splits_pages_and_skips_blanks():
+    chunks = split_content('page one\fpage two\n\n\n\npage three', 1000)
+    assert chunks == ['page one\n\npage two\n\npage three']
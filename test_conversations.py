@@ -0,0 +1,39 @@
+"""
+Conversation Tests
+Offline checks for the conversations prompt window (run with pytest)
+"""
+from chunking import estimate_tokens
+from conversations import CHAT_HISTORY_TOKENS, build_contents, clip_exchange
+
+
+def turn(role, content):
+    return {'role': role, 'content': content,
+            'tokens': estimate_tokens(content)}
+
+
+def test_oversized_latest_exchange_is_clipped_not_dropped():
+    answer = 'A long first answer. ' * 2000
+    conversation = {'turns': [
+        turn('user', 'Explain everything'), turn('model', answer)]}
+    contents, tokens = build_contents(conversation, 'And then?')
+
+    assert [c['role'] for c in contents] == ['user', 'model', 'user']
+    assert contents[0]['parts'] == ['Explain everything']
+    assert contents[1]['parts'][0].startswith('A long first answer.')
+    assert tokens <= CHAT_HISTORY_TOKENS + estimate_tokens('And then?')
+
+
+def test_window_keeps_recent_turns_that_fit():
+    conversation = {'turns': [
+        turn('user', 'x ' * 7000), turn('model', 'old answer'),
+        turn('user', 'Second question'), turn('model', 'Second answer')]}
+    contents, _ = build_contents(conversation, 'Third')
+    assert [c['parts'][0] for c in contents] == [
+        'Second question', 'Second answer', 'Third']
+
+
+def test_clip_exchange_fits_the_window():
+    message, answer = clip_exchange('q ' * 10000, 'a ' * 10000)
+    total = estimate_tokens(message) + estimate_tokens(answer)
+    assert total <= CHAT_HISTORY_TOKENS
+    assert message.endswith(' [...]') and answer.endswith(' [...]')
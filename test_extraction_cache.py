@@ -0,0 +1,37 @@
+"""
+Extraction Cache Tests
+Offline checks for extraction_cache.cached_extractor keys (run with pytest)
+"""
+import extraction_cache
+
+
+def test_cached_extractor_normalizes_default_arguments(monkeypatch):
+    keys = []
+
+    def lookup(kind, digest, *args, **kwargs):
+        keys.append(extraction_cache.key_for(kind, digest, *args, **kwargs))
+        return None
+
+    monkeypatch.setattr(extraction_cache, 'lookup', lookup)
+    monkeypatch.setattr(extraction_cache, 'store', lambda *a, **k: None)
+
+    @extraction_cache.cached_extractor('pdf')
+    def extract(source, page_range=None):
+        return 'text'
+
+    extract(b'pdf', digest='d')
+    extract(b'pdf', None, digest='d')
+    extract(b'pdf', page_range=None, digest='d')
+    # The upload routes build keys from resolve_extractor's (None,) args
+    keys.append(extraction_cache.key_for('pdf', 'd', None))
+    assert len(set(keys)) == 1
+
+    extract(b'pdf', (1, 3), digest='d')
+    assert keys[-1] != keys[0]
+
+
+def test_uncached_text_is_never_stored():
+    assert extraction_cache.is_cacheable('Some text')
+    assert not extraction_cache.is_cacheable(
+        extraction_cache.UncachedText('Some text'))
+    assert not extraction_cache.is_cacheable('Error reading file')
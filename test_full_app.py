@@ -1,20 +1,34 @@
 """
 Full Application Test Suite
 Tests all major API endpoints
+
+app.py runs in-process against mock_services, so neither API keys nor a
+running server are needed.
 """
-import requests
-import time
+import os
+
+import mock_services
+
+_client = None
+
 
-BASE_URL = 'http://localhost:5000'
+def get_client():
+    """Start the mock services and return a test client for app.py."""
+    global _client
+    if _client is None:
+        os.environ.update(mock_services.app_env(mock_services.start()))
+        from app import app
+        _client = app.test_client()
+    return _client
 
 
 def test_health():
-    """Test health check endpoint."""
-    print("\n🔍 Testing /api/health...")
+    """Test health check (API status) endpoint."""
+    print("\n🔍 Testing /...")
     try:
-        resp = requests.get(f"{BASE_URL}/api/health", timeout=5)
+        resp = get_client().get("/")
         print(f"✅ Status: {resp.status_code}")
-        data = resp.json()
+        data = resp.get_json()
         print(f"✅ API Status: {data['status']}")
         print(f"✅ API Key Configured: {data['api_key_configured']}")
         return True
@@ -30,9 +44,9 @@ def test_chat():
         payload = {
             'message': 'What is artificial intelligence?'
         }
-        resp = requests.post(f"{BASE_URL}/api/chat", json=payload, timeout=10)
+        resp = get_client().post("/api/chat", json=payload)
         print(f"✅ Status: {resp.status_code}")
-        data = resp.json()
+        data = resp.get_json()
         print(f"✅ Response length: {len(data['response'])} characters")
         print(f"✅ Language detected: {data['language']}")
         print(f"✅ Response preview: {data['response'][:100]}...")
@@ -51,9 +65,9 @@ def test_generate_image():
             'style': 'realistic',
             'size': '1024x1024'
         }
-        resp = requests.post(f"{BASE_URL}/api/generate-image", json=payload, timeout=15)
+        resp = get_client().post("/api/generate-image", json=payload)
         print(f"✅ Status: {resp.status_code}")
-        data = resp.json()
+        data = resp.get_json()
         print(f"✅ Image URL generated: {data['image_url'][:80]}...")
         print(f"✅ Enhanced prompt: {data['enhanced_prompt'][:100]}...")
         return True
@@ -66,9 +80,9 @@ def test_usage():
     """Test usage statistics endpoint."""
     print("\n🔍 Testing /api/usage...")
     try:
-        resp = requests.get(f"{BASE_URL}/api/usage", timeout=5)
+        resp = get_client().get("/api/usage")
         print(f"✅ Status: {resp.status_code}")
-        data = resp.json()
+        data = resp.get_json()
         print(f"✅ Usage data received: {data}")
         return True
     except Exception as e:
@@ -80,9 +94,9 @@ def test_ui_strings():
     """Test UI strings endpoint."""
     print("\n🔍 Testing /api/ui-strings...")
     try:
-        resp = requests.get(f"{BASE_URL}/api/ui-strings?lang=en", timeout=5)
+        resp = get_client().get("/api/ui-strings?lang=en")
         print(f"✅ Status: {resp.status_code}")
-        data = resp.json()
+        data = resp.get_json()
         print(f"✅ Language: {data['language']}")
         print(f"✅ Strings count: {len(data['strings'])}")
         return True
@@ -97,9 +111,8 @@ def main():
     print("🚀 FULL APPLICATION TEST SUITE")
     print("=" * 60)
 
-    # Wait for server to be ready
-    print("\n⏳ Waiting for server to be ready...")
-    time.sleep(2)
+    print("\n⏳ Starting mock services...")
+    get_client()
 
     results = []
 
@@ -0,0 +1,102 @@
+"""
+In-memory upload buffers
+Keeps small uploads in RAM and spills large ones to a unique temp file
+"""
+
+import base64
+import hashlib
+import io
+import os
+import uuid
+
+from werkzeug.utils import secure_filename
+
+# Uploads up to this size never touch the disk.
+UPLOAD_SPILL_BYTES = int(os.getenv('UPLOAD_SPILL_BYTES', str(8 * 1024 * 1024)))
+
+_CHUNK_SIZE = 256 * 1024
+
+
+class UploadBuffer:
+    """A werkzeug upload read once, hashed on the way in.
+
+    ``source`` is what the extractors accept: the raw bytes for small
+    uploads, or the path of the spill file for large ones. Spill files get
+    a random prefix so concurrent uploads with the same name never collide.
+    """
+
+    def __init__(self, file_storage, spill_dir,
+                 threshold=UPLOAD_SPILL_BYTES):
+        self.filename = secure_filename(file_storage.filename or '')
+        self.ext = self.filename.lower().rsplit('.', 1)[-1]
+        self.mimetype = file_storage.mimetype
+        self.data = None
+        self.path = None
+        self.size = 0
+
+        digest = hashlib.sha256()
+        chunks = []
+        spill = None
+        stream = file_storage.stream
+        try:
+            for chunk in iter(lambda: stream.read(_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                self.size += len(chunk)
+                if spill is None and self.size > threshold:
+                    self.path = os.path.join(
+                        spill_dir,
+                        '{}_{}'.format(uuid.uuid4().hex, self.filename))
+                    spill = open(self.path, 'wb')
+                    spill.writelines(chunks)
+                    chunks = []
+                if spill is not None:
+                    spill.write(chunk)
+                else:
+                    chunks.append(chunk)
+        finally:
+            if spill is not None:
+                spill.close()
+
+        if self.path is None:
+            self.data = b''.join(chunks)
+        self.digest = digest.hexdigest()
+
+    @property
+    def source(self):
+        """Bytes for in-memory uploads, a filesystem path once spilled."""
+        return self.path if self.path is not None else self.data
+
+    def open(self):
+        """Return a binary file object over the upload."""
+        if self.path is not None:
+            return open(self.path, 'rb')
+        return io.BytesIO(self.data)
+
+    def b64encode(self):
+        """Base64-encode the upload without re-reading it from disk."""
+        if self.path is not None:
+            with open(self.path, 'rb') as f:
+                return base64.b64encode(f.read()).decode('utf-8')
+        return base64.b64encode(memoryview(self.data)).decode('utf-8')
+
+    def close(self):
+        """Remove the spill file, if any."""
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def as_file(source):
+    """Wrap in-memory bytes so PIL / python-docx can read them; pass paths."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return source
@@ -0,0 +1,370 @@
+"""
+Local image upscaling
+Denoise at source resolution, then upscale, tile by tile across processes
+
+Non-local-means denoising is the expensive step and its cost grows with
+the pixel count, so it runs on the source image (1/scale^2 of the pixels)
+before the resize. The image is cut into tiles with a margin of context
+around each; workers process tiles independently, the margins are
+dropped, and neighbouring tiles are cross-faded over a narrow band so no
+seams show.
+
+Output is produced one strip (a row of tiles) at a time and only a few
+tiles are in flight, so memory depends on the output width, not on its
+size. Jobs are admitted against a pixel and memory budget from the image
+header, before anything is decoded.
+"""
+
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import groupby
+
+import numpy as np
+
+UPSCALE_WORKERS = int(os.getenv('UPSCALE_WORKERS', str(os.cpu_count() or 1)))
+# Tile size in source pixels
+UPSCALE_TILE = int(os.getenv('UPSCALE_TILE', '256'))
+# Context around each tile: NL-means reads 10 + 3 px around each pixel,
+# the sharpen and unsharp filters a few more
+UPSCALE_TILE_MARGIN = 16
+# Neighbouring tiles are cross-faded over 2 * this many source pixels
+UPSCALE_TILE_BLEND = 4
+
+# Admission control, checked against the image header before decoding
+UPSCALE_MAX_INPUT_PIXELS = int(
+    os.getenv('UPSCALE_MAX_INPUT_PIXELS', str(25 * 1000 * 1000)))
+UPSCALE_MAX_OUTPUT_PIXELS = int(
+    os.getenv('UPSCALE_MAX_OUTPUT_PIXELS', str(64 * 1000 * 1000)))
+# Estimated peak memory of all upscales running in this worker at once
+UPSCALE_MEMORY_BUDGET_MB = int(os.getenv('UPSCALE_MEMORY_BUDGET_MB', '256'))
+
+# Full-size RGB copies of a tile alive while OpenCV/PIL process it
+_TILE_COPIES = 6
+
+_SHARPEN_KERNEL = np.array([[-1, -1, -1],
+                            [-1, 9, -1],
+                            [-1, -1, -1]])
+
+_pool = None
+_pool_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {'jobs': 0, 'tiles': 0, 'megapixels': 0.0, 'seconds': 0.0,
+          'pool_restarts': 0, 'clamped': 0, 'rejected': 0, 'busy': 0}
+_reserved = 0
+
+
+class UpscaleTooLarge(Exception):
+    """The image is over the pixel or memory budget at any scale."""
+
+
+class UpscaleBusy(Exception):
+    """Running upscales already use the memory budget; retry later."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _in_flight():
+    """Tiles submitted ahead of the one being blended."""
+    return 2 * UPSCALE_WORKERS if UPSCALE_WORKERS > 1 else 1
+
+
+def estimate_bytes(width, height, scale):
+    """Rough peak memory of upscaling a width x height image.
+
+    The decoded source, one output strip, and the tiles being processed
+    or waiting to be blended; the PNG encoder's buffers are small.
+    """
+    source = width * height * 3
+    strip = width * scale * (UPSCALE_TILE + 2 * UPSCALE_TILE_BLEND) * scale * 3
+    tile = ((UPSCALE_TILE + 2 * (UPSCALE_TILE_BLEND + UPSCALE_TILE_MARGIN))
+            * scale) ** 2 * 3
+    workers = min(UPSCALE_WORKERS, _in_flight())
+    return source + strip + tile * (workers * _TILE_COPIES + _in_flight())
+
+
+def admit(width, height, scale):
+    """Largest scale up to `scale` that fits the budgets.
+
+    Raises UpscaleTooLarge when even 1x does not fit.
+    """
+    if scale < 1:
+        raise ValueError('scale must be at least 1')
+    budget = UPSCALE_MEMORY_BUDGET_MB * 1024 * 1024
+    if width * height > UPSCALE_MAX_INPUT_PIXELS:
+        with _stats_lock:
+            _stats['rejected'] += 1
+        raise UpscaleTooLarge(
+            'Image is {:.1f} MP; the limit is {:.1f} MP'.format(
+                width * height / 1e6, UPSCALE_MAX_INPUT_PIXELS / 1e6))
+    allowed = scale
+    while allowed > 1 and (
+            width * height * allowed ** 2 > UPSCALE_MAX_OUTPUT_PIXELS
+            or estimate_bytes(width, height, allowed) > budget):
+        allowed -= 1
+    if estimate_bytes(width, height, allowed) > budget:
+        with _stats_lock:
+            _stats['rejected'] += 1
+        raise UpscaleTooLarge('Image is too large to enhance')
+    if allowed != scale:
+        with _stats_lock:
+            _stats['clamped'] += 1
+    return allowed
+
+
+class Reservation:
+    """Memory held against the budget until release() (idempotent)."""
+
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+
+    def release(self):
+        global _reserved
+        with _stats_lock:
+            _reserved -= self.nbytes
+            self.nbytes = 0
+
+
+def reserve(width, height, scale):
+    """Reserve a job's estimated memory, or raise UpscaleBusy."""
+    global _reserved
+    nbytes = estimate_bytes(width, height, scale)
+    budget = UPSCALE_MEMORY_BUDGET_MB * 1024 * 1024
+    with _stats_lock:
+        if _reserved and _reserved + nbytes > budget:
+            _stats['busy'] += 1
+            raise UpscaleBusy('Image enhancement is busy', retry_after=5)
+        _reserved += nbytes
+    return Reservation(nbytes)
+
+
+def _init_worker():
+    import cv2
+    # Tiles already run in parallel; one OpenCV thread per process
+    cv2.setNumThreads(1)
+
+
+def enhance_tile(tile, scale, mean):
+    """Denoise, upscale, sharpen and tone one BGR tile; returns RGB.
+
+    ``mean`` is the whole image's mean luminance, so every tile gets the
+    same contrast stretch (PIL's Contrast would use the tile's own).
+    """
+    import cv2
+    from PIL import Image, ImageEnhance, ImageFilter
+
+    # 1. Denoise (at source resolution)
+    denoised = cv2.fastNlMeansDenoisingColored(tile, None, 10, 10, 7, 21)
+
+    # 2. Upscale with INTER_CUBIC (high quality)
+    height, width = denoised.shape[:2]
+    upscaled = cv2.resize(denoised, (width * scale, height * scale),
+                          interpolation=cv2.INTER_CUBIC)
+
+    # 3. Sharpen
+    sharpened = cv2.filter2D(upscaled, -1, _SHARPEN_KERNEL)
+    img = Image.fromarray(cv2.cvtColor(sharpened, cv2.COLOR_BGR2RGB))
+
+    # 4. Contrast, colour and sharpness, then unsharp mask for detail
+    grey = int(mean + 0.5)
+    img = Image.blend(Image.new('RGB', img.size, (grey, grey, grey)), img,
+                      1.2)
+    img = ImageEnhance.Color(img).enhance(1.1)
+    img = ImageEnhance.Sharpness(img).enhance(1.3)
+    img = img.filter(ImageFilter.UnsharpMask(radius=2, percent=150))
+    return np.asarray(img)
+
+
+def _spans(length, tile):
+    """(start, stop) of each tile along one axis."""
+    count = max(1, -(-length // tile))
+    edges = [round(i * length / count) for i in range(count + 1)]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def plan_tiles(height, width, tile=None):
+    """Tiles as (kept, padded) source boxes (top, bottom, left, right).
+
+    ``kept`` is the tile grown by the blend band towards its neighbours;
+    ``padded`` adds the margin of context that is processed and dropped.
+    """
+    tile = tile or UPSCALE_TILE
+    blend, margin = UPSCALE_TILE_BLEND, UPSCALE_TILE_MARGIN
+    tiles = []
+    for top, bottom in _spans(height, tile):
+        for left, right in _spans(width, tile):
+            kept = (max(0, top - blend), min(height, bottom + blend),
+                    max(0, left - blend), min(width, right + blend))
+            padded = (max(0, kept[0] - margin), min(height, kept[1] + margin),
+                      max(0, kept[2] - margin), min(width, kept[3] + margin))
+            tiles.append((kept, padded))
+    return tiles
+
+
+def _ramp(length, band, fade_in):
+    """Weights along one axis, rising over the first `band` pixels."""
+    weights = np.ones(length, dtype=np.float32)
+    if fade_in:
+        band = min(band, length)
+        weights[:band] = np.linspace(0, 1, band + 2, dtype=np.float32)[1:-1]
+    return weights
+
+
+def blend_into(strip, piece, box, scale, strip_top):
+    """Write a processed tile into `strip`, fading into earlier tiles.
+
+    Tiles arrive in raster order, so only the top and left bands overlap
+    pixels that are already written; everything else is copied as is.
+    ``strip_top`` is the output row of ``strip[0]``.
+    """
+    top, bottom, left, right = (v * scale for v in box)
+    band = 2 * UPSCALE_TILE_BLEND * scale
+    fade_top = min(band, bottom - top) if top > 0 else 0
+    fade_left = min(band, right - left) if left > 0 else 0
+    region = strip[top - strip_top:bottom - strip_top, left:right]
+
+    region[fade_top:, fade_left:] = piece[fade_top:, fade_left:]
+    weights = np.outer(_ramp(bottom - top, band, top > 0),
+                       _ramp(right - left, band, left > 0))[..., None]
+    for rows, cols in ((slice(0, fade_top), slice(None)),
+                       (slice(fade_top, None), slice(0, fade_left))):
+        old = region[rows, cols]
+        if old.size:
+            w = weights[rows, cols]
+            old[...] = (old * (1 - w) + piece[rows, cols] * w + 0.5).astype(
+                np.uint8)
+
+
+def _process(job):
+    tile, scale, mean, crop = job
+    piece = enhance_tile(tile, scale, mean)
+    top, bottom, left, right = (v * scale for v in crop)
+    return piece[top:bottom, left:right]
+
+
+def get_pool():
+    """Return the process-wide tile pool, starting it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=UPSCALE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker)
+            atexit.register(_pool.shutdown, wait=False)
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+            _pool = None
+    with _stats_lock:
+        _stats['pool_restarts'] += 1
+
+
+def _jobs(img, scale, mean, tiles):
+    for kept, padded in tiles:
+        tile = np.ascontiguousarray(
+            img[padded[0]:padded[1], padded[2]:padded[3]])
+        # Where the kept box sits inside the processed tile
+        crop = (kept[0] - padded[0], kept[1] - padded[0],
+                kept[2] - padded[2], kept[3] - padded[2])
+        yield tile, scale, mean, crop
+
+
+def _bounded_map(pool, fn, jobs, limit):
+    """pool.map that keeps at most `limit` jobs submitted at a time."""
+    pending = deque()
+    try:
+        for job in jobs:
+            pending.append(pool.submit(fn, job))
+            if len(pending) >= limit:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _mean_luminance(img, rows=256):
+    """Mean grey level, a band at a time instead of a full grey copy."""
+    import cv2
+
+    total = 0.0
+    for top in range(0, img.shape[0], rows):
+        band = img[top:top + rows]
+        total += cv2.cvtColor(band, cv2.COLOR_BGR2GRAY).sum(dtype=np.float64)
+    return total / (img.shape[0] * img.shape[1])
+
+
+def iter_rows(img, scale):
+    """Enhance a BGR uint8 image `scale` times; yield RGB row bands in order.
+
+    Each band is final once yielded; concatenated they form the output.
+    """
+    began = time.perf_counter()
+    height, width = img.shape[:2]
+    mean = _mean_luminance(img)
+    tiles = plan_tiles(height, width)
+
+    if len(tiles) == 1 or UPSCALE_WORKERS < 2:
+        results = map(_process, _jobs(img, scale, mean, tiles))
+    else:
+        results = _bounded_map(get_pool(), _process,
+                               _jobs(img, scale, mean, tiles), _in_flight())
+
+    strip, strip_top = None, 0
+    try:
+        for top, row in groupby(tiles, key=lambda tile: tile[0][:2]):
+            new_strip = np.empty(
+                ((top[1] - top[0]) * scale, width * scale, 3), dtype=np.uint8)
+            if strip is not None:
+                # Rows above this tile row are final; the overlap carries on
+                done = top[0] * scale - strip_top
+                new_strip[:strip.shape[0] - done] = strip[done:]
+                yield strip[:done]
+            strip, strip_top = new_strip, top[0] * scale
+            for (kept, _), piece in zip(row, results):
+                blend_into(strip, piece, kept, scale, strip_top)
+        yield strip
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed); start a fresh pool next time
+        _reset_pool()
+        raise
+
+    with _stats_lock:
+        _stats['jobs'] += 1
+        _stats['tiles'] += len(tiles)
+        _stats['megapixels'] += height * width / 1e6
+        _stats['seconds'] += time.perf_counter() - began
+
+
+def upscale_image(img, scale):
+    """Enhance a BGR uint8 image and enlarge it `scale` times; returns RGB."""
+    return np.concatenate(list(iter_rows(img, scale)))
+
+
+def get_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+        stats['reserved_mb'] = round(_reserved / 1024 / 1024, 1)
+    stats['seconds_per_megapixel'] = round(
+        stats['seconds'] / stats['megapixels'], 3
+    ) if stats['megapixels'] else None
+    stats['megapixels'] = round(stats['megapixels'], 2)
+    stats['seconds'] = round(stats['seconds'], 3)
+    stats['workers'] = UPSCALE_WORKERS
+    stats['memory_budget_mb'] = UPSCALE_MEMORY_BUDGET_MB
+    stats['pool_started'] = _pool is not None
+    return stats